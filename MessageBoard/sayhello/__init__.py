@@ -1,12 +1,12 @@
 from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
 from flask_bootstrap import Bootstrap
 from flask_moment import Moment
+from sayhello.aio import AsyncAwareSQLAlchemy
 
 app = Flask("sayhello")
 app.config.from_pyfile('settings.py')
 
-db = SQLAlchemy(app)
+db = AsyncAwareSQLAlchemy(app)
 bootstrap = Bootstrap(app)
 moment = Moment(app)
 
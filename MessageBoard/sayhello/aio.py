@@ -0,0 +1,218 @@
+"""
+异步服务模式用到的数据库和 ASGI 适配，入口在 sayhello/asgi.py
+"""
+import sys
+import asyncio
+import tempfile
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import request, has_request_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import orm
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import NullPool
+
+try:
+    from sqlalchemy.pool import AsyncAdaptedQueuePool
+    from sqlalchemy.util import greenlet_spawn, await_only
+except ImportError:  # SQLAlchemy 1.4 以前没有异步驱动，只能用同步的 WSGI 入口
+    AsyncAdaptedQueuePool = greenlet_spawn = await_only = None
+from werkzeug.exceptions import HTTPException
+
+# ASGI 入口在 environ 里设置这个键，表示当前请求运行在事件循环的 greenlet 里，要用异步驱动
+ASYNC_ENVIRON_KEY = "sayhello.async"
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "sqlite+pysqlite": "sqlite+aiosqlite",
+    "mysql": "mysql+aiomysql",
+    "mysql+pymysql": "mysql+aiomysql",
+}
+MAX_MEMORY_BODY = 1024 * 1024
+
+
+class AsyncAwareSession(SignallingSession):
+    """异步请求里的查询发往异步引擎，其余情况和 SignallingSession 一样"""
+
+    def __init__(self, db, **options):
+        self.db = db
+        super(AsyncAwareSession, self).__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if has_request_context() and request.environ.get(ASYNC_ENVIRON_KEY, False):
+            return self.db.get_async_engine(self.app).sync_engine
+        return super(AsyncAwareSession, self).get_bind(mapper, clause)
+
+
+class AsyncAwareSQLAlchemy(SQLAlchemy):
+    """
+    多了一个异步引擎的 SQLAlchemy：SAYHELLO_ASYNC_DATABASE_URI 指定异步驱动的地址，
+    没有设置时由 SQLALCHEMY_DATABASE_URI 换成对应的异步驱动（sqlite -> aiosqlite，mysql -> aiomysql）
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.async_engine = None
+        self._async_lock = Lock()
+        super(AsyncAwareSQLAlchemy, self).__init__(*args, **kwargs)
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=AsyncAwareSession, db=self, **options)
+
+    def get_async_engine(self, app):
+        if self.async_engine is None:
+            with self._async_lock:
+                if self.async_engine is None:
+                    self.async_engine = self._create_async_engine(app)
+        return self.async_engine
+
+    def _create_async_engine(self, app):
+        if AsyncAdaptedQueuePool is None:
+            raise RuntimeError("The ASGI entry point requires SQLAlchemy >= 1.4 and greenlet")
+        from sqlalchemy.ext.asyncio import create_async_engine
+
+        sa_url = make_url(app.config.get("SAYHELLO_ASYNC_DATABASE_URI") or app.config["SQLALCHEMY_DATABASE_URI"])
+        drivername = sa_url.drivername
+        if drivername not in ASYNC_DRIVERS.values():
+            if drivername not in ASYNC_DRIVERS:
+                raise ValueError("No async driver for %r, set SAYHELLO_ASYNC_DATABASE_URI" % drivername)
+            drivername = ASYNC_DRIVERS[drivername]
+        # 相对路径、连接池这些和同步引擎一样按数据库类型处理，然后换成异步驱动
+        options = self.apply_pool_defaults(app, {})
+        sa_url, options = self.apply_driver_hacks(app, sa_url.set(drivername=sa_url.get_backend_name()), options)
+        options.update(app.config["SQLALCHEMY_ENGINE_OPTIONS"])
+        if options.get("poolclass") is NullPool:
+            options["poolclass"] = AsyncAdaptedQueuePool  # aiosqlite 每个连接一个线程，用连接池复用
+        return create_async_engine(sa_url.set(drivername=drivername), **options)
+
+    async def dispose_async_engine(self):
+        if self.async_engine is not None:
+            await self.async_engine.dispose()
+            self.async_engine = None
+
+
+def build_environ(scope, body):
+    """把 ASGI 的 HTTP scope 转成 WSGI environ"""
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_PROTOCOL": "HTTP/%s" % scope["http_version"],
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": body,
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    server = scope.get("server") or ("localhost", 80)
+    environ["SERVER_NAME"], environ["SERVER_PORT"] = server[0], str(server[1] or 80)
+    if scope.get("client"):
+        environ["REMOTE_ADDR"], environ["REMOTE_PORT"] = scope["client"][0], str(scope["client"][1])
+
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin-1").upper().replace("-", "_")
+        if name not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            name = "HTTP_" + name
+        value = value.decode("latin-1")
+        environ[name] = environ[name] + "," + value if name in environ else value
+    return environ
+
+
+class ASGIApp(object):
+    """
+    把 Flask 应用包装成 ASGI 应用：SAYHELLO_ASYNC_ENDPOINTS 里的端点在事件循环上的 greenlet 里执行，
+    等待数据库时让出事件循环；其余请求（静态文件、/buffer/stats）放到线程池里执行
+    """
+
+    def __init__(self, app, db):
+        if greenlet_spawn is None:
+            raise RuntimeError("The ASGI entry point requires SQLAlchemy >= 1.4 and greenlet")
+        app.config.setdefault("SAYHELLO_ASYNC_ENDPOINTS", ["index", "messages"])
+        app.config.setdefault("SAYHELLO_ASGI_THREADS", 4)
+
+        self.app = app
+        self.db = db
+        self.executor = ThreadPoolExecutor(max_workers=app.config["SAYHELLO_ASGI_THREADS"],
+                                           thread_name_prefix="sayhello-asgi")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self.lifespan(receive, send)
+        if scope["type"] != "http":
+            raise RuntimeError("Unsupported ASGI scope type: %r" % scope["type"])
+
+        body = tempfile.SpooledTemporaryFile(max_size=MAX_MEMORY_BODY)
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+            body.write(message.get("body", b""))
+            if not message.get("more_body", False):
+                break
+        length = body.tell()
+        body.seek(0)
+
+        environ = build_environ(scope, body)
+        # 分块传输的请求没有 Content-Length，请求体已经全部读完了，按实际长度补上
+        environ.setdefault("CONTENT_LENGTH", str(length))
+        try:
+            if self.is_async(environ):
+                environ[ASYNC_ENVIRON_KEY] = True
+                await greenlet_spawn(self.run_wsgi, environ, send, await_only)
+            else:
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(self.executor, self.run_wsgi, environ, send,
+                                           lambda coroutine: asyncio.run_coroutine_threadsafe(coroutine, loop).result())
+        finally:
+            body.close()
+
+    def is_async(self, environ):
+        try:
+            endpoint, args = self.app.url_map.bind_to_environ(environ).match()
+        except HTTPException:
+            return False
+        return endpoint in self.app.config["SAYHELLO_ASYNC_ENDPOINTS"]
+
+    def run_wsgi(self, environ, send, wait):
+        """
+        执行 WSGI 应用，边迭代响应边发送
+        :param wait: 在当前上下文里等待 send() 协程完成的函数，greenlet 里是 await_only，线程里等待事件循环
+        """
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info is not None and response.get("started"):
+                raise exc_info[1].with_traceback(exc_info[2])
+            response.update(status=int(status.split(" ", 1)[0]), headers=[
+                (name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers])
+
+        def start():
+            if not response.get("started"):
+                response["started"] = True
+                wait(send({"type": "http.response.start", "status": response["status"],
+                           "headers": response["headers"]}))
+
+        iterable = self.app(environ, start_response)
+        try:
+            for chunk in iterable:
+                if chunk:
+                    start()
+                    wait(send({"type": "http.response.body", "body": chunk, "more_body": True}))
+            start()
+            wait(send({"type": "http.response.body", "body": b"", "more_body": False}))
+        finally:
+            if hasattr(iterable, "close"):
+                iterable.close()
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.db.dispose_async_engine()
+                self.executor.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
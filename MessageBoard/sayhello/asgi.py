@@ -0,0 +1,11 @@
+"""
+ASGI 入口：
+
+    uvicorn sayhello.asgi:application
+
+首页和 /messages 在事件循环上用异步驱动执行，一个进程能同时处理的请求数不受线程数限制
+"""
+from sayhello import app, db
+from sayhello.aio import ASGIApp
+
+application = ASGIApp(app, db)
@@ -0,0 +1,134 @@
+import time
+import atexit
+import threading
+from datetime import datetime
+
+from sayhello import app, db
+from sayhello.models import Message
+
+
+class WriteBehindBuffer(object):
+    """
+    留言的写后缓冲。
+
+    表单验证通过的留言先放进进程内的缓冲区，攒够 SAYHELLO_BUFFER_SIZE 条，
+    或者最早的一条等了 SAYHELLO_BUFFER_MAX_AGE 秒，就用一条多行 INSERT 写进数据库，
+    高峰期把很多次提交合并成一次，提交的延迟不再是吞吐量的上限。
+    写入失败的留言放回缓冲区等下次再写，缓冲区里超过 SAYHELLO_BUFFER_MAX_PENDING 条时丢弃新的留言；
+    进程正常退出时会把剩下的留言写完，进程被强制杀掉时缓冲区里的留言会丢失。
+    每个进程各有一个缓冲区，计数也是每个进程单独统计的。
+    """
+
+    # 一条 INSERT 最多写入的行数，SQLite 对一条语句的参数个数有限制
+    MAX_ROWS_PER_INSERT = 200
+
+    def __init__(self, app, model):
+        self.app = app
+        self.table = model.__table__
+        self.size = app.config.get("SAYHELLO_BUFFER_SIZE", 100)
+        self.max_age = app.config.get("SAYHELLO_BUFFER_MAX_AGE", 1.0)
+        self.max_pending = app.config.get("SAYHELLO_BUFFER_MAX_PENDING", 10000)
+        self.rows = []
+        self.oldest = None  # 缓冲区里最早一条留言放进来的时间
+        self.counters = dict(buffered=0, flushed=0, dropped=0, failed=0, flushes=0)
+        self._lock = threading.Lock()  # 保护 rows 和计数
+        self._flush_lock = threading.Lock()  # 同一时间只有一个线程在写数据库
+        self._wakeup = threading.Event()
+        self._thread = None
+        atexit.register(self.close)
+
+    @property
+    def enabled(self):
+        return self.app.config.get("SAYHELLO_WRITE_BEHIND", False)
+
+    def add(self, **values):
+        """
+        放进一条留言，时间戳在写入数据库时才生成
+        :return: 缓冲区满了被丢弃时返回 False
+        """
+        with self._lock:
+            if len(self.rows) >= self.max_pending:
+                self.counters["dropped"] += 1
+                return False
+            if not self.rows:
+                self.oldest = time.time()
+            self.rows.append(values)
+            self.counters["buffered"] += 1
+            full = len(self.rows) >= self.size
+        self._start()
+        if full:
+            self._wakeup.set()  # 交给后台线程写，请求不用等数据库
+        return True
+
+    def flush(self):
+        """
+        把缓冲区里的留言全部写进数据库
+        :return: 写入的行数
+        """
+        with self._flush_lock:
+            with self._lock:
+                rows, self.rows, self.oldest = self.rows, [], None
+            if not rows:
+                return 0
+            # 时间戳在写入时生成：?newer_than=<游标> 按 (timestamp, id) 取新留言，
+            # 如果用放进缓冲区的时间，别的进程先写入的更晚的留言会让轮询的客户端跳过这些留言。
+            # 同一批的时间戳相同，按 id 保持提交的顺序；写入失败重试时重新生成
+            timestamp = datetime.utcnow()
+            values = [dict(row, timestamp=timestamp) for row in rows]
+            try:
+                with self.app.app_context():
+                    with db.engine.begin() as connection:  # 所有批次在一个事务里提交
+                        for start in range(0, len(values), self.MAX_ROWS_PER_INSERT):
+                            connection.execute(
+                                self.table.insert().values(values[start:start + self.MAX_ROWS_PER_INSERT]))
+            except Exception:
+                self.app.logger.exception("Failed to flush %d buffered messages", len(rows))
+                self._requeue(rows)
+                return 0
+            with self._lock:
+                self.counters["flushed"] += len(rows)
+                self.counters["flushes"] += 1
+            return len(rows)
+
+    def _requeue(self, rows):
+        """写入失败的留言放回缓冲区前面，放不下的算作丢弃"""
+        with self._lock:
+            self.counters["failed"] += 1
+            room = max(self.max_pending - len(self.rows), 0)
+            self.counters["dropped"] += max(len(rows) - room, 0)
+            self.rows = rows[:room] + self.rows
+            if self.rows:
+                self.oldest = time.time()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters, pending=len(self.rows))
+        stats.update(enabled=self.enabled, size=self.size, max_age=self.max_age, max_pending=self.max_pending)
+        return stats
+
+    def _start(self):
+        # 第一次用到时才启动后台线程，forge 之类的命令和 fork 之前的主进程里不会多出线程
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="sayhello-write-behind", daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._lock:  # 睡到最早的一条留言到期，或者被写满的缓冲区叫醒
+                timeout = self.max_age if self.oldest is None else max(self.oldest + self.max_age - time.time(), 0)
+            self._wakeup.wait(timeout)
+            self._wakeup.clear()
+            with self._lock:
+                due = self.rows and (len(self.rows) >= self.size or time.time() - self.oldest >= self.max_age)
+            if due:
+                self.flush()
+
+    def close(self):
+        """进程退出时写完缓冲区里剩下的留言"""
+        if self.rows:
+            self.flush()
+
+
+message_buffer = WriteBehindBuffer(app, Message)
@@ -1,11 +1,60 @@
 from datetime import datetime
 from sayhello import db
 
+CURSOR_TIME_FORMAT = "%Y%m%d%H%M%S%f"
+
+
+def decode_cursor(cursor):
+    """
+    游标的格式为 时间戳-id，格式不对的时候抛出 ValueError
+    """
+    timestamp, message_id = cursor.split("-", 1)
+    return datetime.strptime(timestamp, CURSOR_TIME_FORMAT), int(message_id)
+
 
 class Message(db.Model):
-    __table_args__ = {'mysql_engine': 'InnoDB', 'mysql_charset': 'utf8mb4'}
+    # 按 (timestamp, id) 排序和翻页，联合索引同时覆盖了单独按 timestamp 的查询
+    __table_args__ = (db.Index("ix_message_timestamp_id", "timestamp", "id"),
+                      {'mysql_engine': 'InnoDB', 'mysql_charset': 'utf8mb4'})
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(20))
     body = db.Column(db.String(100))
-    timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+
+    @property
+    def cursor(self):
+        return "%s-%d" % (self.timestamp.strftime(CURSOR_TIME_FORMAT), self.id)
+
+    def to_dict(self):
+        return dict(id=self.id, name=self.name, body=self.body,
+                    timestamp=self.timestamp.strftime("%Y-%m-%dT%H:%M:%SZ"), cursor=self.cursor)
+
+    @staticmethod
+    def feed(older_than=None, newer_than=None, limit=20):
+        """
+        按 (timestamp, id) 的游标取一页留言，走联合索引定位，不管翻到多深代价都一样
+        :param older_than: 取比这个游标更早的留言，用于“加载更多”
+        :param newer_than: 取比这个游标更新的留言，用于刷新新留言
+        :param limit: 每页条数
+        :return: (从新到旧排好的留言, 是否还有更多)
+        """
+        query = Message.query
+        if newer_than:
+            timestamp, message_id = decode_cursor(newer_than)
+            query = query.filter(db.or_(Message.timestamp > timestamp,
+                                        db.and_(Message.timestamp == timestamp, Message.id > message_id)))
+            # 从游标往新的方向取，保证新留言很多的时候拿到的是紧挨着游标的一页
+            query = query.order_by(Message.timestamp.asc(), Message.id.asc())
+        else:
+            if older_than:
+                timestamp, message_id = decode_cursor(older_than)
+                query = query.filter(db.or_(Message.timestamp < timestamp,
+                                            db.and_(Message.timestamp == timestamp, Message.id < message_id)))
+            query = query.order_by(Message.timestamp.desc(), Message.id.desc())
 
+        messages = query.limit(limit + 1).all()  # 多取一条用来判断还有没有更多
+        has_more = len(messages) > limit
+        messages = messages[:limit]
+        if newer_than:
+            messages.reverse()
+        return messages, has_more
@@ -1,19 +1,56 @@
-from flask import flash, redirect, url_for, render_template
+from flask import flash, redirect, url_for, render_template, request, abort, jsonify
 from sayhello import app, db
 from sayhello.models import Message
 from sayhello.forms import Helloform
+from sayhello.buffer import message_buffer
+
+
+def load_feed():
+    """
+    按请求里的 older_than / newer_than 游标取一页留言，游标格式不对时返回400
+    """
+    try:
+        return Message.feed(older_than=request.args.get("older_than"), newer_than=request.args.get("newer_than"),
+                            limit=app.config["SAYHELLO_MESSAGE_PER_PAGE"])
+    except ValueError:
+        abort(400)
 
 
 @app.route("/", methods=["GET", "POST"])
 def index():
-    messages = Message.query.order_by(Message.timestamp.desc()).all()
     form = Helloform()
     if form.validate_on_submit():
         name = form.name.data
         body = form.body.data
-        message = Message(body=body, name=name)
-        db.session.add(message)
-        db.session.commit()
-        flash("to world...")
+        if message_buffer.enabled:
+            # 写后缓冲：先放进缓冲区，攒成一批再写库，刚提交的留言可能要等一会儿才显示出来
+            if message_buffer.add(body=body, name=name):
+                flash("to world...")
+            else:
+                flash("留言太多啦，请稍后再试")
+        else:
+            message = Message(body=body, name=name)
+            db.session.add(message)
+            db.session.commit()
+            flash("to world...")
         return redirect(url_for("index"))
-    return render_template("index.html", form=form, messages=messages)
+    # 只渲染最新的一页，更早的留言通过 /messages 按游标加载
+    messages, has_more = load_feed()
+    return render_template("index.html", form=form, messages=messages, has_more=has_more)
+
+
+@app.route("/messages")
+def messages():
+    """
+    增量加载留言：?older_than=<游标> 取更早的一页，?newer_than=<游标> 取更新的留言，
+    返回留言数据和渲染好的列表项
+    """
+    messages, has_more = load_feed()
+    return jsonify(messages=[message.to_dict() for message in messages], has_more=has_more,
+                   html=render_template("_messages.html", messages=messages))
+
+
+@app.route("/buffer/stats")
+def buffer_stats():
+    """写后缓冲的计数：放进缓冲区、写入数据库、丢弃的留言数，以及还没写入的留言数"""
+    return jsonify(message_buffer.stats())
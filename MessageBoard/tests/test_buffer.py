@@ -0,0 +1,73 @@
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+
+from sayhello import app, db
+from sayhello.buffer import WriteBehindBuffer
+from sayhello.models import Message
+
+
+class WriteBehindBufferTestCase(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        # 后台线程按数量或者时间触发写入，测试里调大阈值，由测试自己调用 flush
+        app.config.update(SQLALCHEMY_DATABASE_URI="sqlite:///" + os.path.join(directory, "sayhello.db"),
+                          SAYHELLO_BUFFER_SIZE=1000, SAYHELLO_BUFFER_MAX_AGE=60)
+        self.context = app.app_context()
+        self.context.push()
+        db.create_all()
+        self.buffer = WriteBehindBuffer(app, Message)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
+
+    def messages(self):
+        db.session.remove()
+        return Message.query.order_by(Message.id).all()
+
+    def test_flush_keeps_order_and_stamps_timestamps(self):
+        for i in range(5):
+            self.assertTrue(self.buffer.add(name="yl", body="message %d" % i))
+        self.assertEqual(self.messages(), [])
+
+        before = datetime.utcnow()
+        self.assertEqual(self.buffer.flush(), 5)
+        messages = self.messages()
+        self.assertEqual([message.body for message in messages], ["message %d" % i for i in range(5)])
+        # 时间戳在写入数据库时生成，同一批相同，按 id 保持提交的顺序
+        self.assertEqual(len(set(message.timestamp for message in messages)), 1)
+        self.assertGreaterEqual(messages[0].timestamp, before)
+        self.assertEqual(self.buffer.flush(), 0)
+
+        stats = self.buffer.stats()
+        self.assertEqual((stats["buffered"], stats["flushed"], stats["flushes"], stats["pending"]), (5, 5, 1, 0))
+
+    def test_failed_flush_requeues(self):
+        self.buffer.add(name="yl", body="first")
+        db.drop_all()
+        self.assertEqual(self.buffer.flush(), 0)
+        self.buffer.add(name="yl", body="second")
+        self.assertEqual(self.buffer.stats()["pending"], 2)
+
+        db.create_all()
+        self.assertEqual(self.buffer.flush(), 2)
+        self.assertEqual([message.body for message in self.messages()], ["first", "second"])
+        self.assertEqual(self.buffer.stats()["failed"], 1)
+
+    def test_drop_when_full(self):
+        self.buffer.max_pending = 2
+        self.assertTrue(self.buffer.add(name="yl", body="1"))
+        self.assertTrue(self.buffer.add(name="yl", body="2"))
+        self.assertFalse(self.buffer.add(name="yl", body="3"))
+        self.assertEqual(self.buffer.flush(), 2)
+        self.assertEqual(self.buffer.stats()["dropped"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
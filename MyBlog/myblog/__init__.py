@@ -4,8 +4,10 @@ from myblog.blueprints.auth import auth_bp
 from myblog.blueprints.blog import blog_bp
 import os
 from myblog.settings import config
-from myblog.extensions import bootstrap, db, mail, ckeditor, moment, login_manager, csrf
-from myblog.models import Admin, Post, Category, Comment, Link
+from myblog.extensions import bootstrap, db, mail, ckeditor, moment, login_manager, csrf, context_cache, response_cache, \
+    mail_dispatcher, sql_recorder, assets, login_throttle
+from myblog.models import Admin, Post, Category, Comment, Link, SearchTerm
+from myblog.streaming import stream_flush
 import click
 from flask_wtf.csrf import CSRFError
 from flask_login import current_user
@@ -37,27 +39,41 @@ def register_blueprints(app):
 def register_extensions(app):
     bootstrap.init_app(app)
     db.init_app(app)
+    sql_recorder.init_app(app)
     ckeditor.init_app(app)
     mail.init_app(app)
+    mail_dispatcher.init_app(app)
     moment.init_app(app)
     login_manager.init_app(app)
+    login_throttle.init_app(app)
     csrf.init_app(app)
+    context_cache.init_app(app)
+    response_cache.init_app(app)
+    assets.init_app(app)
 
 
 def register_template_context(app):
     @app.context_processor  # 注册模板上下文函数，其返回的模板变量可以在任意模板中使用
     def make_template_context():
-        admin = Admin.query.first()
-        categories = Category.query.order_by(Category.name).all()
-        links = Link.query.order_by(Link.name).all()
+        # 侧边栏的数据走进程内缓存，缓存里的对象已经脱离了原来的 session，
+        # 用 merge(load=False) 挂到当前 session 上，不会产生查询
+        admin = context_cache.get("admin", lambda: Admin.query.first())
+        if admin is not None:
+            admin = db.session.merge(admin, load=False)
+        categories = [db.session.merge(category, load=False) for category in
+                      context_cache.get("categories", lambda: Category.query.order_by(Category.name).all())]
+        links = [db.session.merge(link, load=False) for link in
+                 context_cache.get("links", lambda: Link.query.order_by(Link.name).all())]
 
         if current_user.is_authenticated:
-            unread_comments = Comment.query.filter_by(reviewed=False).count()
+            unread_comments = Comment.unread_count()
         else:
             unread_comments = None
 
         return dict(admin=admin, categories=categories, links=links, unread_comments=unread_comments)
 
+    app.add_template_global(stream_flush)
+
 
 def register_commands(app):
     @app.cli.command()
@@ -94,6 +110,7 @@ def register_commands(app):
             click.echo('已经存在管理员，正在跟新...')
             admin.username = username
             admin.set_password(password)
+            admin.bump_session_version()  # 以前登录的会话全部失效
         else:
             click.echo('创建管理员账户中...')
             admin = Admin(
@@ -113,16 +130,131 @@ def register_commands(app):
             db.session.add(category)
 
         db.session.commit()
+        context_cache.invalidate()
+        response_cache.clear()
         click.echo('Done.')
 
+    @app.cli.command()
+    def upgrade():
+        """给已有的数据库补上新增的表、列和索引，并回填冗余数据"""
+        from myblog.migrations import upgrade_schema
+
+        changes = upgrade_schema()
+        for change in changes:
+            click.echo(change)
+        click.echo("数据表结构已经是最新的了" if not changes else "共执行了%d项变更" % len(changes))
+
+        Post.query.filter(Post.last_modified.is_(None)).update({Post.last_modified: Post.timestamp},
+                                                               synchronize_session=False)
+        if SearchTerm.query.first() is None:
+            from myblog.search import rebuild_index
+            click.echo("为%d篇博客建立了搜索索引" % rebuild_index())
+        count = Comment.update_paths()
+        if count:
+            click.echo("为%d条评论生成了讨论串路径" % count)
+        count = Post.update_excerpts()
+        if count:
+            click.echo("为%d篇博客生成了摘要" % count)
+        Category.update_post_counts()
+        Post.update_comment_counts()
+        db.session.commit()
+        context_cache.invalidate()
+        response_cache.clear()
+        click.echo("Done.")
+
+    @app.cli.command()
+    @click.option("--batch-size", default=500, help="每批读取的文章数")
+    def reindex(batch_size):
+        """重建全文搜索的索引"""
+        from myblog.search import rebuild_index
+
+        count = rebuild_index(batch_size)
+        click.echo("为%d篇博客建立了索引" % count)
+
+    @app.cli.command()
+    @click.option("--batch-size", default=500, help="每批读取的文章数")
+    @click.option("--all", "regenerate_all", is_flag=True, help="重新生成所有文章的摘要，默认只处理没有摘要的")
+    def excerpts(batch_size, regenerate_all):
+        """生成文章摘要和字数"""
+        count = Post.update_excerpts(batch_size, only_missing=not regenerate_all)
+        db.session.commit()
+        response_cache.clear()
+        click.echo("为%d篇博客生成了摘要" % count)
+
+    @app.cli.command("assets")
+    @click.option("--clean", is_flag=True, help="删除已经不用的旧版本文件")
+    def build_assets(clean):
+        """生成带内容哈希的静态文件以及 .gz/.br 预压缩版本"""
+        count, written = assets.build(app, clean)
+        response_cache.clear()  # 缓存的页面里还是旧的静态文件地址
+        click.echo("共%d个静态文件，新写入%d个文件，重启应用后生效" % (count, written))
+
+    @app.cli.command("merge-category")
+    @click.argument("source")
+    @click.argument("target", required=False)
+    def merge_category(source, target):
+        """把 SOURCE 分类的文章移到 TARGET 分类（默认为默认分类）并删除 SOURCE，分类可以用id或者名字"""
+        def find(value):
+            category = Category.query.get(int(value)) if value.isdigit() else None
+            category = category or Category.query.filter_by(name=value).first()
+            if category is None:
+                raise click.BadParameter("没有这个分类：%s" % value)
+            return category
+
+        category = find(source)
+        target = find(target) if target is not None else Category.query.get(1)
+        if category.id == 1 or category.id == target.id:
+            raise click.BadParameter("不能合并默认分类，也不能合并到自己")
+        name = category.name
+        moved = category.merge_into(target)
+        db.session.commit()
+        context_cache.invalidate()
+        response_cache.clear()
+        click.echo("已将分类 %s 合并到 %s，移动了%d篇文章" % (name, target.name, moved))
+
+    @app.cli.command()
+    @click.option("--strict", is_flag=True, help="发现全表扫描或者额外排序时以非0状态退出")
+    def explain(strict):
+        """对博客和后台的热点查询执行 EXPLAIN，标出全表扫描（full scan）和额外排序（filesort）"""
+        from myblog.explain import hot_queries, explain as explain_query
+
+        flagged = 0
+        for name, query in hot_queries():
+            sql, plan, problems = explain_query(db.engine, query)
+            flagged += bool(problems)
+            if problems:
+                click.echo("!! %s (%s)" % (name, ", ".join(problems)))
+            else:
+                click.echo("ok %s" % name)
+            for line in plan:
+                click.echo("    " + line)
+        click.echo("共%d条查询有问题，先执行 flask upgrade 建立缺少的索引" % flagged if flagged else "所有查询都用上了索引")
+        if strict and flagged:
+            raise SystemExit(1)
+
+    @app.cli.command()
+    def recount():
+        """重新统计分类的文章数以及文章的评论数"""
+        Category.update_post_counts()
+        Post.update_comment_counts()
+        db.session.commit()
+        context_cache.invalidate()
+        response_cache.clear()
+        click.echo("Done.")
+
     @app.cli.command()
     @click.option('--category', default=5, help='Quantity of categories, default is 5.')
     @click.option('--post', default=10, help='Quantity of posts, default is 10.')
     @click.option('--comment', default=100, help='Quantity of comments, default is 100.')
-    def forge(category, post, comment):
+    @click.option('--batch-size', default=1000, help='Rows per bulk insert, default is 1000.')
+    @click.option('--processes', default=1, help='Processes used to generate fake text, default is 1.')
+    def forge(category, post, comment, batch_size, processes):
         """Generate fake data."""
+        import time
         from myblog.fakes import fake_admin, fake_categories, fake_posts, fake_comments, fake_links
+        from myblog.search import rebuild_index
 
+        start = time.time()
         db.drop_all()
         db.create_all()
 
@@ -133,15 +265,20 @@ def register_commands(app):
         fake_categories(category)
 
         click.echo('Generating %d posts...' % post)
-        fake_posts(post)
+        fake_posts(post, batch_size, processes)
 
         click.echo('Generating %d comments...' % comment)
-        fake_comments(comment)
+        fake_comments(comment, batch_size, processes)
 
         click.echo('Generating links...')
         fake_links()
 
-        click.echo('Done.')
+        click.echo('Building the search index...')
+        rebuild_index()
+        context_cache.invalidate()
+        response_cache.clear()
+
+        click.echo('Done in %.1fs.' % (time.time() - start))
 
 
 def register_errors(app):
@@ -153,6 +290,11 @@ def register_errors(app):
     def page_not_found(e):
         return render_template("errors/404.html"), 404
 
+    @app.errorhandler(429)
+    def too_many_requests(e):
+        headers = {"Retry-After": str(e.retry_after)} if getattr(e, "retry_after", None) else {}
+        return render_template("errors/429.html", description=e.description), 429, headers
+
     @app.errorhandler(500)
     def internal_server_error(e):
         return render_template("errors/500.html"), 500
@@ -0,0 +1,162 @@
+"""
+ASGI 入口，和 create_app 并列：
+
+    uvicorn myblog.asgi:create_asgi_app --factory --port 9001
+
+MYBLOG_ASYNC_BLUEPRINTS 里的蓝本（默认只有 blog）的 GET/HEAD 请求运行在事件循环上：每个请求一个 greenlet，
+数据库走异步驱动（SQLite 用 aiosqlite，MySQL 用 aiomysql），等待数据库时让出事件循环去处理别的请求，
+一个进程能同时处理的请求数不再受线程数限制，只受连接池大小限制。
+视图、模板和 ORM 代码不用改成 async def，SQLAlchemy 的 AsyncSession 也是用同样的方式在 greenlet 里运行同步代码的。
+后台、登录、评论提交和静态文件这些请求仍然是同步的，在 MYBLOG_ASGI_THREADS 个线程的线程池里用同步驱动执行。
+"""
+import sys
+import asyncio
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy.util import greenlet_spawn, await_only  # SQLAlchemy 1.4+，同步的 WSGI 入口不会导入这个模块
+from werkzeug.exceptions import HTTPException
+
+from myblog import create_app
+from myblog.extensions import db
+from myblog.routing import ASYNC_ENVIRON_KEY
+
+# 请求体超过这个大小时放到临时文件里
+MAX_MEMORY_BODY = 1024 * 1024
+
+
+def build_environ(scope, body):
+    """把 ASGI 的 HTTP scope 转成 WSGI environ"""
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_PROTOCOL": "HTTP/%s" % scope["http_version"],
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": body,
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    server = scope.get("server") or ("localhost", 80)
+    environ["SERVER_NAME"], environ["SERVER_PORT"] = server[0], str(server[1] or 80)
+    if scope.get("client"):
+        environ["REMOTE_ADDR"], environ["REMOTE_PORT"] = scope["client"][0], str(scope["client"][1])
+
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin-1").upper().replace("-", "_")
+        if name not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            name = "HTTP_" + name
+        value = value.decode("latin-1")
+        environ[name] = environ[name] + "," + value if name in environ else value
+    return environ
+
+
+class ASGIApp(object):
+    """
+    把 Flask 应用包装成 ASGI 应用，按请求分成两条路径：
+    异步请求在事件循环上的 greenlet 里执行，其余请求放到线程池里执行
+    """
+
+    def __init__(self, app, db):
+        app.config.setdefault("MYBLOG_ASYNC_BLUEPRINTS", ["blog"])
+        app.config.setdefault("MYBLOG_ASGI_THREADS", 8)
+
+        self.app = app
+        self.db = db
+        self.executor = ThreadPoolExecutor(max_workers=app.config["MYBLOG_ASGI_THREADS"],
+                                           thread_name_prefix="myblog-asgi")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self.lifespan(receive, send)
+        if scope["type"] != "http":
+            raise RuntimeError("Unsupported ASGI scope type: %r" % scope["type"])
+
+        body = tempfile.SpooledTemporaryFile(max_size=MAX_MEMORY_BODY)
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+            body.write(message.get("body", b""))
+            if not message.get("more_body", False):
+                break
+        length = body.tell()
+        body.seek(0)
+
+        environ = build_environ(scope, body)
+        # 分块传输的请求没有 Content-Length，请求体已经全部读完了，按实际长度补上
+        environ.setdefault("CONTENT_LENGTH", str(length))
+        try:
+            if self.is_async(environ):
+                environ[ASYNC_ENVIRON_KEY] = True
+                await greenlet_spawn(self.run_wsgi, environ, send, await_only)
+            else:
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(self.executor, self.run_wsgi, environ, send,
+                                           lambda coroutine: asyncio.run_coroutine_threadsafe(coroutine, loop).result())
+        finally:
+            body.close()
+
+    def is_async(self, environ):
+        """按 URL 规则匹配到的端点判断请求走哪条路径，匹配不到（404、重定向）的交给线程池"""
+        if environ["REQUEST_METHOD"] not in ("GET", "HEAD"):
+            return False
+        try:
+            endpoint, args = self.app.url_map.bind_to_environ(environ).match()
+        except HTTPException:
+            return False
+        return endpoint.rpartition(".")[0] in self.app.config["MYBLOG_ASYNC_BLUEPRINTS"]
+
+    def run_wsgi(self, environ, send, wait):
+        """
+        执行 WSGI 应用，边迭代响应边发送，流式渲染的页面也能分段到达浏览器
+        :param wait: 在当前上下文里等待 send() 协程完成的函数，greenlet 里是 await_only，线程里等待事件循环
+        """
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info is not None and response.get("started"):
+                raise exc_info[1].with_traceback(exc_info[2])
+            response.update(status=int(status.split(" ", 1)[0]), headers=[
+                (name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers])
+
+        def start():
+            if not response.get("started"):
+                response["started"] = True
+                wait(send({"type": "http.response.start", "status": response["status"],
+                           "headers": response["headers"]}))
+
+        iterable = self.app(environ, start_response)
+        try:
+            for chunk in iterable:
+                if chunk:
+                    start()
+                    wait(send({"type": "http.response.body", "body": chunk, "more_body": True}))
+            start()
+            wait(send({"type": "http.response.body", "body": b"", "more_body": False}))
+        finally:
+            if hasattr(iterable, "close"):
+                iterable.close()
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.db.dispose_async_engines(self.app)
+                self.executor.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+
+def create_asgi_app(config_name=None):
+    """
+    ASGI 应用的工厂函数
+    :param config_name: 同 create_app
+    """
+    return ASGIApp(create_app(config_name), db)
@@ -0,0 +1,191 @@
+import os
+import io
+import json
+import gzip
+import hashlib
+import tempfile
+import mimetypes
+
+from flask import request, url_for, send_from_directory, current_app
+from werkzeug.exceptions import NotFound
+
+try:
+    from werkzeug.utils import safe_join
+except ImportError:  # Werkzeug 2.0 以前在 werkzeug.security 里
+    from werkzeug.security import safe_join
+
+try:
+    import brotli
+except ImportError:  # brotli 是可选依赖，没有安装时只生成 .gz
+    brotli = None
+
+# 预压缩只对文本类型有意义，图片、字体本身已经压缩过了
+COMPRESSIBLE_EXTENSIONS = {".css", ".js", ".map", ".svg", ".json", ".txt", ".html", ".xml"}
+MIN_COMPRESS_SIZE = 256
+HASH_LENGTH = 12
+
+# 按 Accept-Encoding 依次尝试的预压缩版本
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+
+def hashed_name(filename, content):
+    """css/blue.css -> css/blue.<内容哈希>.css，内容不变文件名就不变"""
+    root, ext = os.path.splitext(filename)
+    return "%s.%s%s" % (root, hashlib.md5(content).hexdigest()[:HASH_LENGTH], ext)
+
+
+def gzip_compress(content):
+    # mtime 固定为0，同样的内容每次构建得到同样的 .gz
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode="wb", compresslevel=9, mtime=0) as f:
+        f.write(content)
+    return buffer.getvalue()
+
+
+def _write_file(path, content):
+    """先写临时文件再改名，应用读到的文件要么是旧的要么是完整的新文件"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, "wb") as f:
+        f.write(content)
+    os.chmod(tmp_path, 0o644)  # mkstemp 建的文件只有自己能读，前面的 nginx 也要能读
+    os.replace(tmp_path, path)
+
+
+class Assets(object):
+    """
+    带内容哈希、预压缩的静态文件。
+
+    flask assets 把应用的 static 目录以及 MYBLOG_ASSETS_EXTRA 里列出的蓝本静态文件复制到 MYBLOG_ASSETS_DIR，
+    文件名里带上内容哈希，文本文件另外生成 .gz（安装了 brotli 时还有 .br），对应关系写在 manifest.json 里。
+    模板里用 asset_url() 代替 url_for('static', ...)，清单里有的文件生成带哈希的地址，
+    由 MYBLOG_ASSETS_URL_PATH 下的路由按 Accept-Encoding 返回预压缩的版本，缓存一年并标记 immutable；
+    清单里没有的文件退回到原来的 static 路由。
+    清单在应用启动时读取，重新构建以后需要重启应用。
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.manifest = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("MYBLOG_ASSETS_FINGERPRINT", True)
+        app.config.setdefault("MYBLOG_ASSETS_DIR", os.path.join(app.root_path, "assets"))
+        app.config.setdefault("MYBLOG_ASSETS_URL_PATH", "/assets")
+        app.config.setdefault("MYBLOG_ASSETS_MAX_AGE", 365 * 24 * 3600)
+        app.config.setdefault("MYBLOG_ASSETS_EXTRA", {})
+
+        self.app = app
+        app.extensions["assets"] = self
+        self.manifest = self.load_manifest(app) if app.config["MYBLOG_ASSETS_FINGERPRINT"] else {}
+        app.add_url_rule(app.config["MYBLOG_ASSETS_URL_PATH"].rstrip("/") + "/<path:filename>",
+                         endpoint="assets", view_func=self.send_asset)
+        app.add_template_global(self.asset_url)
+
+    @staticmethod
+    def manifest_path(app):
+        return os.path.join(app.config["MYBLOG_ASSETS_DIR"], "manifest.json")
+
+    def load_manifest(self, app):
+        try:
+            with open(self.manifest_path(app), encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def asset_url(self, filename, endpoint="static"):
+        """
+        静态文件的地址，构建过的返回带哈希的地址
+        :param filename: 相对于静态目录的文件名
+        :param endpoint: 静态文件的端点，比如 static、bootstrap.static
+        """
+        hashed = self.manifest.get(endpoint, {}).get(filename)
+        if hashed is None:
+            return url_for(endpoint, filename=filename)
+        return url_for("assets", filename=hashed)
+
+    def send_asset(self, filename):
+        directory = current_app.config["MYBLOG_ASSETS_DIR"]
+        if filename == "manifest.json" or filename.endswith((".gz", ".br")):
+            raise NotFound()
+        mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        for encoding, suffix in ENCODINGS:
+            if not request.accept_encodings[encoding]:
+                continue
+            path = safe_join(directory, filename + suffix)
+            if path is not None and os.path.isfile(path):
+                response = send_from_directory(directory, filename + suffix, mimetype=mimetype)
+                response.headers["Content-Encoding"] = encoding
+                break
+        else:
+            response = send_from_directory(directory, filename, mimetype=mimetype)
+        # 文件名带了内容哈希，内容变了地址也会变，可以放心地让浏览器和CDN缓存一年
+        response.vary.add("Accept-Encoding")
+        response.headers["Cache-Control"] = "public, max-age=%d, immutable" % current_app.config[
+            "MYBLOG_ASSETS_MAX_AGE"]
+        return response
+
+    def sources(self, app):
+        """
+        需要构建的静态文件
+        :return: (端点, 文件名, 文件路径, 输出目录前缀) 的生成器
+        """
+        if app.static_folder and os.path.isdir(app.static_folder):
+            for root, dirs, files in os.walk(app.static_folder):
+                for name in sorted(files):
+                    path = os.path.join(root, name)
+                    filename = os.path.relpath(path, app.static_folder).replace(os.sep, "/")
+                    yield "static", filename, path, ""
+
+        for blueprint_name, filenames in app.config["MYBLOG_ASSETS_EXTRA"].items():
+            blueprint = app.blueprints.get(blueprint_name)
+            if blueprint is None or not blueprint.has_static_folder:
+                continue
+            for filename in filenames:
+                path = safe_join(blueprint.static_folder, filename)
+                if path is not None and os.path.isfile(path):
+                    yield blueprint_name + ".static", filename, path, blueprint_name + "/"
+
+    def build(self, app, clean=False):
+        """
+        生成带哈希的文件和预压缩版本，写入清单
+        :param clean: 删除清单里已经不用的旧文件
+        :return: (文件数, 新写入的文件数)
+        """
+        directory = app.config["MYBLOG_ASSETS_DIR"]
+        manifest = {}
+        outputs = set()
+        written = 0
+        for endpoint, filename, path, prefix in self.sources(app):
+            with open(path, "rb") as f:
+                content = f.read()
+            hashed = prefix + hashed_name(filename, content)
+            manifest.setdefault(endpoint, {})[filename] = hashed
+
+            variants = [("", content)]
+            if os.path.splitext(filename)[1].lower() in COMPRESSIBLE_EXTENSIONS and len(content) >= MIN_COMPRESS_SIZE:
+                variants.append((".gz", gzip_compress(content)))
+                if brotli is not None:
+                    variants.append((".br", brotli.compress(content, quality=11)))
+            for suffix, data in variants:
+                if suffix and len(data) >= len(content):
+                    continue
+                target = os.path.join(directory, *(hashed + suffix).split("/"))
+                outputs.add(target)
+                if not os.path.exists(target):  # 文件名带哈希，存在就说明内容相同
+                    _write_file(target, data)
+                    written += 1
+
+        manifest_path = self.manifest_path(app)
+        _write_file(manifest_path, json.dumps(manifest, indent=2, sort_keys=True).encode("utf-8"))
+        if clean:
+            outputs.add(manifest_path)
+            for root, dirs, files in os.walk(directory):
+                for name in files:
+                    path = os.path.join(root, name)
+                    if path not in outputs:
+                        os.remove(path)
+        self.manifest = manifest
+        return sum(len(files) for files in manifest.values()), written
@@ -1,11 +1,15 @@
-from flask import render_template, flash, redirect, url_for, request, current_app, Blueprint, send_from_directory
+from datetime import datetime, timedelta
+from flask import render_template, flash, redirect, url_for, request, current_app, Blueprint, send_from_directory, \
+    jsonify, abort
 from flask_login import login_required, current_user
 from flask_ckeditor import upload_success, upload_fail
 
 from myblog.forms import SettingForm, PostForm, CategoryForm, LinkForm
-from myblog.models import Post, Comment, Category, Link
+from myblog.models import Admin, Post, Comment, Category, Link
 from myblog.utils import redirect_back, allowed_file
-from myblog.extensions import db
+from myblog.pagination import paginate
+from myblog.search import index_post, unindex_post
+from myblog.extensions import db, context_cache, response_cache, sql_recorder, identity_key, login_throttle
 
 admin_bp = Blueprint("admin", __name__)
 
@@ -28,7 +32,11 @@ def settings():
         current_user.blog_title = form.blog_title.data
         current_user.blog_sub_title = form.blog_sub_title.data
         current_user.about = form.about.data
+        current_user.site_modified = datetime.utcnow()
         db.session.commit()  # extensions中将admin的数据注入到了current_user
+        # 别的 worker 核对 site_modified 时发现变了，会重新加载缓存的身份
+        context_cache.invalidate("admin", identity_key(current_user.id))
+        response_cache.clear()  # 博客标题等每个页面都有
         flash("修改成功", "success")
         return redirect(url_for("blog.index"))
 
@@ -41,12 +49,12 @@ def settings():
 
 @admin_bp.route("/post/manage")
 def manage_post():
-    page = request.args.get("page", 1, type=int)
-    pagination = Post.query.order_by(Post.timestamp.desc()).paginate(
-        page, per_page=current_app.config["MYBLOG_POST_PAGE_NUM"]
-    )
+    # 只加载表格里显示的列，不加载正文
+    query = Post.query.options(db.load_only("id", "title", "timestamp", "category_id", "comment_count", "word_count",
+                                            "can_comment"))
+    pagination = paginate(query, Post, current_app.config["MYBLOG_POST_PAGE_NUM"])
     posts = pagination.items
-    return render_template("admin/manage_post.html", page=page, pagination=pagination, posts=posts)
+    return render_template("admin/manage_post.html", pagination=pagination, posts=posts)
 
 
 @admin_bp.route("/post/new", methods=["GET", "POST"])
@@ -57,8 +65,16 @@ def new_post():
         body = form.body.data
         category = Category.query.get(form.category.data)  # 这里是存的 category 对象，存 category_id 也OK
         post = Post(title=title, body=body, category=category)
+        post.update_excerpt()
         db.session.add(post)
+        if category is not None:
+            category.increase_post_count()
+        Admin.mark_site_modified()  # 侧边栏的分类文章数变了
+        db.session.flush()  # 拿到文章id以后才能建立搜索索引
+        index_post(post)
         db.session.commit()
+        context_cache.invalidate("categories")
+        response_cache.clear()
         flash("博客创建成功", "success")
         return redirect(url_for("blog.show_post", post_id=post.id))
     return render_template("admin/new_post.html", form=form)
@@ -71,8 +87,24 @@ def edit_post(post_id):
     if form.validate_on_submit():
         post.title = form.title.data
         post.body = form.body.data
-        post.category = Category.query.get(form.category.data)
+        post.update_excerpt()
+        category = Category.query.get(form.category.data)
+        category_changed = category is not post.category
+        if category_changed:
+            if post.category is not None:
+                post.category.increase_post_count(-1)
+            if category is not None:
+                category.increase_post_count()
+            post.category = category
+            Admin.mark_site_modified()
+        post.last_modified = datetime.utcnow()
+        index_post(post)
         db.session.commit()  # post对象被取出来了，这里就不用session.add了
+        context_cache.invalidate("categories")
+        if category_changed:
+            response_cache.clear()  # 侧边栏的分类文章数变了
+        else:
+            response_cache.invalidate("post:%d" % post.id)
         flash("博客更新成功", "success")
         return redirect(url_for("blog.show_post", post_id=post_id))
     form.title.data = post.title
@@ -84,8 +116,17 @@ def edit_post(post_id):
 @admin_bp.route("/post/<int:post_id>/delete", methods=["POST"])  # 这就代表只接收POST请求
 def delete_post(post_id):
     post = Post.query.get_or_404(post_id)
-    db.session.delete(post)  # 删除博客
+    if post.category is not None:
+        post.category.increase_post_count(-1)
+    # 先批量删掉评论和所有回复，其他文章下面回复了这篇文章评论的老数据也一起删除，这些文章的评论数会重新统计
+    Comment.bulk_delete(post_id=post.id)
+    unindex_post(post.id)
+    # 评论已经删掉了，不用 session.delete，它会为了级联删除再加载一遍 comments
+    Post.query.filter(Post.id == post.id).delete(synchronize_session="evaluate")  # 删除博客
+    Admin.mark_site_modified()
     db.session.commit()
+    context_cache.invalidate("categories", "unread_comments")
+    response_cache.clear()
     flash("删除成功", "success")
     return redirect_back()
 
@@ -102,43 +143,105 @@ def set_comment(post_id):
     else:
         post.can_comment = True
         flash("允许评论成功", "success")
+    post.last_modified = datetime.utcnow()
     db.session.commit()
+    response_cache.invalidate("post:%d" % post.id)
     return redirect_back()
 
 
 @admin_bp.route("/comment/<int:comment_id>/approve", methods=["POST"])
 def approve_comment(comment_id):
     comment = Comment.query.get_or_404(comment_id)
+    if not comment.reviewed:
+        comment.post.reviewed_comment_count = Post.reviewed_comment_count + 1
     comment.reviewed = True  # 评审评论
+    comment.post.last_modified = datetime.utcnow()
     db.session.commit()
+    context_cache.invalidate("unread_comments")
+    response_cache.invalidate("post:%d" % comment.post_id)
     flash("评论发表", "success")
     return redirect_back()
 
 
+def comment_filters(args):
+    """
+    从请求参数里取出评论的过滤条件：filter（all, unread, admin）、post_id，以及 start、end 两个日期（YYYY-MM-DD，UTC，包含当天）
+    :return: Comment.filter_criteria 的参数，日期格式不对时抛出 ValueError
+    """
+    filters = {}
+    filter_rule = args.get("filter", "all")
+    if filter_rule == "unread":
+        filters["reviewed"] = False
+    elif filter_rule == "admin":
+        filters["from_admin"] = True
+    if args.get("post_id"):
+        filters["post_id"] = int(args["post_id"])
+    if args.get("start"):
+        filters["start"] = datetime.strptime(args["start"], "%Y-%m-%d")
+    if args.get("end"):
+        filters["end"] = datetime.strptime(args["end"], "%Y-%m-%d") + timedelta(days=1)
+    return filters
+
+
 @admin_bp.route("/comment/manage")
 def manage_comment():
-    filter_rule = request.args.get("filter", "all")  # all, unreviewed, admin
-    page = request.args.get("page", 1, type=int)
     per_page = current_app.config["MYBLOG_POST_PAGE_NUM"]
+    try:
+        filters = comment_filters(request.args)
+    except ValueError:
+        abort(400)
 
     # 这里先根据过滤条件取出所有符合条件的评论
-    if filter_rule == "unread":
-        filtered_comments = Comment.query.filter_by(reviewed=False)
-    elif filter_rule == "admin":
-        filtered_comments = Comment.query.filter_by(from_admin=True)
-    else:
-        filtered_comments = Comment.query
-
-    pagination = filtered_comments.order_by(Comment.timestamp.desc()).paginate(page, per_page=per_page)
+    # 列表里的文章链接只用到文章的 id、title，连表一次取出，不再按文章逐个懒加载整篇正文
+    filtered_comments = Comment.query.options(db.joinedload(Comment.post).load_only("id", "title")) \
+        .filter(*Comment.filter_criteria(**filters))
+    pagination = paginate(filtered_comments, Comment, per_page)
     comments = pagination.items
     return render_template("admin/manage_comment.html", comments=comments, pagination=pagination)
 
 
+@admin_bp.route("/comment/bulk", methods=["POST"])
+def bulk_comment():
+    """
+    批量发表、删除评论：scope 为 selected 时处理勾选的评论，为 filter 时处理所有符合过滤条件的评论
+    """
+    action = request.form.get("action")
+    if action not in ("approve", "delete"):
+        abort(400)
+    if request.form.get("scope") == "filter":
+        try:
+            filters = comment_filters(request.form)
+        except ValueError:
+            flash("过滤条件的格式不对", "warning")
+            return redirect_back()
+    else:
+        ids = request.form.getlist("ids", type=int)
+        filters = dict(ids=ids) if ids else {}
+    if not filters:  # 不允许一次处理全部评论
+        flash("请先勾选评论或者设置过滤条件", "warning")
+        return redirect_back()
+
+    if action == "approve":
+        count, post_ids = Comment.bulk_approve(**filters)
+        message = "发表了 %d 条评论" % count
+    else:
+        count, replies, post_ids = Comment.bulk_delete(**filters)
+        message = "删除了 %d 条评论" % count + ("，其中 %d 条是级联删除的回复" % replies if replies else "")
+    db.session.commit()
+    context_cache.invalidate("unread_comments")
+    response_cache.invalidate(*["post:%d" % post_id for post_id in post_ids])
+    flash(message, "success")
+    return redirect_back()
+
+
 @admin_bp.route("/comment/<int:comment_id>/delete", methods=["POST"])
 def delete_comment(comment_id):
     comment = Comment.query.get_or_404(comment_id)
-    db.session.delete(comment)
+    # 讨论串按 path 区间和 replied_id 找出来一起删除，不逐条懒加载回复，评论数用一条 UPDATE 重新统计
+    affected_post_ids = Comment.bulk_delete(ids=[comment.id])[2]
     db.session.commit()
+    context_cache.invalidate("unread_comments")
+    response_cache.invalidate(*["post:%d" % post_id for post_id in affected_post_ids])
     flash("评论删除成功", "success")
     return redirect_back()
 
@@ -158,7 +261,10 @@ def new_category():
         name = form.name.data
         category = Category(name=name)
         db.session.add(category)
+        Admin.mark_site_modified()
         db.session.commit()
+        context_cache.invalidate("categories")
+        response_cache.clear()
         flash("创建分类成功", "success")
         return redirect(url_for("admin.manage_category"))
     return render_template("admin/new_category.html", form=form)
@@ -173,11 +279,14 @@ def edit_category(category_id):
         return redirect(url_for("admin.manage_category"))
     if form.validate_on_submit():
         category.name = form.name.data
+        Admin.mark_site_modified()
         db.session.commit()
+        context_cache.invalidate("categories")
+        response_cache.clear()
         flash("分类修改成功", "success")
         return redirect(url_for("admin.manage_category"))
 
-    form.name.data = category.anme
+    form.name.data = category.name
     return render_template("admin/edit_category.html", form=form)
 
 
@@ -187,8 +296,29 @@ def delete_category(category_id):
     if category.id == 1:
         flash("你的级别不够哦，不能删除这个分类", "warning")
         return redirect(url_for("admin.manage_category"))
-    category.delete()  # 删除分类,调用的是Category Model里面的类方法
-    flash("删除成功", "success")
+    moved = category.delete()  # 删除分类,调用的是Category Model里面的类方法
+    context_cache.invalidate("categories")
+    response_cache.clear()
+    flash("删除成功，%d 篇文章移到了默认分类" % moved if moved else "删除成功", "success")
+    return redirect(url_for("admin.manage_category"))
+
+
+@admin_bp.route("/category/<int:category_id>/merge", methods=["POST"])
+def merge_category(category_id):
+    category = Category.query.get_or_404(category_id)
+    target = Category.query.get(request.form.get("target_id", type=int))
+    if category.id == 1:
+        flash("默认分类不能合并到其他分类", "warning")
+        return redirect(url_for("admin.manage_category"))
+    if target is None or target.id == category.id:
+        flash("请选择要合并到的分类", "warning")
+        return redirect(url_for("admin.manage_category"))
+    name, target_name = category.name, target.name
+    moved = category.merge_into(target)
+    db.session.commit()
+    context_cache.invalidate("categories")
+    response_cache.clear()
+    flash("已将分类 %s 合并到 %s，移动了 %d 篇文章" % (name, target_name, moved), "success")
     return redirect(url_for("admin.manage_category"))
 
 
@@ -206,7 +336,10 @@ def new_link():
         url = form.url.data
         link = Link(name=name, url=url)
         db.session.add(link)
+        Admin.mark_site_modified()
         db.session.commit()
+        context_cache.invalidate("links")
+        response_cache.clear()
         flash("连接创建成功", "success")
         return redirect(url_for("admin.manage_link"))
     return render_template("admin/new_link.html", form=form)
@@ -219,7 +352,10 @@ def edit_link(link_id):
     if form.validate_on_submit():
         link.name = form.name.data
         link.url = form.url.data
+        Admin.mark_site_modified()
         db.session.commit()
+        context_cache.invalidate("links")
+        response_cache.clear()
         flash("链接更新成功", "success")
         return redirect(url_for("admin.manage_link"))
     form.name.data = link.name
@@ -231,28 +367,38 @@ def edit_link(link_id):
 def delete_link(link_id):
     link = Link.query.get_or_404(link_id)
     db.session.delete(link)
+    Admin.mark_site_modified()
     db.session.commit()
+    context_cache.invalidate("links")
+    response_cache.clear()
     flash("删除成功", "success")
     return redirect(url_for("admin.manage_link"))
 
 
+# 查询统计
+@admin_bp.route("/queries")
+def queries():
+    sort = request.args.get("sort", "duration")
+    if sort not in ("duration", "queries"):
+        sort = "duration"
+    return render_template("admin/queries.html", sort=sort, endpoints=sql_recorder.ranked_endpoints(sort),
+                           slow_queries=sql_recorder.worst_queries(), n_plus_one=sql_recorder.n_plus_one_queries())
 
 
+@admin_bp.route("/queries/reset", methods=["POST"])
+def reset_queries():
+    sql_recorder.reset()
+    flash("查询统计已清空", "success")
+    return redirect(url_for("admin.queries"))
 
 
+@admin_bp.route("/pool")
+def pool():
+    """处理这个请求的 worker 的连接池统计，多个 worker 时每次请求可能落到不同的进程上，看 pid 区分"""
+    return jsonify(db.pool_metrics.to_dict())
 
 
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+@admin_bp.route("/throttle")
+def throttle():
+    """登录限流的计数：放行和被 IP、用户名限制的次数，内存存储时每个 worker 各有一份，看 pid 区分"""
+    return jsonify(login_throttle.to_dict())
@@ -1,6 +1,7 @@
 from flask import render_template, flash, redirect, url_for, Blueprint
 from flask_login import login_user, logout_user, login_required, current_user
 
+from myblog.extensions import login_throttle
 from myblog.forms import LoginForm
 from myblog.models import Admin
 from myblog.utils import redirect_back
@@ -20,9 +21,11 @@ def login():
         password = form.password.data
         remember = form.remember.data
 
+        login_throttle.check(username)  # 超过限制时直接返回 429，不计算密码哈希
         admin = Admin.query.first()
         if admin:
             if username == admin.username and admin.validate_password(password):
+                login_throttle.reset(username)
                 login_user(admin, remember)
                 flash("欢迎您，{}".format(username), "success")
                 return redirect_back()
@@ -1,45 +1,92 @@
 from flask import render_template, flash, redirect, url_for, request, current_app, Blueprint, abort, make_response
-from myblog.models import Post, Category, Comment
+from datetime import datetime
+from functools import partial
+from myblog.models import Admin, Post, Category, Comment
 from flask_login import current_user
+from flask_sqlalchemy import Pagination
 from myblog.forms import CommentForm, AdminCommentForm
 from myblog.emails import send_new_comment_mail, send_new_reply_email
-from myblog.extensions import db
-from myblog.utils import redirect_back
+from myblog.extensions import db, context_cache, response_cache
+from myblog.utils import redirect_back, conditional
+from myblog.pagination import paginate
+from myblog.search import search as search_posts, make_snippet
+from myblog.streaming import stream_template
 
 blog_bp = Blueprint("blog", __name__)
 
 
+def _site_modified():
+    return db.session.query(db.func.max(Admin.site_modified)).as_scalar()
+
+
+def _latest(*values):
+    values = [value for value in values if value is not None]
+    return max(values) if values else None
+
+
+def site_last_modified(**kwargs):
+    """关于页只依赖博客资料和侧边栏"""
+    return db.session.query(_site_modified()).scalar()
+
+
+def posts_last_modified(**kwargs):
+    """列表页：所有文章里最新的修改时间，last_modified 上有索引，只需要读索引的一端"""
+    return _latest(*db.session.query(db.func.max(Post.last_modified), _site_modified()).one())
+
+
+def listing_query(query):
+    """列表页只加载显示出来的列，正文换成了保存时生成的摘要"""
+    return query.options(db.load_only("id", "title", "excerpt", "timestamp", "category_id",
+                                      "reviewed_comment_count"))
+
+
+def post_last_modified(post_id):
+    """文章页：只查询 last_modified，不加载正文"""
+    row = db.session.query(Post.last_modified, _site_modified()).filter(Post.id == post_id).first()
+    return _latest(*row) if row is not None else None
+
+
 @blog_bp.route("/")
+@response_cache.cached
+@conditional(posts_last_modified)
 def index():
-    page = request.args.get("page", 1, type=int)
     page_num = current_app.config["MYBLOG_POST_PAGE_NUM"]  # 获取配置参数
-    pagination = Post.query.order_by(Post.timestamp.desc()).paginate(page, per_page=page_num)
-    posts = pagination.items  # flask-sqlalchemy内置的分页功能
+    pagination = paginate(listing_query(Post.query), Post, page_num)
+    posts = pagination.items  # flask-sqlalchemy内置的分页功能，或者游标分页
+    response_cache.tag(*["post:%d" % post.id for post in posts])
     return render_template("blog/index.html", posts=posts, pagination=pagination)
 
 
 @blog_bp.route("/about")
+@response_cache.cached
+@conditional(site_last_modified)
 def about():
     return render_template("blog/about.html")
 
 
 @blog_bp.route("/category/<int:category_id>")
+@response_cache.cached
+@conditional(posts_last_modified)
 def show_category(category_id):
     category = Category.query.get_or_404(category_id)
-    page = request.args.get("page", 1, type=int)
     page_num = current_app.config["MYBLOG_POST_PAGE_NUM"]
-    pagination = Post.query.with_parent(category).order_by(Post.timestamp.desc()).paginate(page, page_num)
+    pagination = paginate(listing_query(Post.query.with_parent(category)), Post, page_num)
     posts = pagination.items
+    response_cache.tag("category:%d" % category.id, *["post:%d" % post.id for post in posts])
     return render_template("blog/category.html", category=category, pagination=pagination, posts=posts)
 
 
 @blog_bp.route("/post/<int:post_id>", methods=["GET", "POST"])
+@response_cache.cached
+@conditional(post_last_modified, csrf=True)
 def show_post(post_id):
     post = Post.query.get_or_404(post_id)   # 若果查询文章不存在，就返回404错误
-    page = request.args.get("page", 1, type=int)
     page_num = current_app.config["MYBLOG_POST_PAGE_NUM"]
-    pagination = Comment.query.with_parent(post).filter_by(reviewed=True).order_by(Comment.timestamp.desc()).paginate(page, page_num)
-    comments = pagination.items
+    # 分页的是顶层评论，回复按讨论串一次加载出来，显示成树形。
+    # 讨论串在模板里渲染到评论区时才加载，流式渲染时正文已经先发出去了
+    pagination = paginate(Comment.query.with_parent(post).filter_by(reviewed=True, depth=0), Comment, page_num)
+    load_comments = partial(Comment.load_threads, pagination.items)
+    response_cache.tag("post:%d" % post.id)
 
     if current_user.is_authenticated:
         form = AdminCommentForm()
@@ -66,7 +113,15 @@ def show_post(post_id):
             comment.replied = replied_comment
             send_new_reply_email(replied_comment)  # 邮件通知评论人，该评论有人回复了
         db.session.add(comment)
+        db.session.flush()  # 拿到id以后才能生成路径
+        comment.set_path()
+        post.increase_comment_count(reviewed=reviewed)
+        if reviewed:
+            post.last_modified = datetime.utcnow()
         db.session.commit()  #
+        context_cache.invalidate("unread_comments")
+        if reviewed:  # 待审核的评论不会显示出来，不用清掉页面缓存
+            response_cache.invalidate("post:%d" % post.id)
 
         if current_user.is_authenticated:
             flash("恭喜您，评论成功.🤗", "success")  # 如果当前用户为管理员，则直接发表成功
@@ -75,7 +130,32 @@ def show_post(post_id):
             send_new_comment_mail(post)  # 邮件通知文章作者，有新的评论
 
         return redirect(url_for("blog.show_post", post_id=post_id))
-    return render_template("blog/post.html", post=post, pagination=pagination, comments=comments, form=form)
+
+    # 会写进页面缓存的请求不用流式渲染，缓存命中比流式输出更快
+    if current_app.config["MYBLOG_STREAM_POST"] and not response_cache.should_cache():
+        return stream_template("blog/post.html", post=post, pagination=pagination, load_comments=load_comments,
+                               form=form)
+    return render_template("blog/post.html", post=post, pagination=pagination, load_comments=load_comments,
+                           form=form)
+
+
+@blog_bp.route("/search")
+def search():
+    q = request.args.get("q", "").strip()
+    if not q:
+        flash("请输入要搜索的关键词哦🤔", "warning")
+        return redirect(url_for("blog.index"))
+
+    page = max(request.args.get("page", 1, type=int), 1)
+    page_num = current_app.config["MYBLOG_SEARCH_RESULT_PAGE_NUM"]
+    # 倒排索引里查出排好序的文章id，只加载当前页的文章
+    post_ids = search_posts(q, current_app.config["MYBLOG_SEARCH_MAX_RESULTS"])
+    page_ids = post_ids[(page - 1) * page_num:page * page_num]
+    posts = sorted(Post.query.filter(Post.id.in_(page_ids)).all(), key=lambda post: page_ids.index(post.id)) \
+        if page_ids else []
+    pagination = Pagination(None, page, page_num, len(post_ids), posts)
+    snippets = dict((post.id, make_snippet(post, q)) for post in posts)
+    return render_template("blog/search.html", q=q, posts=posts, pagination=pagination, snippets=snippets)
 
 
 @blog_bp.route("/reply/comment/<int:comment_id>")
@@ -0,0 +1,294 @@
+import os
+import time
+import pickle
+import hashlib
+import tempfile
+from functools import wraps
+from collections import OrderedDict
+from threading import Lock
+
+from flask import request, session, g, current_app
+from flask_login import current_user
+
+
+class TemplateContextCache(object):
+    """
+    进程内的模板上下文缓存。
+
+    每次失效都会让版本号加一，缓存项记录自己写入时的版本号，版本号对不上就重新加载，
+    这样侧边栏需要的管理员、分类、链接只在数据变动后查询一次。
+    多进程部署时每个 worker 各有一份缓存，MYBLOG_CONTEXT_CACHE_TIMEOUT 用来限制其他 worker 的最长过期时间。
+    """
+
+    def __init__(self, app=None):
+        self.version = 0
+        self.timeout = None
+        self._items = {}
+        self._lock = Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("MYBLOG_CONTEXT_CACHE_TIMEOUT", 300)
+        self.timeout = app.config["MYBLOG_CONTEXT_CACHE_TIMEOUT"]
+
+    def get(self, key, loader):
+        """
+        取出缓存项，缓存不存在、版本过期或者超时的时候调用 loader 重新加载
+        :param key: 缓存键
+        :param loader: 无参函数，返回需要缓存的值
+        :return:
+        """
+        item = self._items.get(key)
+        now = time.time()
+        if item is not None:
+            version, expires, value = item
+            if version == self.version and (expires is None or expires > now):
+                return value
+
+        version = self.version
+        value = loader()
+        expires = now + self.timeout if self.timeout else None
+        with self._lock:
+            if version == self.version:  # 加载期间被失效的话就不写入了
+                self._items[key] = (version, expires, value)
+        return value
+
+    def invalidate(self, *keys):
+        """
+        不传 key 时清空全部缓存，版本号加一
+        """
+        with self._lock:
+            if keys:
+                for key in keys:
+                    self._items.pop(key, None)
+            else:
+                self.version += 1
+                self._items.clear()
+
+
+class MemoryBackend(object):
+    """
+    进程内的LRU缓存，按缓存内容的总字节数限制大小，超出时淘汰最久没有访问的项
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self._entries = OrderedDict()  # key -> (expires, tags, value, size)
+        self._tags = {}  # tag -> set(key)
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                self._delete(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry[2]
+
+    def set(self, key, value, tags, timeout):
+        size = len(value[2])
+        if size > self.max_size:
+            return
+        with self._lock:
+            self._delete(key)
+            self._entries[key] = (time.time() + timeout, tags, value, size)
+            self.size += size
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while self.size > self.max_size:
+                self._delete(next(iter(self._entries)))
+
+    def delete_tag(self, tag):
+        with self._lock:
+            for key in list(self._tags.get(tag, ())):
+                self._delete(key)
+            self._tags.pop(tag, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tags.clear()
+            self.size = 0
+
+    def _delete(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self.size -= entry[3]
+        for tag in entry[1]:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+
+class FileSystemBackend(object):
+    """
+    文件缓存，多个 worker 进程可以共用同一个目录。
+    每个缓存项一个文件，标签用 tags/<tag>/ 目录下的空文件记录包含的缓存项，按标签删除时不需要扫描整个目录。
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.tag_directory = os.path.join(directory, "tags")
+        os.makedirs(self.tag_directory, exist_ok=True)
+
+    def _filename(self, key):
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    def _tag_path(self, tag):
+        return os.path.join(self.tag_directory, tag.replace(os.sep, "_").replace(":", "-"))
+
+    def get(self, key):
+        path = os.path.join(self.directory, self._filename(key))
+        try:
+            with open(path, "rb") as f:
+                expires, value = pickle.load(f)
+        except (OSError, EOFError, pickle.PickleError):
+            return None
+        if expires < time.time():
+            self._remove(path)
+            return None
+        return value
+
+    def set(self, key, value, tags, timeout):
+        filename = self._filename(key)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump((time.time() + timeout, value), f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, os.path.join(self.directory, filename))  # 原子替换，其他进程不会读到写了一半的文件
+        for tag in tags:
+            tag_path = self._tag_path(tag)
+            os.makedirs(tag_path, exist_ok=True)
+            open(os.path.join(tag_path, filename), "w").close()
+
+    def delete_tag(self, tag):
+        tag_path = self._tag_path(tag)
+        try:
+            filenames = os.listdir(tag_path)
+        except OSError:
+            return
+        for filename in filenames:
+            self._remove(os.path.join(self.directory, filename))
+            self._remove(os.path.join(tag_path, filename))
+
+    def clear(self):
+        for root, dirs, files in os.walk(self.directory):
+            for filename in files:
+                self._remove(os.path.join(root, filename))
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class ResponseCache(object):
+    """
+    匿名用户 GET 请求的整页缓存，缓存键由路径、查询参数和 theme cookie 组成。
+
+    视图函数通过 tag() 给当前页面打上标签（比如 post:1），后台修改数据时调用 invalidate() 按标签删除，
+    只影响包含这些数据的页面；侧边栏、博客标题这类每页都有的数据变化时调用 clear()。
+    页面里的 CSRF 令牌在写入缓存时换成占位符，命中时再换成当前会话的令牌。
+    """
+
+    csrf_placeholder = "__MYBLOG_CSRF_TOKEN__"
+
+    def __init__(self, app=None):
+        self.backend = None
+        self.timeout = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("MYBLOG_RESPONSE_CACHE_TYPE", None)
+        app.config.setdefault("MYBLOG_RESPONSE_CACHE_TIMEOUT", 300)
+        app.config.setdefault("MYBLOG_RESPONSE_CACHE_MAX_SIZE", 32 * 1024 * 1024)
+        app.config.setdefault("MYBLOG_RESPONSE_CACHE_DIR", None)
+
+        cache_type = app.config["MYBLOG_RESPONSE_CACHE_TYPE"]
+        self.timeout = app.config["MYBLOG_RESPONSE_CACHE_TIMEOUT"]
+        if cache_type == "memory":
+            self.backend = MemoryBackend(app.config["MYBLOG_RESPONSE_CACHE_MAX_SIZE"])
+        elif cache_type == "filesystem":
+            directory = app.config["MYBLOG_RESPONSE_CACHE_DIR"] or os.path.join(app.instance_path, "response_cache")
+            self.backend = FileSystemBackend(directory)
+        elif cache_type is not None:
+            raise ValueError("Unknown MYBLOG_RESPONSE_CACHE_TYPE: %r" % cache_type)
+        else:
+            self.backend = None
+
+    @staticmethod
+    def make_key():
+        args = sorted(request.args.items(multi=True))
+        query = "&".join("%s=%s" % (key, value) for key, value in args)
+        return "%s?%s|%s" % (request.path, query, request.cookies.get("theme", ""))
+
+    def should_cache(self):
+        """
+        只缓存匿名用户的 GET 请求，有待显示的 flash 消息时也不缓存
+        """
+        return (self.backend is not None and request.method == "GET"
+                and "_flashes" not in session and not current_user.is_authenticated)
+
+    def tag(self, *tags):
+        if self.backend is not None:
+            g.setdefault("response_cache_tags", set()).update(tags)
+
+    def invalidate(self, *tags):
+        if self.backend is not None:
+            for tag in tags:
+                self.backend.delete_tag(tag)
+
+    def clear(self):
+        if self.backend is not None:
+            self.backend.clear()
+
+    def cached(self, view):
+        @wraps(view)
+        def decorated_view(*args, **kwargs):
+            if not self.should_cache():
+                return view(*args, **kwargs)
+
+            key = self.make_key()
+            cached = self.backend.get(key)
+            if cached is not None:
+                return self._restore(cached)
+
+            response = current_app.make_response(view(*args, **kwargs))
+            if response.status_code == 200 and not response.is_streamed:
+                self.backend.set(key, self._dump(response), g.get("response_cache_tags", set()), self.timeout)
+            response.headers["X-Cache"] = "MISS"
+            response.vary.add("Cookie")
+            return response
+
+        return decorated_view
+
+    def _dump(self, response):
+        body = response.get_data()
+        token = g.get(current_app.config.get("WTF_CSRF_FIELD_NAME", "csrf_token"))
+        if token:
+            body = body.replace(token.encode("utf-8"), self.csrf_placeholder.encode("utf-8"))
+        headers = [(name, value) for name, value in response.headers
+                   if name.lower() not in ("set-cookie", "content-length", "x-cache")]
+        return response.status_code, headers, body
+
+    def _restore(self, cached):
+        from flask_wtf.csrf import generate_csrf
+
+        status, headers, body = cached
+        placeholder = self.csrf_placeholder.encode("utf-8")
+        if placeholder in body:
+            body = body.replace(placeholder, generate_csrf().encode("utf-8"))
+        response = current_app.response_class(body, status=status, headers=headers)
+        response.headers["X-Cache"] = "HIT"
+        response.vary.add("Cookie")
+        return response.make_conditional(request)
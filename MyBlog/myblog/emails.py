@@ -1,36 +1,18 @@
 from flask import url_for, current_app
 from flask_mail import Message
-from myblog.extensions import mail
-from threading import Thread
-
-
-def _send_async_mail(app, message):
-    """
-    使用app_context方法创建一个应用上下文，因为mail.send内部调用了current_app变量，
-    这个变量只有在激活的程序上下文中才存在。这里在后台线程调用的send函数，但是后台线程没有程序上下文，
-    这里用app.context手动激活上下文
-
-    :param app:
-    :param message:
-    :return:
-    """
-    with app.app_context():
-        mail.send(message)
+from myblog.extensions import mail_dispatcher
 
 
 def send_mail(subject, to, html):
     """
-    构建发送mail的函数
+    构建发送mail的函数，邮件放进发信队列，由固定数量的后台线程批量发送，见 myblog.mailqueue
     :param subject: 主题
     :param to: 接收方
     :param html: 发送的HTML内容
-    :return:
+    :return: 队列已满、邮件被丢弃时返回 False
     """
-    app = current_app._get_current_object()  # 通过这样可以获得程序实例
     message = Message(subject, recipients=[to], html=html)
-    thr = Thread(target=_send_async_mail, args=[app, message])
-    thr.start()
-    return thr
+    return mail_dispatcher.send(message)
 
 
 def send_new_comment_mail(post):
@@ -0,0 +1,94 @@
+from sqlalchemy import text
+
+from myblog.extensions import db
+from myblog.models import Post, Comment
+
+
+def hot_queries(per_page=5):
+    """
+    blog、admin 蓝本里的热点查询，和视图里的写法保持一致，参数取数据库里真实存在的文章和分类
+    :return: (名称, 查询) 列表
+    """
+    post = Post.query.order_by(Post.reviewed_comment_count.desc()).first()
+    post_id = post.id if post is not None else 1
+    category_id = post.category_id if post is not None and post.category_id is not None else 1
+    comment = Comment.query.filter(Comment.post_id == post_id, Comment.depth == 0).first()
+    comment_id, path = (comment.id, comment.path or "") if comment is not None else (1, "")
+    newest = (Post.timestamp.desc(), Post.id.desc())
+    newest_comments = (Comment.timestamp.desc(), Comment.id.desc())
+
+    return [
+        ("blog.index", Post.query.order_by(*newest).limit(per_page)),
+        ("blog.show_category", Post.query.filter(Post.category_id == category_id).order_by(*newest).limit(per_page)),
+        ("blog.show_post comments", Comment.query.filter(Comment.post_id == post_id, Comment.reviewed == True,
+                                                         Comment.depth == 0).order_by(*newest_comments).limit(per_page)),
+        ("blog.show_post threads", Comment.query.filter(Comment.post_id == post_id, Comment.depth > 0,
+                                                        Comment.path > path, Comment.path < path + "~",
+                                                        Comment.reviewed == True).order_by(Comment.path)),
+        ("blog last_modified", db.session.query(db.func.max(Post.last_modified))),
+        ("admin.manage_comment all", Comment.query.order_by(*newest_comments).limit(per_page)),
+        ("admin.manage_comment unread", Comment.query.filter(Comment.reviewed == False)
+         .order_by(*newest_comments).limit(per_page)),
+        ("admin.manage_comment admin", Comment.query.filter(Comment.from_admin == True)
+         .order_by(*newest_comments).limit(per_page)),
+        ("unread comment count", db.session.query(db.func.count(Comment.id)).filter(Comment.reviewed == False)),
+        ("comment replies", Comment.query.filter(Comment.replied_id == comment_id)),
+    ]
+
+
+def explain_sqlite(connection, sql):
+    rows = connection.execute(text("EXPLAIN QUERY PLAN " + sql)).fetchall()
+    plan = [row[-1] for row in rows]
+    problems = []
+    for detail in plan:
+        # "SCAN post" 是全表扫描；"SCAN post USING INDEX ..." 是按索引顺序读，配合 LIMIT 只读一页
+        if detail.startswith("SCAN ") and " USING " not in detail:
+            problems.append("full scan")
+        if "USE TEMP B-TREE" in detail:
+            problems.append("filesort")
+    return plan, problems
+
+
+def explain_mysql(connection, sql):
+    result = connection.execute(text("EXPLAIN " + sql))
+    # Result.mappings() 是 SQLAlchemy 1.4 才有的，按列名自己拼成字典，1.3 的 RowProxy 也能用
+    keys = list(result.keys())
+    rows = [dict(zip(keys, row)) for row in result.fetchall()]
+    plan = ["table=%s type=%s key=%s rows=%s extra=%s" % (row["table"], row["type"], row["key"], row["rows"],
+                                                           row["Extra"]) for row in rows]
+    problems = []
+    for row in rows:
+        if row["type"] == "ALL":
+            problems.append("full scan")
+        if "Using filesort" in (row["Extra"] or ""):
+            problems.append("filesort")
+    return plan, problems
+
+
+def explain_postgresql(connection, sql):
+    plan = [row[0] for row in connection.execute(text("EXPLAIN " + sql))]
+    problems = []
+    for line in plan:
+        if "Seq Scan" in line:
+            problems.append("full scan")
+        if line.lstrip(" ->").startswith("Sort"):
+            problems.append("filesort")
+    return plan, problems
+
+
+EXPLAINERS = dict(sqlite=explain_sqlite, mysql=explain_mysql, postgresql=explain_postgresql)
+
+
+def explain(engine, query):
+    """
+    对一条查询执行 EXPLAIN，参数直接渲染进语句
+    :return: (SQL, 执行计划的每一行, 发现的问题：full scan / filesort)
+    """
+    statement = query.statement if hasattr(query, "statement") else query
+    sql = str(statement.compile(dialect=engine.dialect, compile_kwargs={"literal_binds": True}))
+    explainer = EXPLAINERS.get(engine.dialect.name)
+    if explainer is None:
+        raise ValueError("EXPLAIN is not supported for %s" % engine.dialect.name)
+    with engine.connect() as connection:
+        plan, problems = explainer(connection, sql)
+    return sql, plan, sorted(set(problems))
@@ -1,26 +1,83 @@
+import time
+
+from flask import current_app
 from flask_bootstrap import Bootstrap
-from flask_sqlalchemy import SQLAlchemy
 from flask_mail import Mail
 from flask_ckeditor import CKEditor
 from flask_moment import Moment
 from flask_login import LoginManager
 from flask_wtf.csrf import CSRFProtect
 
+from myblog.caching import TemplateContextCache, ResponseCache
+from myblog.mailqueue import MailDispatcher
+from myblog.sqlrecorder import SQLRecorder
+from myblog.assets import Assets
+from myblog.routing import RoutingSQLAlchemy
+from myblog.throttle import LoginThrottle
+
 
 bootstrap = Bootstrap()
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
 mail = Mail()
 ckeditor = CKEditor()
 moment = Moment()
 login_manager = LoginManager()
 csrf = CSRFProtect()
+context_cache = TemplateContextCache()
+response_cache = ResponseCache()
+mail_dispatcher = MailDispatcher()
+sql_recorder = SQLRecorder()
+assets = Assets()
+login_throttle = LoginThrottle()
+
+
+
+def identity_key(admin_id):
+    return "identity:%s" % admin_id
+
+
+def _load_identity(admin_id):
+    from myblog.models import Admin
+
+    # 用单独的 session 加载，缓存的对象不会在当前请求提交时被过期，也不会换掉当前 session 里已有的对象
+    loader_session = db.create_scoped_session()
+    try:
+        admin = loader_session.query(Admin).get(admin_id)
+    finally:
+        loader_session.remove()
+    return dict(admin=admin, checked=time.time())
 
 
 @login_manager.user_loader
 def load_user(user_id):
+    """
+    已登录的请求从进程内的身份缓存里取管理员，用 merge(load=False) 挂到当前 session 上。
+    user_id 是 Admin.get_id() 返回的 “id:session_version”。缓存的账户每 MYBLOG_IDENTITY_CHECK_INTERVAL 秒
+    只查询 session_version 和 site_modified 两列和数据库核对一次，别的 worker 或者命令行改过账户时重新加载；
+    会话里的 session_version 和数据库里的对不上（flask init 改过用户名密码）时返回 None，这个会话需要重新登录
+    """
     from myblog.models import Admin
-    user = Admin.query.get(int(user_id))
-    return user
+
+    admin_id, _, version = user_id.partition(":")
+    if not admin_id.isdigit() or not (version or "0").isdigit():
+        return None
+    admin_id, version = int(admin_id), int(version or 0)  # 加上版本号以前的会话里只有 id，当作版本 0
+
+    key = identity_key(admin_id)
+    entry = context_cache.get(key, lambda: _load_identity(admin_id))
+    admin = entry["admin"]
+    now = time.time()
+    if admin is not None and (admin.session_version != version or
+                              now - entry["checked"] >= current_app.config["MYBLOG_IDENTITY_CHECK_INTERVAL"]):
+        row = db.session.query(Admin.session_version, Admin.site_modified).filter(Admin.id == admin_id).first()
+        if row is None or tuple(row) != (admin.session_version, admin.site_modified):
+            context_cache.invalidate(key, "admin")  # 侧边栏用的管理员也是旧的
+            entry = context_cache.get(key, lambda: _load_identity(admin_id))
+            admin = entry["admin"]
+        entry["checked"] = now
+    if admin is None or admin.session_version != version:
+        return None
+    return db.session.merge(admin, load=False)
 
 
 login_manager.login_view = 'auth.login'
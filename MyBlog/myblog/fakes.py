@@ -1,6 +1,10 @@
+import time
 import random
+from array import array
+from multiprocessing import Pool
+
+import click
 from faker import Faker
-from sqlalchemy.exc import IntegrityError
 
 from myblog import db
 from myblog.models import Admin, Comment, Post, Category, Link
@@ -8,6 +12,74 @@ from myblog.models import Admin, Comment, Post, Category, Link
 fake = Faker("zh-CN")
 
 
+class Progress(object):
+    """
+    打印生成进度和每秒插入的行数
+    """
+
+    def __init__(self, name, total):
+        self.name = name
+        self.total = total
+        self.done = 0
+        self.start = time.time()
+
+    def update(self, amount):
+        self.done += amount
+        elapsed = time.time() - self.start
+        click.echo("  %s: %d/%d (%.0f rows/s)" % (self.name, self.done, self.total, self.done / elapsed if elapsed else 0))
+
+
+def _batches(total, batch_size):
+    """把 total 拆成若干个不超过 batch_size 的数"""
+    while total > 0:
+        size = min(batch_size, total)
+        yield size
+        total -= size
+
+
+def _generate_posts(args):
+    """在子进程里生成文章内容，只生成文字，外键由主进程从id池里分配"""
+    count, seed = args
+    fake.seed_instance(seed)
+    rows = []
+    for i in range(count):
+        timestamp = fake.date_time_this_year()
+        body = fake.text(500)
+        excerpt, word_count = Post.make_excerpt(body)
+        rows.append(dict(title=fake.sentence(), body=body, timestamp=timestamp, last_modified=timestamp,
+                         can_comment=True, excerpt=excerpt, word_count=word_count))
+    return rows
+
+
+def _generate_comments(args):
+    count, seed = args
+    fake.seed_instance(seed)
+    return [dict(author=fake.name(), email=fake.email(), site=fake.url(), body=fake.sentence(),
+                 timestamp=fake.date_time_this_year()) for i in range(count)]
+
+
+def _generate(generator, count, batch_size, processes):
+    """
+    按批生成数据，processes 大于1时用多进程生成，Faker生成文字是最慢的部分
+    """
+    seed = random.randint(0, 2 ** 30)
+    tasks = [(size, seed + i) for i, size in enumerate(_batches(count, batch_size))]
+    if processes > 1:
+        with Pool(processes) as pool:
+            for rows in pool.imap(generator, tasks):
+                yield rows
+    else:
+        for task in tasks:
+            yield generator(task)
+
+
+def _insert(model, rows):
+    """一条 executemany 插入一批数据，不经过 ORM 的单位工作"""
+    if rows:
+        db.session.execute(model.__table__.insert(), rows)
+        db.session.commit()
+
+
 def fake_admin():
     admin = Admin(
         username="yl",
@@ -22,83 +94,68 @@ def fake_admin():
 
 
 def fake_categories(count=5):
-    category = Category(name="default")
-    db.session.add(category)
-
-    for i in range(count):
-        category = Category(name=fake.word())
-        db.session.add(category)
-        try:
-            db.session.commit()
-        except IntegrityError:
-            db.session.rollback()
-
-
-def fake_posts(count=10):
-    for i in range(count):
-        post = Post(
-            title=fake.sentence(),
-            body=fake.text(500),
-            category=Category.query.get(random.randint(1, Category.query.count())),
-            timestamp=fake.date_time_this_year()
-        )
-        db.session.add(post)
+    names = ["default"]
+    for i in range(count * 10):  # 分类名要唯一，重复的直接跳过
+        if len(names) > count:
+            break
+        name = fake.word()
+        if name not in names:
+            names.append(name)
+    _insert(Category, [dict(name=name) for name in names])
+
+
+def fake_posts(count=10, batch_size=1000, processes=1):
+    category_ids = [category_id for category_id, in db.session.query(Category.id)]  # 分类id池，不用每行都查询
+    if not category_ids:
+        return
+    progress = Progress("posts", count)
+    for rows in _generate(_generate_posts, count, batch_size, processes):
+        for row in rows:
+            row["category_id"] = random.choice(category_ids)
+        _insert(Post, rows)
+        progress.update(len(rows))
+    Category.update_post_counts()
     db.session.commit()
 
 
-def fake_comments(count=100):
-    for i in range(count):
-        comment = Comment(
-            author=fake.name(),
-            email=fake.email(),
-            site=fake.url(),
-            body=fake.sentence(),
-            timestamp=fake.date_time_this_year(),
-            reviewed=True,
-            post=Post.query.get(random.randint(1, Post.query.count()))
-        )
-        db.session.add(comment)
-
+def fake_comments(count=100, batch_size=1000, processes=1):
+    post_ids = array("i", (post_id for post_id, in db.session.query(Post.id)))
+    if not post_ids:
+        return
     salt = int(count * 0.1)
-    for i in range(salt):
-        # 没有审查的评论
-        comment = Comment(
-            author=fake.name(),
-            email=fake.email(),
-            site=fake.url(),
-            body=fake.sentence(),
-            timestamp=fake.date_time_this_year(),
-            reviewed=False,
-            post=Post.query.get(random.randint(1, Post.query.count()))
-        )
-        db.session.add(comment)
-
-        # 来自管理员的评论
-        comment = Comment(
-            author="杨磊",
-            email="example@qq.com",
-            site="example.com",
-            body=fake.sentence(),
-            timestamp=fake.date_time_this_year(),
-            reviewed=True,
-            post=Post.query.get(random.randint(1, Post.query.count()))
-        )
-        db.session.add(comment)
-    db.session.commit()
-
-    # 回复
-    for i in range(salt):
-        comment = Comment(
-            author=fake.name(),
-            email=fake.email(),
-            site=fake.url(),
-            body=fake.sentence(),
-            timestamp=fake.date_time_this_year(),
-            reviewed=True,
-            replied=Comment.query.get(random.randint(1, Comment.query.count())),
-            post=Post.query.get(random.randint(1, Post.query.count()))
-        )
-        db.session.add(comment)
+    progress = Progress("comments", count + salt * 3)
+
+    # 已经审查的评论，没有审查的评论
+    for reviewed, total in (True, count), (False, salt):
+        for rows in _generate(_generate_comments, total, batch_size, processes):
+            for row in rows:
+                row.update(reviewed=reviewed, from_admin=False, post_id=random.choice(post_ids))
+            _insert(Comment, rows)
+            progress.update(len(rows))
+
+    # 来自管理员的评论
+    for rows in _generate(_generate_comments, salt, batch_size, processes):
+        for row in rows:
+            row.update(author="杨磊", email="example@qq.com", site="example.com", reviewed=True, from_admin=True,
+                       post_id=random.choice(post_ids))
+        _insert(Comment, rows)
+        progress.update(len(rows))
+
+    # 回复，回复和被回复的评论在同一篇文章下面
+    comment_ids, comment_post_ids = array("i"), array("i")
+    for comment_id, post_id in db.session.query(Comment.id, Comment.post_id).yield_per(10000):
+        comment_ids.append(comment_id)
+        comment_post_ids.append(post_id)
+    for rows in _generate(_generate_comments, salt, batch_size, processes):
+        for row in rows:
+            index = random.randrange(len(comment_ids))
+            row.update(reviewed=True, from_admin=False, replied_id=comment_ids[index],
+                       post_id=comment_post_ids[index])
+        _insert(Comment, rows)
+        progress.update(len(rows))
+
+    Comment.update_paths(batch_size)
+    Post.update_comment_counts()
     db.session.commit()
 
 
@@ -109,41 +166,3 @@ def fake_links():
     google = Link(name='Google+', url='#')
     db.session.add_all([twitter, facebook, linkedin, google])
     db.session.commit()
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
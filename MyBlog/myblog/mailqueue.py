@@ -0,0 +1,178 @@
+import os
+import time
+import uuid
+import atexit
+from queue import Queue, Full, Empty
+from threading import Thread, Lock
+
+
+class SMTPBackend(object):
+    """
+    一批邮件共用一个SMTP连接，只需要握手、登录一次
+    """
+
+    def __init__(self, mail):
+        self.mail = mail
+
+    def send_batch(self, messages):
+        """
+        发送成功的邮件会从 messages 里移除，中途出错重试时只会重发剩下的
+        """
+        with self.mail.connect() as connection:
+            while messages:
+                connection.send(messages[0])
+                messages.pop(0)
+
+
+class SpoolBackend(object):
+    """
+    把邮件写成 .eml 文件放到目录里，本地开发和测试时不需要SMTP服务器
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def send_batch(self, messages):
+        while messages:
+            filename = "%s-%s.eml" % (time.strftime("%Y%m%d%H%M%S"), uuid.uuid4().hex)
+            tmp = os.path.join(self.directory, "." + filename)
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(messages[0].as_string())
+            os.replace(tmp, os.path.join(self.directory, filename))
+            messages.pop(0)
+
+
+class MailDispatcher(object):
+    """
+    发信线程池：固定数量的线程从有界队列里取邮件，每次尽量多取几封一起发送，失败后按指数退避重试。
+
+    队列满了的时候 send 最多阻塞 MYBLOG_MAIL_ENQUEUE_TIMEOUT 秒，还是放不进去就丢弃这封邮件，
+    不会因为评论太多而无限制地创建线程和SMTP连接。
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.backend = None
+        self.queue = None
+        self.workers = []
+        self.stats = dict(queued=0, sent=0, failed=0, dropped=0, retried=0)
+        self._lock = Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("MYBLOG_MAIL_BACKEND", "smtp")
+        app.config.setdefault("MYBLOG_MAIL_SPOOL_DIR", os.path.join(app.instance_path, "mail_spool"))
+        app.config.setdefault("MYBLOG_MAIL_WORKERS", 2)
+        app.config.setdefault("MYBLOG_MAIL_QUEUE_SIZE", 100)
+        app.config.setdefault("MYBLOG_MAIL_BATCH_SIZE", 20)
+        app.config.setdefault("MYBLOG_MAIL_RETRIES", 3)
+        app.config.setdefault("MYBLOG_MAIL_RETRY_DELAY", 1)
+        app.config.setdefault("MYBLOG_MAIL_ENQUEUE_TIMEOUT", 1)
+
+        self.app = app
+        if app.config["MYBLOG_MAIL_BACKEND"] == "spool":
+            self.backend = SpoolBackend(app.config["MYBLOG_MAIL_SPOOL_DIR"])
+        else:
+            self.backend = SMTPBackend(app.extensions["mail"])
+        self.queue = Queue(maxsize=app.config["MYBLOG_MAIL_QUEUE_SIZE"])
+        app.extensions["mail_dispatcher"] = self
+
+    def send(self, message):
+        """
+        把邮件放进发送队列
+        :return: 队列已满、邮件被丢弃时返回 False
+        """
+        self._start_workers()
+        try:
+            self.queue.put(message, timeout=self.app.config["MYBLOG_MAIL_ENQUEUE_TIMEOUT"])
+        except Full:
+            self._count("dropped")
+            self.app.logger.warning("Mail queue is full, dropped mail to %s", ", ".join(message.recipients))
+            return False
+        self._count("queued")
+        return True
+
+    def shutdown(self, timeout=5):
+        """
+        等队列里的邮件发送完，然后停止发信线程，进程退出时自动调用
+        """
+        workers, self.workers = self.workers, []
+        for _ in workers:
+            try:
+                self.queue.put(None, timeout=timeout)
+            except Full:
+                break
+        for worker in workers:
+            worker.join(timeout)
+
+    def _start_workers(self):
+        if self.workers:
+            return
+        with self._lock:
+            if self.workers:
+                return
+            for i in range(self.app.config["MYBLOG_MAIL_WORKERS"]):
+                worker = Thread(target=self._work, name="mail-worker-%d" % i, daemon=True)
+                worker.start()
+                self.workers.append(worker)
+            atexit.register(self.shutdown)
+
+    def _work(self):
+        batch_size = self.app.config["MYBLOG_MAIL_BATCH_SIZE"]
+        while True:
+            message = self.queue.get()
+            if message is None:
+                return
+            batch = [message]
+            stop = False
+            while len(batch) < batch_size:
+                try:
+                    message = self.queue.get_nowait()
+                except Empty:
+                    break
+                if message is None:
+                    stop = True
+                    break
+                batch.append(message)
+
+            self._deliver(batch)
+            if stop:
+                return
+
+    def _deliver(self, batch):
+        """
+        发送一批邮件，出错时从出错的那一封开始重试，每次重试前按指数退避等待。
+        同一封邮件重试 MYBLOG_MAIL_RETRIES 次还是失败就跳过它，接着发后面的，一个错误的收件人不会连累同一批的其他邮件
+        """
+        retries = self.app.config["MYBLOG_MAIL_RETRIES"]
+        delay = self.app.config["MYBLOG_MAIL_RETRY_DELAY"]
+        attempt = 0
+        # flask-mail 构建邮件内容时需要程序上下文
+        with self.app.app_context():
+            while batch:
+                pending = len(batch)
+                error = None
+                try:
+                    self.backend.send_batch(batch)
+                except Exception as e:
+                    error = e
+                self._count("sent", pending - len(batch))
+                if not batch:
+                    break
+                if len(batch) < pending:
+                    attempt = 0  # 前面的已经发出去了，这次出错的是新的一封
+                if attempt < retries:
+                    self._count("retried")
+                    time.sleep(delay * 2 ** attempt)
+                    attempt += 1
+                    continue
+                message = batch.pop(0)
+                attempt = 0
+                self._count("failed")
+                self.app.logger.error("Failed to send mail to %s", ", ".join(message.recipients), exc_info=error)
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self.stats[name] += amount
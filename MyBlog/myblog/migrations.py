@@ -0,0 +1,38 @@
+from sqlalchemy import inspect, text
+from sqlalchemy.schema import CreateColumn
+
+from myblog.extensions import db
+
+
+def upgrade_schema():
+    """
+    给已有的数据库补上模型里新增的表、列和索引，只增不删，已有的数据不会动。
+    新增的列必须能为空或者带有 server_default，否则老数据没法补列。
+    :return: 执行过的变更说明列表
+    """
+    engine = db.engine
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    changes = []
+
+    for table in db.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            table.create(bind=engine)
+            changes.append("create table %s" % table.name)
+            continue
+
+        existing_columns = set(column["name"] for column in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name in existing_columns:
+                continue
+            ddl = "ALTER TABLE %s ADD COLUMN %s" % (table.name, CreateColumn(column).compile(dialect=engine.dialect))
+            with engine.begin() as conn:
+                conn.execute(text(ddl))
+            changes.append("add column %s.%s" % (table.name, column.name))
+
+        existing_indexes = set(index["name"] for index in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing_indexes:
+                index.create(bind=engine)
+                changes.append("create index %s" % index.name)
+    return changes
@@ -1,6 +1,7 @@
-from myblog.extensions import db
+from myblog.extensions import db, context_cache
 from datetime import datetime
 from flask_login import UserMixin
+from markupsafe import Markup
 from werkzeug.security import generate_password_hash, check_password_hash
 
 
@@ -13,6 +14,8 @@ class Admin(db.Model, UserMixin):
     blog_sub_title = db.Column(db.String(100))
     name = db.Column(db.String(30))              # 姓名
     about = db.Column(db.Text)
+    site_modified = db.Column(db.DateTime, default=datetime.utcnow)  # 每个页面都有的内容（博客标题、侧边栏）最后修改的时间
+    session_version = db.Column(db.Integer, default=0, server_default="0", nullable=False)  # 登录凭据每修改一次加一
 
     def set_password(self, password):
         self.password_hash = generate_password_hash(password)
@@ -20,39 +23,195 @@ class Admin(db.Model, UserMixin):
     def validate_password(self, password):
         return check_password_hash(self.password_hash, password)
 
+    def get_id(self):
+        """会话和 remember cookie 里记录 “id:session_version”，版本号变了以后以前的登录全部失效"""
+        return "%d:%d" % (self.id, self.session_version or 0)
+
+    def bump_session_version(self):
+        """
+        用户名、密码变化时调用，所有已经登录的会话（包括 remember cookie）都要重新登录
+        """
+        self.session_version = (self.session_version or 0) + 1
+
+    @staticmethod
+    def mark_site_modified():
+        """
+        博客标题、侧边栏的分类和链接变化时调用，所有页面的条件请求校验值都会跟着变
+        """
+        Admin.query.update({Admin.site_modified: datetime.utcnow()}, synchronize_session=False)
+
 
 # 文章分类表
 class Category(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(30), unique=True)  # 文章分类名唯一
+    post_count = db.Column(db.Integer, default=0, server_default="0", nullable=False)  # 冗余的文章数，侧边栏不用再加载文章
 
     posts = db.relationship("Post", back_populates="category")  # 创建集合关系posts
 
+    def increase_post_count(self, amount=1):
+        """
+        用SQL表达式做加减，并发修改时不会互相覆盖，提交后属性会重新从数据库加载
+        """
+        self.post_count = Category.post_count + amount
+
     def delete(self):
-        default_category = Category.query.get(1)
-        posts = self.posts[:]
-        for post in posts:
-            post.category = default_category
-        db.session.delete(self)
+        """
+        删除分类，下面的文章移到默认分类（id 为 1），默认分类本身不能删除
+        :return: 移到默认分类的文章数
+        """
+        if self.id == 1:
+            raise ValueError("Cannot delete the default category")
+        moved = self.merge_into(Category.query.get(1))
         db.session.commit()
+        return moved
+
+    def merge_into(self, target):
+        """
+        把这个分类合并到 target：用一条 UPDATE 把文章移过去，再删除这个分类，不加载文章，需要调用者提交。
+        文章数按移动的行数加到 target 上；文章页面上显示的分类变了，所有页面的条件请求校验值跟着更新
+        :return: 移动的文章数
+        """
+        if target.id == self.id:
+            raise ValueError("Cannot merge a category into itself")
+        moved = Post.query.filter(Post.category_id == self.id).update({Post.category_id: target.id},
+                                                                      synchronize_session=False)
+        target.increase_post_count(moved)
+        # 不用 session.delete：它会加载 posts 集合，把已经加载过的文章的 category_id 置空
+        Category.query.filter(Category.id == self.id).delete(synchronize_session="evaluate")
+        Admin.mark_site_modified()
+        return moved
+
+    @staticmethod
+    def update_post_counts():
+        """
+        用一条 UPDATE 按 post 表重新统计所有分类的文章数，数据不一致时用来修复
+        """
+        counts = db.session.query(db.func.count(Post.id)).filter(Post.category_id == Category.id).as_scalar()
+        Category.query.update({Category.post_count: counts}, synchronize_session=False)
+
+
+EXCERPT_LENGTH = 255  # 和模板里 truncate 过滤器的默认长度一样
 
 
 # 文章表
 class Post(db.Model):
+    # 分类页按分类过滤、按时间倒序分页，联合索引直接按顺序读出一页，不用排序；flask explain 会检查这些查询
+    __table_args__ = (db.Index("ix_post_category_id_timestamp", "category_id", "timestamp"),)
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(60))
     body = db.Column(db.Text)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)  # 建立索引
     can_comment = db.Column(db.Boolean, default=True)
+    last_modified = db.Column(db.DateTime, default=datetime.utcnow, index=True)  # 文章页面内容（包括评论）最后修改的时间
 
     category_id = db.Column(db.Integer, db.ForeignKey("category.id"))  # 外键，一个分类对应多篇文章
 
+    comment_count = db.Column(db.Integer, default=0, server_default="0", nullable=False)  # 冗余的评论总数
+    reviewed_comment_count = db.Column(db.Integer, default=0, server_default="0", nullable=False)  # 冗余的已审核评论数
+
+    # 保存文章时生成的摘要和字数，列表页不用加载正文
+    excerpt = db.Column(db.String(EXCERPT_LENGTH + 5))
+    word_count = db.Column(db.Integer, default=0, server_default="0", nullable=False)
+
     category = db.relationship("Category", back_populates="posts")  # 创建标量关系category
     comments = db.relationship("Comment", back_populates="post", cascade="all, delete-orphan")    # 创建集合关系comments,级联删除
 
+    @staticmethod
+    def make_excerpt(body, length=EXCERPT_LENGTH, leeway=5, end="..."):
+        """
+        去掉HTML标签以后截取摘要，结果和模板里的 body|striptags|truncate 一样
+        :return: (摘要, 字数)
+        """
+        text = Markup(body or "").striptags()
+        if len(text) <= length + leeway:
+            return text, len(text)
+        return text[:length - len(end)].rsplit(" ", 1)[0] + end, len(text)
+
+    def update_excerpt(self):
+        """新建、编辑文章修改正文以后调用"""
+        self.excerpt, self.word_count = Post.make_excerpt(self.body)
+
+    @staticmethod
+    def update_excerpts(batch_size=500, only_missing=True):
+        """
+        按 id 分批重新生成摘要，每批只读取 id 和正文
+        :param only_missing: 只处理还没有摘要的文章
+        :return: 处理的文章数
+        """
+        table = Post.__table__
+        update = table.update().where(table.c.id == db.bindparam("post_id")) \
+            .values(excerpt=db.bindparam("new_excerpt"), word_count=db.bindparam("new_word_count"))
+        last_id = 0
+        count = 0
+        while True:
+            query = db.session.query(Post.id, Post.body).filter(Post.id > last_id)
+            if only_missing:
+                query = query.filter(Post.excerpt.is_(None))
+            rows = query.order_by(Post.id).limit(batch_size).all()
+            if not rows:
+                break
+            mappings = []
+            for post_id, body in rows:
+                excerpt, word_count = Post.make_excerpt(body)
+                mappings.append(dict(post_id=post_id, new_excerpt=excerpt, new_word_count=word_count))
+            db.session.execute(update, mappings)
+            count += len(rows)
+            last_id = rows[-1][0]
+        return count
+
+    def increase_comment_count(self, amount=1, reviewed=False):
+        """
+        和 Category.increase_post_count 一样用SQL表达式做加减
+        :param amount: 变化的数量
+        :param reviewed: 是否同时修改已审核评论数
+        """
+        self.comment_count = Post.comment_count + amount
+        if reviewed:
+            self.reviewed_comment_count = Post.reviewed_comment_count + amount
+
+    @staticmethod
+    def mark_modified(post_ids):
+        """
+        更新文章的最后修改时间，条件请求用它来判断页面有没有变化
+        """
+        if post_ids:
+            Post.query.filter(Post.id.in_(post_ids)).update({Post.last_modified: datetime.utcnow()},
+                                                            synchronize_session=False)
+
+    @staticmethod
+    def update_comment_counts(post_ids=None):
+        """
+        按 comment 表重新统计文章的评论数，删除评论时级联删掉的回复数量不好算，直接重新统计
+        :param post_ids: 需要重新统计的文章id，为 None 时统计所有文章
+        """
+        total = db.session.query(db.func.count(Comment.id)).filter(Comment.post_id == Post.id).as_scalar()
+        reviewed = db.session.query(db.func.count(Comment.id)).filter(Comment.post_id == Post.id,
+                                                                     Comment.reviewed == True).as_scalar()
+        query = Post.query
+        if post_ids is not None:
+            if not post_ids:
+                return
+            query = query.filter(Post.id.in_(post_ids))
+        query.update({Post.comment_count: total, Post.reviewed_comment_count: reviewed}, synchronize_session=False)
+
+
+PATH_SEGMENT = "%010d/"  # 固定宽度，按字符串排序和按id排序一致
+PATH_LENGTH = 255
+BULK_CHUNK_SIZE = 500  # 批量删除时一条 DELETE 里最多的id数，SQLite 对一条语句的参数个数有限制
+
 
 # 评论表
 class Comment(db.Model):
+    # 对应几种热点查询：文章页的顶层已审核评论、后台的未审核评论和管理员评论，都按时间倒序分页。
+    # 等值条件的列在前，排序的 timestamp 在最后，InnoDB 和 SQLite 的二级索引都隐含主键，按 (timestamp, id) 排序也不用再排；
+    # 文章页的讨论串按 (post_id, path) 范围读出来，本身就是按 path 排好序的
+    __table_args__ = (
+        db.Index("ix_comment_post_id_reviewed_depth_timestamp", "post_id", "reviewed", "depth", "timestamp"),
+        db.Index("ix_comment_post_id_path", "post_id", "path"),
+        db.Index("ix_comment_reviewed_timestamp", "reviewed", "timestamp"),
+        db.Index("ix_comment_from_admin_timestamp", "from_admin", "timestamp"),
+    )
     id = db.Column(db.Integer, primary_key=True)
     author = db.Column(db.String(30))
     email = db.Column(db.String(50))
@@ -66,10 +225,196 @@ class Comment(db.Model):
     post_id = db.Column(db.Integer, db.ForeignKey("post.id"))  # 外键，一篇文章对应多个评论
     post = db.relationship("Post", back_populates="comments")  # 创建标量关系post
 
-    replied_id = db.Column(db.Integer, db.ForeignKey("comment.id"))  # 子评论ID, 一个评论对应多个子评论
+    replied_id = db.Column(db.Integer, db.ForeignKey("comment.id"), index=True)  # 子评论ID, 一个评论对应多个子评论
     replies = db.relationship("Comment", back_populates="replied", cascade="all, delete-orphan")  # 创建集合关系属性，子评论，级联删除
     replied = db.relationship("Comment", back_populates="replies", remote_side=[id])  # 创建标量关系属性，父评论
 
+    # 物化路径：从顶层评论到自己的id，每段固定宽度，比如 0000000012/0000000045/。
+    # 按 path 排序就是先父后子的树形顺序，一个评论下面的整个讨论串是一段连续的 path 区间
+    path = db.Column(db.String(PATH_LENGTH), index=True)
+    depth = db.Column(db.Integer, default=0, server_default="0", nullable=False)  # 顶层评论为 0
+
+    @staticmethod
+    def child_path(comment_id, parent_path=None, parent_depth=0):
+        """
+        :return: (path, depth)，没有父评论时是顶层评论；超过最大深度时挂在父评论的同一层
+        """
+        segment = PATH_SEGMENT % comment_id
+        if parent_path is None:
+            return segment, 0
+        if len(parent_path) + len(segment) > PATH_LENGTH:
+            return parent_path[:-len(segment)] + segment, parent_depth
+        return parent_path + segment, parent_depth + 1
+
+    def set_path(self):
+        """
+        新评论 flush 拿到 id 以后调用。回复其他文章的评论（老数据里可能有）也当作顶层评论
+        """
+        replied = self.replied
+        if replied is not None and replied.post_id == self.post_id and replied.path:
+            self.path, self.depth = Comment.child_path(self.id, replied.path, replied.depth)
+        else:
+            self.path, self.depth = Comment.child_path(self.id)
+
+    def thread_range(self):
+        """这条评论下面所有回复的 path 区间（不包括自己），分隔符和数字都比 ~ 小"""
+        return db.and_(Comment.path > self.path, Comment.path < self.path + "~")
+
+    @staticmethod
+    def load_threads(roots, reviewed=True):
+        """
+        一次查询加载一页顶层评论下面的所有回复，组装成树，每条评论的回复放在 children 属性里。
+        被回复的评论没有显示出来（比如还没审核）时，回复挂在最近的一个显示出来的上级评论下面。
+        :param roots: 当前页的顶层评论
+        :param reviewed: 只加载审核过的回复
+        :return: roots
+        """
+        nodes = {}
+        for root in roots:
+            root.children = []
+            nodes[root.path] = root
+        roots_with_path = [root for root in roots if root.path]
+        if not roots_with_path:
+            return roots
+
+        query = Comment.query.filter(Comment.post_id == roots_with_path[0].post_id, Comment.depth > 0,
+                                     db.or_(*[root.thread_range() for root in roots_with_path]))
+        if reviewed:
+            query = query.filter(Comment.reviewed == True)
+        for reply in query.order_by(Comment.path):  # 按 path 排序，父评论一定先出现
+            reply.children = []
+            nodes[reply.path] = reply
+            parent_path = reply.path[:-len(PATH_SEGMENT % 0)]
+            while parent_path and parent_path not in nodes:
+                parent_path = parent_path[:-len(PATH_SEGMENT % 0)]
+            if parent_path:
+                nodes[parent_path].children.append(reply)
+        return roots
+
+    @staticmethod
+    def unread_count():
+        """待审核的评论数，显示在后台导航栏上，走模板上下文缓存，发表、审核、删除评论时失效"""
+        return context_cache.get("unread_comments", lambda: Comment.query.filter_by(reviewed=False).count())
+
+    @staticmethod
+    def filter_criteria(model=None, ids=None, post_id=None, reviewed=None, from_admin=None, start=None, end=None):
+        """
+        评论管理页面和批量审核、删除共用的过滤条件
+        :param model: Comment 或者它的别名
+        :param ids: 勾选的评论id
+        :param start: 时间范围的开始（包含），UTC
+        :param end: 时间范围的结束（不包含），UTC
+        :return: 条件列表，为空时表示所有评论
+        """
+        model = model or Comment
+        criteria = []
+        if ids is not None:
+            criteria.append(model.id.in_(ids))
+        if post_id is not None:
+            criteria.append(model.post_id == post_id)
+        if reviewed is not None:
+            criteria.append(model.reviewed == reviewed)
+        if from_admin is not None:
+            criteria.append(model.from_admin == from_admin)
+        if start is not None:
+            criteria.append(model.timestamp >= start)
+        if end is not None:
+            criteria.append(model.timestamp < end)
+        return criteria
+
+    @staticmethod
+    def bulk_approve(**filters):
+        """
+        用一条 UPDATE 发表所有符合条件的未审核评论，回复不会跟着发表，还是要单独审核
+        :param filters: 见 filter_criteria
+        :return: (发表的评论数, 受影响的文章id)
+        """
+        criteria = Comment.filter_criteria(**filters) + [Comment.reviewed == False]
+        post_ids = set(post_id for post_id, in db.session.query(Comment.post_id).filter(*criteria).distinct())
+        if not post_ids:
+            return 0, post_ids
+        count = Comment.query.filter(*criteria).update({Comment.reviewed: True}, synchronize_session=False)
+        Post.update_comment_counts(post_ids)
+        Post.mark_modified(post_ids)
+        return count, post_ids
+
+    @staticmethod
+    def bulk_delete(**filters):
+        """
+        删除所有符合条件的评论以及它们下面的全部回复，不把评论加载到 session 里。
+        同一篇文章下的回复按 path 区间和符合条件的评论一起用一次查询找出来，
+        回复其他文章评论的老数据、还没有 path 的评论再按 replied_id 一轮一轮地找。
+        删除前先把这些评论的 replied_id 置空，互相之间不再有外键引用，MySQL 逐行检查外键也不会失败，
+        语句数只和评论数有关，和讨论串的深度无关
+        :param filters: 见 filter_criteria
+        :return: (删除的评论数, 其中级联删除的回复数, 受影响的文章id)
+        """
+        root = db.aliased(Comment)
+        thread = db.or_(Comment.id == root.id, db.and_(Comment.path > root.path, Comment.path < root.path + "~"))
+        matched = db.func.max(db.case([(Comment.id == root.id, 1)], else_=0))
+        rows = db.session.query(Comment.id, Comment.post_id, matched).join(root, thread) \
+            .filter(*Comment.filter_criteria(root, **filters)).group_by(Comment.id, Comment.post_id).all()
+        if not rows:
+            return 0, 0, set()
+
+        post_ids = set(row[1] for row in rows)
+        replies = sum(1 for row in rows if not row[2])
+        ids = [row[0] for row in rows]
+        seen = set(ids)
+        found = ids
+        while found:
+            parents, found = found, []
+            for start in range(0, len(parents), BULK_CHUNK_SIZE):
+                for comment_id, post_id in db.session.query(Comment.id, Comment.post_id) \
+                        .filter(Comment.replied_id.in_(parents[start:start + BULK_CHUNK_SIZE])):
+                    if comment_id not in seen:
+                        seen.add(comment_id)
+                        found.append(comment_id)
+                        post_ids.add(post_id)
+            replies += len(found)
+            ids = ids + found
+
+        chunks = [ids[start:start + BULK_CHUNK_SIZE] for start in range(0, len(ids), BULK_CHUNK_SIZE)]
+        for chunk in chunks:
+            Comment.query.filter(Comment.id.in_(chunk)).update({Comment.replied_id: None}, synchronize_session=False)
+        count = 0
+        for chunk in chunks:
+            count += Comment.query.filter(Comment.id.in_(chunk)).delete(synchronize_session=False)
+        Post.update_comment_counts(post_ids)
+        Post.mark_modified(post_ids)
+        return count, replies, post_ids
+
+    @staticmethod
+    def update_paths(batch_size=1000):
+        """
+        给 path 为空的评论回填 path 和 depth：先是顶层评论，然后一层一层处理回复，
+        每批只查询 batch_size 条，内存占用和评论总数无关
+        :return: 回填的评论数
+        """
+        parent = db.aliased(Comment)
+        table = Comment.__table__
+        update = table.update().where(table.c.id == db.bindparam("comment_id")) \
+            .values(path=db.bindparam("new_path"), depth=db.bindparam("new_depth"))
+        count = 0
+
+        roots = db.session.query(Comment.id).outerjoin(parent, Comment.replied_id == parent.id) \
+            .filter(Comment.path.is_(None), db.or_(parent.id.is_(None), parent.post_id != Comment.post_id))
+        replies = db.session.query(Comment.id, parent.path, parent.depth) \
+            .join(parent, Comment.replied_id == parent.id) \
+            .filter(Comment.path.is_(None), parent.path.isnot(None), parent.post_id == Comment.post_id)
+        for query in roots, replies:
+            while True:
+                rows = query.limit(batch_size).all()
+                if not rows:
+                    break
+                mappings = []
+                for row in rows:
+                    path, depth = Comment.child_path(*row)
+                    mappings.append(dict(comment_id=row[0], new_path=path, new_depth=depth))
+                db.session.execute(update, mappings)
+                count += len(rows)
+        return count
+
 
 # 存放链接的表
 class Link(db.Model):
@@ -78,7 +423,8 @@ class Link(db.Model):
     url = db.Column(db.String(100))
 
 
-
-
-
-
+# 全文搜索的倒排索引表，每一行记录一个词在一篇文章里的权重，见 myblog.search
+class SearchTerm(db.Model):
+    term = db.Column(db.String(32), primary_key=True)
+    post_id = db.Column(db.Integer, db.ForeignKey("post.id"), primary_key=True, index=True)
+    weight = db.Column(db.Integer, default=1)  # 词频，标题里出现的词权重更高
@@ -0,0 +1,108 @@
+from datetime import datetime
+
+from flask import request, url_for, current_app, abort
+from sqlalchemy import and_, or_
+
+CURSOR_TIME_FORMAT = "%Y%m%d%H%M%S%f"
+
+
+def encode_cursor(item):
+    return "%s-%d" % (item.timestamp.strftime(CURSOR_TIME_FORMAT), item.id)
+
+
+def decode_cursor(cursor):
+    """
+    游标的格式为 时间戳-id，格式不对的时候返回400
+    """
+    try:
+        timestamp, item_id = cursor.split("-", 1)
+        return datetime.strptime(timestamp, CURSOR_TIME_FORMAT), int(item_id)
+    except ValueError:
+        abort(400)
+
+
+class KeysetPagination(object):
+    """
+    按 (timestamp, id) 倒序的游标分页。
+
+    OFFSET 分页翻到后面要先扫过前面所有的行，还要额外 COUNT(*) 一次，
+    游标分页直接用上一页最后一条记录的 (timestamp, id) 作为条件，走索引定位，翻到第几页代价都一样。
+    after 表示取比游标更旧的一页（下一页），before 表示取比游标更新的一页（上一页）。
+    """
+
+    total = None  # 不做 COUNT(*)，模板里需要判断
+    page = None
+
+    def __init__(self, query, model, per_page, after=None, before=None):
+        self.per_page = per_page
+        timestamp, item_id = model.timestamp, model.id
+
+        if before:
+            cursor_timestamp, cursor_id = decode_cursor(before)
+            query = query.filter(or_(timestamp > cursor_timestamp,
+                                     and_(timestamp == cursor_timestamp, item_id > cursor_id)))
+            query = query.order_by(timestamp.asc(), item_id.asc())
+        else:
+            if after:
+                cursor_timestamp, cursor_id = decode_cursor(after)
+                query = query.filter(or_(timestamp < cursor_timestamp,
+                                         and_(timestamp == cursor_timestamp, item_id < cursor_id)))
+            query = query.order_by(timestamp.desc(), item_id.desc())
+
+        items = query.limit(per_page + 1).all()  # 多取一条用来判断还有没有下一页
+        has_more = len(items) > per_page
+        items = items[:per_page]
+
+        if before:
+            items.reverse()
+            self.has_prev = has_more
+            self.has_next = True
+        else:
+            self.has_prev = bool(after)
+            self.has_next = has_more
+        self.items = items
+
+    @property
+    def next_cursor(self):
+        return encode_cursor(self.items[-1]) if self.has_next and self.items else None
+
+    @property
+    def prev_cursor(self):
+        return encode_cursor(self.items[0]) if self.has_prev and self.items else None
+
+    def url_for_cursor(self, **cursor):
+        """
+        保留当前请求的其他参数（比如评论管理的 filter），只替换分页参数
+        """
+        args = request.args.to_dict()
+        for key in ("page", "after", "before"):
+            args.pop(key, None)
+        args.update(request.view_args or {})
+        args.update(cursor)
+        return url_for(request.endpoint, **args)
+
+    @property
+    def first_url(self):
+        return self.url_for_cursor()
+
+    @property
+    def next_url(self):
+        return self.url_for_cursor(after=self.next_cursor)
+
+    @property
+    def prev_url(self):
+        return self.url_for_cursor(before=self.prev_cursor)
+
+
+def paginate(query, model, per_page):
+    """
+    按配置选择分页方式，MYBLOG_KEYSET_PAGINATION 为 True 时用游标分页，否则用 flask-sqlalchemy 内置的分页
+    :param query: 还没有排序的查询
+    :param model: 有 timestamp 和 id 字段的模型
+    :param per_page: 每页数量
+    """
+    if current_app.config["MYBLOG_KEYSET_PAGINATION"]:
+        return KeysetPagination(query, model, per_page,
+                                after=request.args.get("after"), before=request.args.get("before"))
+    page = request.args.get("page", 1, type=int)
+    return query.order_by(model.timestamp.desc(), model.id.desc()).paginate(page, per_page=per_page)
@@ -0,0 +1,142 @@
+import os
+import time
+from threading import Lock
+
+from sqlalchemy import event, exc
+from sqlalchemy.pool import QueuePool
+
+try:
+    from sqlalchemy.pool import AsyncAdaptedQueuePool
+except ImportError:  # SQLAlchemy 1.4 以前没有异步驱动，只能用同步的 WSGI 入口
+    AsyncAdaptedQueuePool = None
+
+
+class PoolStats(object):
+    """
+    一个连接池在当前进程里的统计：取连接的等待时间、正在使用的连接数、溢出和超时次数。
+    每个 gunicorn worker 各有一份，(pool_size + max_overflow) * worker 数就是数据库那边要准备的最大连接数
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.pool = None
+        self.checkouts = 0
+        self.connects = 0
+        self.invalidations = 0
+        self.in_use = 0
+        self.max_in_use = 0
+        self.waits = 0  # 经过 QueuePool 排队的取连接次数，只有 QueuePool 才统计等待时间
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.overflows = 0
+        self.timeouts = 0
+        self._lock = Lock()
+
+    def record_wait(self, duration, overflowed=False):
+        with self._lock:
+            self.waits += 1
+            self.wait_time += duration
+            self.max_wait_time = max(self.max_wait_time, duration)
+            if overflowed:
+                self.overflows += 1
+
+    def record_timeout(self, duration):
+        with self._lock:
+            self.timeouts += 1
+            self.max_wait_time = max(self.max_wait_time, duration)
+
+    def on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        with self._lock:
+            self.checkouts += 1
+            self.in_use += 1
+            self.max_in_use = max(self.max_in_use, self.in_use)
+
+    def on_checkin(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.in_use = max(self.in_use - 1, 0)
+
+    def on_connect(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.connects += 1
+
+    def on_invalidate(self, dbapi_connection, connection_record, exception):
+        # pre-ping 发现连接断开、或者执行时遇到断开的连接都会走到这里
+        with self._lock:
+            self.invalidations += 1
+
+    def to_dict(self):
+        pool = self.pool
+        with self._lock:
+            stats = dict(name=self.name, pool=type(pool).__name__ if pool is not None else None,
+                         checkouts=self.checkouts, connects=self.connects, invalidations=self.invalidations,
+                         in_use=self.in_use, max_in_use=self.max_in_use, overflows=self.overflows,
+                         timeouts=self.timeouts,
+                         avg_wait_ms=self.wait_time / self.waits * 1000 if self.waits else 0,
+                         max_wait_ms=self.max_wait_time * 1000)
+        if isinstance(pool, QueuePool):
+            stats.update(pool_size=pool.size(), max_overflow=pool._max_overflow, checked_in=pool.checkedin(),
+                         checked_out=pool.checkedout(), overflow=max(pool.overflow(), 0))
+        return stats
+
+
+class InstrumentedQueuePool(QueuePool):
+    """
+    记录取连接等待时间的 QueuePool，池里没有空闲连接时 _do_get 会排队或者建立溢出连接
+    """
+
+    stats = None
+
+    def _do_get(self):
+        start = time.perf_counter()
+        overflow = self._overflow
+        try:
+            connection = super(InstrumentedQueuePool, self)._do_get()
+        except exc.TimeoutError:
+            if self.stats is not None:
+                self.stats.record_timeout(time.perf_counter() - start)
+            raise
+        if self.stats is not None:
+            # _overflow 从 -pool_size 开始计数，大于0说明这次建立的是池外的溢出连接
+            self.stats.record_wait(time.perf_counter() - start, overflowed=self._overflow > max(overflow, 0))
+        return connection
+
+    def recreate(self):
+        # engine.dispose() 会重新建一个池，统计接着用同一份
+        pool = super(InstrumentedQueuePool, self).recreate()
+        pool.stats = self.stats
+        self.stats.pool = pool
+        return pool
+
+
+if AsyncAdaptedQueuePool is not None:
+    class InstrumentedAsyncQueuePool(InstrumentedQueuePool, AsyncAdaptedQueuePool):
+        """异步驱动用的 InstrumentedQueuePool"""
+else:
+    InstrumentedAsyncQueuePool = None
+
+
+class PoolMetrics(object):
+    """
+    当前进程里所有引擎（主库和只读副本）的连接池统计
+    """
+
+    def __init__(self):
+        self.pools = {}
+
+    def instrument(self, engine):
+        name = repr(engine.url)  # 密码会显示成 ***
+        stats = self.pools.get(name)
+        if stats is None:
+            stats = self.pools[name] = PoolStats(name)
+        stats.pool = engine.pool
+        if isinstance(engine.pool, InstrumentedQueuePool):
+            engine.pool.stats = stats
+        event.listen(engine.pool, "checkout", stats.on_checkout)
+        event.listen(engine.pool, "checkin", stats.on_checkin)
+        event.listen(engine.pool, "connect", stats.on_connect)
+        event.listen(engine.pool, "invalidate", stats.on_invalidate)
+        return engine
+
+    def to_dict(self):
+        return dict(pid=os.getpid(), pools=[stats.to_dict() for stats in self.pools.values()])
+
@@ -0,0 +1,213 @@
+import time
+import random
+import itertools
+from threading import Lock
+
+from flask import g, request, session, current_app, has_app_context, has_request_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import event, orm
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import NullPool
+from sqlalchemy.sql.dml import UpdateBase
+
+from myblog.pool import PoolMetrics, InstrumentedQueuePool, InstrumentedAsyncQueuePool
+
+REPLICA_BIND_PREFIX = "replica_"
+STICKY_SESSION_KEY = "_db_primary_until"
+# ASGI 入口在 environ 里设置这个键，表示当前请求运行在事件循环的 greenlet 里，要用异步驱动
+ASYNC_ENVIRON_KEY = "myblog.async"
+# 同步驱动对应的异步驱动
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "sqlite+pysqlite": "sqlite+aiosqlite",
+    "mysql": "mysql+aiomysql",
+    "mysql+pymysql": "mysql+aiomysql",
+    "mysql+mysqldb": "mysql+aiomysql",
+    "postgresql": "postgresql+asyncpg",
+    "postgresql+psycopg2": "postgresql+asyncpg",
+}
+
+
+def async_url(sa_url):
+    """把同步驱动的地址换成对应的异步驱动，已经是异步驱动的原样返回"""
+    sa_url = make_url(sa_url)
+    if sa_url.drivername in ASYNC_DRIVERS.values():
+        return sa_url
+    if sa_url.drivername not in ASYNC_DRIVERS:
+        raise ValueError("No async driver for %r, set MYBLOG_ASYNC_DATABASE_URI" % sa_url.drivername)
+    return sa_url.set(drivername=ASYNC_DRIVERS[sa_url.drivername])
+
+
+def in_async_request():
+    return has_request_context() and request.environ.get(ASYNC_ENVIRON_KEY, False)
+
+
+class RoutingSession(SignallingSession):
+    """
+    按请求选择数据库的 session：请求开始时选好的只读副本记在 g.db_replica 里，
+    查询发往副本，flush 和 UPDATE/DELETE/INSERT 语句始终发往主库
+    """
+
+    def __init__(self, db, **options):
+        self.db = db
+        super(RoutingSession, self).__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        bind = mapper.persist_selectable.info.get("bind_key") if mapper is not None else None
+        # 指定了 __bind_key__ 的模型不参与读写分离
+        if bind is None and not (self._flushing or isinstance(clause, UpdateBase)):
+            bind = g.get("db_replica") if has_app_context() else None
+        if in_async_request():
+            # 异步引擎的 sync_engine 在 greenlet 里执行，等待数据库时让出事件循环
+            return self.db.get_async_engine(self.app, bind).sync_engine
+        if bind is None:
+            return super(RoutingSession, self).get_bind(mapper, clause)
+        return self.db.get_engine(self.app, bind=bind)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """
+    支持只读副本的 SQLAlchemy。
+
+    MYBLOG_DATABASE_REPLICAS 里的每个地址注册成一个 replica_<n> 绑定。
+    MYBLOG_REPLICA_BLUEPRINTS 里的蓝本处理 GET/HEAD 请求时，整个请求（包括模板上下文里的查询）都读同一个副本，
+    按 MYBLOG_REPLICA_STRATEGY 轮流（round_robin）或者随机（random）选择；后台、登录和发表评论都走主库。
+    写过数据库的浏览器会话在 MYBLOG_REPLICA_STICKY_SECONDS 秒内只读主库，保证能读到自己刚写的内容；
+    当前进程刚写过数据库时所有请求也先读主库，避免刚失效的页面缓存被副本上的旧数据重新填上。
+    没有配置副本时和普通的 SQLAlchemy 完全一样。
+
+    连接池参数来自配置类里的 MYBLOG_DB_POOL_*，SQLite 没有连接池，不设置这些参数；
+    每个引擎的连接池统计在 pool_metrics 里。
+
+    通过 ASGI 入口（myblog.asgi）进来的异步请求用 get_async_engine() 返回的异步引擎，
+    驱动由 MYBLOG_ASYNC_DATABASE_URI 指定，没有配置时按 ASYNC_DRIVERS 换成对应的异步驱动，连接池参数相同。
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.pool_metrics = PoolMetrics()
+        self.replicas = []
+        self.last_write = 0
+        self._counter = itertools.count()
+        self.async_engines = {}
+        self._async_lock = Lock()
+        super(RoutingSQLAlchemy, self).__init__(*args, **kwargs)
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        result = super(RoutingSQLAlchemy, self).apply_driver_hacks(app, sa_url, options)
+        if result is not None:  # Flask-SQLAlchemy 2.5 起返回新的 sa_url 和 options，以前的版本是原地修改
+            sa_url, options = result
+        if not sa_url.drivername.startswith("sqlite"):
+            options.update(poolclass=InstrumentedQueuePool,
+                           pool_size=app.config["MYBLOG_DB_POOL_SIZE"],
+                           max_overflow=app.config["MYBLOG_DB_MAX_OVERFLOW"],
+                           pool_timeout=app.config["MYBLOG_DB_POOL_TIMEOUT"],
+                           pool_recycle=app.config["MYBLOG_DB_POOL_RECYCLE"],
+                           pool_pre_ping=app.config["MYBLOG_DB_POOL_PRE_PING"])
+        return sa_url, options  # SQLALCHEMY_ENGINE_OPTIONS 在这之后合并，显式配置的参数优先
+
+    def create_engine(self, sa_url, engine_opts):
+        engine = super(RoutingSQLAlchemy, self).create_engine(sa_url, engine_opts)
+        return self.pool_metrics.instrument(engine)
+
+    def get_async_engine(self, app, bind=None):
+        """
+        异步请求用的 AsyncEngine，每个应用、每个绑定一个
+        :param bind: 绑定名，None 为主库
+        """
+        key = (app, bind)
+        engine = self.async_engines.get(key)
+        if engine is None:
+            with self._async_lock:
+                engine = self.async_engines.get(key)
+                if engine is None:
+                    engine = self.async_engines[key] = self._create_async_engine(app, bind)
+        return engine
+
+    def _create_async_engine(self, app, bind):
+        if InstrumentedAsyncQueuePool is None:
+            raise RuntimeError("The ASGI entry point requires SQLAlchemy >= 1.4 and greenlet")
+        from sqlalchemy.ext.asyncio import create_async_engine
+
+        if bind is None:
+            uri = app.config["MYBLOG_ASYNC_DATABASE_URI"] or app.config["SQLALCHEMY_DATABASE_URI"]
+        else:
+            uri = app.config["SQLALCHEMY_BINDS"][bind]
+        sa_url = make_url(uri)
+        drivername = async_url(sa_url).drivername
+        # 驱动相关的处理（SQLite 的相对路径、连接池参数）和同步引擎一样，按数据库类型做完再换成异步驱动
+        options = self.apply_pool_defaults(app, {})
+        sa_url, options = self.apply_driver_hacks(app, sa_url.set(drivername=sa_url.get_backend_name()), options)
+        options.update(app.config["SQLALCHEMY_ENGINE_OPTIONS"])
+        options.update(self._engine_options)
+        if options.get("poolclass") is NullPool:
+            # aiosqlite 的每个连接都有一个自己的线程，SQLite 文件数据库也用连接池复用连接
+            options.update(poolclass=InstrumentedQueuePool, pool_size=app.config["MYBLOG_DB_POOL_SIZE"],
+                           max_overflow=app.config["MYBLOG_DB_MAX_OVERFLOW"],
+                           pool_timeout=app.config["MYBLOG_DB_POOL_TIMEOUT"])
+        if options.get("poolclass") is InstrumentedQueuePool:
+            options["poolclass"] = InstrumentedAsyncQueuePool  # 连接池满时在事件循环上等待，不阻塞线程
+        engine = create_async_engine(sa_url.set(drivername=drivername), **options)
+        self.pool_metrics.instrument(engine.sync_engine)
+        return engine
+
+    async def dispose_async_engines(self, app):
+        for key in [key for key in self.async_engines if key[0] is app]:
+            await self.async_engines.pop(key).dispose()
+
+    def create_session(self, options):
+        session_factory = orm.sessionmaker(class_=RoutingSession, db=self, **options)
+        event.listen(session_factory, "after_flush", self._after_flush)
+        return session_factory
+
+    def init_app(self, app):
+        app.config.setdefault("MYBLOG_DATABASE_REPLICAS", [])
+        app.config.setdefault("MYBLOG_REPLICA_STRATEGY", "round_robin")
+        app.config.setdefault("MYBLOG_REPLICA_BLUEPRINTS", ["blog"])
+        app.config.setdefault("MYBLOG_REPLICA_STICKY_SECONDS", 5)
+        app.config.setdefault("MYBLOG_DB_POOL_SIZE", 5)
+        app.config.setdefault("MYBLOG_DB_MAX_OVERFLOW", 10)
+        app.config.setdefault("MYBLOG_DB_POOL_TIMEOUT", 10)
+        app.config.setdefault("MYBLOG_DB_POOL_RECYCLE", 1800)
+        app.config.setdefault("MYBLOG_DB_POOL_PRE_PING", True)
+        app.config.setdefault("MYBLOG_ASYNC_DATABASE_URI", None)
+
+        binds = dict(app.config.get("SQLALCHEMY_BINDS") or {})
+        self.replicas = []
+        for index, uri in enumerate(app.config["MYBLOG_DATABASE_REPLICAS"]):
+            key = REPLICA_BIND_PREFIX + str(index)
+            binds[key] = uri
+            self.replicas.append(key)
+        app.config["SQLALCHEMY_BINDS"] = binds or None
+        if app.config["MYBLOG_REPLICA_STRATEGY"] not in ("round_robin", "random"):
+            raise ValueError("Unknown MYBLOG_REPLICA_STRATEGY: %r" % app.config["MYBLOG_REPLICA_STRATEGY"])
+
+        super(RoutingSQLAlchemy, self).init_app(app)
+        if self.replicas:
+            app.before_request(self._choose_replica)
+            app.after_request(self._stick_to_primary)
+
+    def choose_replica(self, app):
+        if app.config["MYBLOG_REPLICA_STRATEGY"] == "random":
+            return random.choice(self.replicas)
+        return self.replicas[next(self._counter) % len(self.replicas)]
+
+    def _choose_replica(self):
+        app = current_app._get_current_object()
+        sticky = app.config["MYBLOG_REPLICA_STICKY_SECONDS"]
+        now = time.time()
+        if (request.method in ("GET", "HEAD") and request.blueprint in app.config["MYBLOG_REPLICA_BLUEPRINTS"]
+                and now - self.last_write >= sticky and session.get(STICKY_SESSION_KEY, 0) <= now):
+            g.db_replica = self.choose_replica(app)
+
+    def _after_flush(self, db_session, flush_context):
+        if db_session.new or db_session.dirty or db_session.deleted:
+            self.last_write = time.time()
+            if has_app_context():
+                g.db_wrote = True
+
+    def _stick_to_primary(self, response):
+        # 批量 UPDATE/DELETE 不经过 flush，写请求一律算作写过
+        if g.get("db_wrote") or request.method not in ("GET", "HEAD", "OPTIONS"):
+            self.last_write = time.time()
+            session[STICKY_SESSION_KEY] = self.last_write + current_app.config["MYBLOG_REPLICA_STICKY_SECONDS"]
+        return response
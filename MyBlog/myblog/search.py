@@ -0,0 +1,154 @@
+import re
+import math
+from collections import Counter, defaultdict
+
+from markupsafe import Markup, escape
+
+from myblog.extensions import db
+from myblog.models import Post, SearchTerm
+
+TITLE_WEIGHT = 5  # 标题里出现一次相当于正文里出现五次
+MAX_TERM_LENGTH = 32
+
+# 中日韩文字没有空格分词，按相邻两个字切分（bigram），其他文字按单词切分
+_CJK_RANGES = r"\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af"
+_TOKEN_RE = re.compile(r"([%s]+)|([^\W_%s]+)" % (_CJK_RANGES, _CJK_RANGES))
+
+
+def strip_html(html):
+    """去掉HTML标签并还原实体，和模板里的 striptags 过滤器效果一样"""
+    return Markup(html or "").striptags()
+
+
+def tokenize(text):
+    """
+    中文按二元切分：“全文搜索” -> 全文、文搜、搜索，只有一个字的时候保留单字；英文和数字转成小写的单词
+    """
+    tokens = []
+    for cjk, word in _TOKEN_RE.findall(text or ""):
+        if cjk:
+            if len(cjk) == 1:
+                tokens.append(cjk)
+            else:
+                tokens.extend(cjk[i:i + 2] for i in range(len(cjk) - 1))
+        else:
+            tokens.append(word.lower()[:MAX_TERM_LENGTH])
+    return tokens
+
+
+def index_terms(text):
+    """
+    建索引用的词：在 tokenize 的基础上，每段中文再多记一个末尾的单字。
+    这样每个汉字要么是某个二元词的第一个字，要么是单字词，搜单个汉字时用前缀匹配就能找全
+    """
+    tokens = tokenize(text)
+    tokens.extend(cjk[-1] for cjk, word in _TOKEN_RE.findall(text or "") if len(cjk) > 1)
+    return tokens
+
+
+def _term_weights(post):
+    weights = Counter(index_terms(strip_html(post.body)))
+    for term in index_terms(post.title):
+        weights[term] += TITLE_WEIGHT
+    return weights
+
+
+def unindex_post(post_id):
+    SearchTerm.query.filter_by(post_id=post_id).delete(synchronize_session=False)
+
+
+def index_post(post):
+    """
+    增量更新一篇文章的索引，新建、编辑文章以后调用，post 需要已经有 id
+    """
+    unindex_post(post.id)
+    mappings = [dict(term=term, post_id=post.id, weight=weight) for term, weight in _term_weights(post).items()]
+    if mappings:
+        db.session.bulk_insert_mappings(SearchTerm, mappings)
+
+
+def rebuild_index(batch_size=500):
+    """
+    重建整个索引，按 id 分批读取文章，避免一次把所有正文读进内存
+    :return: 建立索引的文章数
+    """
+    SearchTerm.query.delete(synchronize_session=False)
+    last_id = 0
+    count = 0
+    while True:
+        posts = Post.query.filter(Post.id > last_id).order_by(Post.id).limit(batch_size).all()
+        if not posts:
+            break
+        mappings = []
+        for post in posts:
+            mappings.extend(dict(term=term, post_id=post.id, weight=weight)
+                            for term, weight in _term_weights(post).items())
+        count += len(posts)
+        last_id = posts[-1].id  # 提交以后对象会过期，先记下最后一个 id
+        db.session.bulk_insert_mappings(SearchTerm, mappings)
+        db.session.commit()
+        db.session.expunge_all()
+    return count
+
+
+def search(query, limit=500):
+    """
+    返回包含全部关键词的文章，按 TF-IDF 的分数排序。
+    中文按二元切分以后，要求所有二元词都命中，效果接近短语搜索
+    :param limit: 最多返回的文章数，先在数据库里按词频之和选出这么多候选文章，常见的单字不会把大半个索引读进内存
+    :return: 排好序的文章 id 列表
+    """
+    terms = set(tokenize(query))
+    if not terms:
+        return []
+
+    conditions = []
+    for term in terms:
+        if len(term) == 1 and _TOKEN_RE.match(term).group(1):
+            conditions.append(SearchTerm.term.like(term + "%"))  # 单个汉字匹配以它开头的二元词和它自己
+        else:
+            conditions.append(SearchTerm.term == term)
+    condition = db.or_(*conditions)
+
+    # 命中的是哪个关键词：精确匹配的就是它自己，前缀匹配的是第一个字
+    matched = db.case([(SearchTerm.term.in_(sorted(terms)), SearchTerm.term)], else_=db.func.substr(SearchTerm.term, 1, 1))
+    candidates = db.session.query(SearchTerm.post_id).filter(condition).group_by(SearchTerm.post_id) \
+        .having(db.func.count(db.distinct(matched)) == len(terms)) \
+        .order_by(db.func.sum(SearchTerm.weight).desc(), SearchTerm.post_id).limit(limit).subquery()
+    rows = db.session.query(SearchTerm.post_id, SearchTerm.term, SearchTerm.weight).filter(condition) \
+        .join(candidates, SearchTerm.post_id == candidates.c.post_id).all()
+    if not rows:
+        return []
+
+    document_frequency = dict(db.session.query(SearchTerm.term, db.func.count(SearchTerm.post_id))
+                              .filter(condition).group_by(SearchTerm.term))
+    total = db.session.query(db.func.count(Post.id)).scalar() or 1
+    scores = defaultdict(float)
+    for post_id, term, weight in rows:
+        scores[post_id] += (1 + math.log(weight)) * math.log(1 + total / document_frequency[term])
+    return sorted(scores, key=lambda post_id: scores[post_id], reverse=True)
+
+
+def make_snippet(post, query, length=120):
+    """
+    截取正文里第一次出现关键词附近的一段文字，关键词用 <mark> 标出
+    """
+    text = strip_html(post.body)
+    lowered = text.lower()
+    keywords = sorted(set(query.lower().split()) | set(tokenize(query)), key=len, reverse=True)
+    positions = [lowered.find(keyword) for keyword in keywords if keyword and lowered.find(keyword) >= 0]
+    start = max(min(positions) - length // 4, 0) if positions else 0
+    snippet = text[start:start + length]
+
+    pattern = re.compile("|".join(re.escape(keyword) for keyword in keywords if keyword), re.IGNORECASE)
+    highlighted = Markup("")
+    last = 0
+    for match in pattern.finditer(snippet):
+        highlighted += escape(snippet[last:match.start()]) + Markup("<mark>%s</mark>") % match.group()
+        last = match.end()
+    highlighted += escape(snippet[last:])
+    if start > 0:
+        highlighted = Markup("...") + highlighted
+    if start + length < len(text):
+        highlighted += Markup("...")
+    return highlighted
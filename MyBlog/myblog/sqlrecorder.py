@@ -0,0 +1,157 @@
+import re
+import time
+import traceback
+from datetime import datetime
+from collections import deque, Counter
+from threading import Lock
+
+from flask import g, request, current_app, has_app_context, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# 把 IN (?, ?, ?) 这类长度不定的参数列表折叠成一个，同一条语句换了参数也能认出来
+_PARAM_LIST_RE = re.compile(r"\((?:\s*(?:\?|%s|:\w+)\s*,)+\s*(?:\?|%s|:\w+)\s*\)")
+
+
+def normalize(statement):
+    return _PARAM_LIST_RE.sub("(?)", " ".join(statement.split()))
+
+
+class EndpointStats(object):
+    def __init__(self):
+        self.requests = 0
+        self.queries = 0
+        self.duration = 0.0
+        self.max_queries = 0
+        self.max_duration = 0.0
+
+    @property
+    def avg_queries(self):
+        return self.queries / float(self.requests) if self.requests else 0
+
+    @property
+    def avg_duration(self):
+        return self.duration / self.requests if self.requests else 0
+
+
+class SQLRecorder(object):
+    """
+    基于 SQLAlchemy 事件的查询记录器。
+
+    每个请求执行的语句、参数、耗时都记在 g.sql_queries 里，请求结束时汇总到各个端点的统计中。
+    超过 MYBLOG_SLOW_QUERY_THRESHOLD 秒的查询写进日志，并放进一个固定长度的环形缓冲区；
+    同一个请求里同一条语句（只是参数不同）执行了 MYBLOG_N_PLUS_ONE_THRESHOLD 次以上时当作 N+1 查询记录下来。
+    统计数据保存在进程内，多 worker 部署时每个进程各有一份。
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.endpoints = {}
+        self.slow_queries = None
+        self.n_plus_one = {}  # (endpoint, statement) -> (单个请求里最多执行的次数, 出现过的请求数)
+        self._lock = Lock()
+        self._listening = False
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("MYBLOG_SQL_RECORDER", True)
+        app.config.setdefault("MYBLOG_SLOW_QUERY_THRESHOLD", 1)
+        app.config.setdefault("MYBLOG_SLOW_QUERY_BUFFER_SIZE", 50)
+        app.config.setdefault("MYBLOG_N_PLUS_ONE_THRESHOLD", 5)
+
+        self.app = app
+        self.slow_queries = deque(maxlen=app.config["MYBLOG_SLOW_QUERY_BUFFER_SIZE"])
+        app.extensions["sql_recorder"] = self
+        if not app.config["MYBLOG_SQL_RECORDER"]:
+            return
+
+        # 引擎由 flask-sqlalchemy 延迟创建，直接监听 Engine 类，回调里只处理属于这个应用的查询
+        if not self._listening:
+            event.listen(Engine, "before_cursor_execute", self._before_cursor_execute)
+            event.listen(Engine, "after_cursor_execute", self._after_cursor_execute)
+            self._listening = True
+        app.teardown_request(self._teardown_request)
+
+    def reset(self):
+        with self._lock:
+            self.endpoints.clear()
+            self.n_plus_one.clear()
+            self.slow_queries.clear()
+
+    def ranked_endpoints(self, key="duration"):
+        """
+        按数据库总耗时（或者总查询数）从高到低排列的端点统计
+        :param key: duration 或 queries
+        """
+        with self._lock:
+            items = list(self.endpoints.items())
+        return sorted(items, key=lambda item: getattr(item[1], key), reverse=True)
+
+    def worst_queries(self):
+        with self._lock:
+            queries = list(self.slow_queries)
+        return sorted(queries, key=lambda query: query["duration"], reverse=True)
+
+    def n_plus_one_queries(self):
+        with self._lock:
+            items = [dict(endpoint=endpoint, statement=statement, max_repeats=max_repeats, requests=requests)
+                     for (endpoint, statement), (max_repeats, requests) in self.n_plus_one.items()]
+        return sorted(items, key=lambda item: item["max_repeats"], reverse=True)
+
+    def _is_ours(self):
+        return has_app_context() and current_app._get_current_object() is self.app
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if context is not None and self._is_ours():
+            context._myblog_query_start = time.perf_counter()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        start = getattr(context, "_myblog_query_start", None)
+        if start is None:
+            return
+        duration = time.perf_counter() - start
+        endpoint = request.endpoint if has_request_context() else None
+        query = dict(statement=statement, parameters=parameters, duration=duration, endpoint=endpoint)
+        if has_request_context():
+            g.setdefault("sql_queries", []).append(query)
+
+        if duration >= current_app.config["MYBLOG_SLOW_QUERY_THRESHOLD"]:
+            query["caller"] = self._find_caller()
+            query["timestamp"] = datetime.utcnow()
+            with self._lock:
+                self.slow_queries.append(query)
+            current_app.logger.warning("Slow query %.3fs in %s (%s)\n%s\nParameters: %.200r", duration,
+                                       endpoint or "<no request>", query["caller"], statement, parameters)
+
+    @staticmethod
+    def _find_caller():
+        """调用栈里最近的一个项目代码位置，只在慢查询时计算"""
+        for frame in reversed(traceback.extract_stack()[:-3]):
+            if "/myblog/" in frame.filename.replace("\\", "/") and not frame.filename.endswith("sqlrecorder.py"):
+                return "%s:%d %s" % (frame.filename.rsplit("myblog", 1)[-1].lstrip("/\\"), frame.lineno, frame.name)
+        return None
+
+    def _teardown_request(self, exc):
+        queries = g.pop("sql_queries", [])
+        endpoint = request.endpoint
+        if endpoint is None:
+            return
+        duration = sum(query["duration"] for query in queries)
+        repeated = Counter(normalize(query["statement"]) for query in queries)
+        threshold = current_app.config["MYBLOG_N_PLUS_ONE_THRESHOLD"]
+        suspects = [(statement, count) for statement, count in repeated.items() if count >= threshold]
+
+        with self._lock:
+            stats = self.endpoints.setdefault(endpoint, EndpointStats())
+            stats.requests += 1
+            stats.queries += len(queries)
+            stats.duration += duration
+            stats.max_queries = max(stats.max_queries, len(queries))
+            stats.max_duration = max(stats.max_duration, duration)
+            for statement, count in suspects:
+                max_repeats, requests = self.n_plus_one.get((endpoint, statement), (0, 0))
+                self.n_plus_one[(endpoint, statement)] = (max(max_repeats, count), requests + 1)
+
+        for statement, count in suspects:
+            current_app.logger.warning("Possible N+1 query in %s: executed %d times\n%s", endpoint, count, statement)
@@ -0,0 +1,59 @@
+import zlib
+
+from flask import current_app, request, g, get_flashed_messages, stream_with_context
+from flask_wtf.csrf import generate_csrf
+from markupsafe import Markup
+
+FLUSH_MARKER = "<!--myblog:flush-->"
+GZIP_LEVEL = 6
+
+
+def stream_flush():
+    """
+    模板里的刷新点，流式渲染时在这里把已经渲染好的部分发给浏览器，普通渲染时什么也不输出
+    """
+    return Markup(FLUSH_MARKER) if g.get("streaming_template") else ""
+
+
+def _generate(template, context, compressor):
+    """
+    按刷新点把模板分段输出，两个刷新点之间的小片段先攒起来，避免发出大量很小的数据块。
+    压缩时每段结束用 Z_SYNC_FLUSH，浏览器收到的每一段都能马上解压出来
+    """
+    buffer = []
+    for piece in template.generate(context):
+        if FLUSH_MARKER not in piece:
+            buffer.append(piece)
+            continue
+        buffer.append(str(piece).replace(FLUSH_MARKER, ""))  # Markup.replace 会转义参数，先转成普通字符串
+        data = "".join(buffer).encode("utf-8")
+        buffer = []
+        yield compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH) if compressor else data
+
+    data = "".join(buffer).encode("utf-8")
+    yield compressor.compress(data) + compressor.flush() if compressor else data
+
+
+def stream_template(template_name, **context):
+    """
+    流式渲染模板，模板里 stream_flush() 之前的部分渲染完就先发出去。
+    响应头发出以后 session 就不能再改了，所以 CSRF 令牌和 flash 消息要在开始输出之前准备好；
+    模板里的异常发生在响应头之后，浏览器只会收到不完整的页面，可能出错的查询应该在视图里做完
+    """
+    app = current_app._get_current_object()
+    generate_csrf()  # 令牌保存在 session 里，先生成
+    get_flashed_messages(with_categories=True)  # 取出的消息缓存在请求上下文里，模板再取时不会再改 session
+    g.streaming_template = True
+    app.update_template_context(context)
+    template = app.jinja_env.get_or_select_template(template_name)
+
+    compressor = None
+    if app.config["MYBLOG_STREAM_GZIP"] and request.accept_encodings["gzip"]:
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # 16+ 表示 gzip 格式
+    response = app.response_class(stream_with_context(_generate(template, context, compressor)),
+                                  mimetype="text/html")
+    if compressor is not None:
+        response.headers["Content-Encoding"] = "gzip"
+    response.vary.add("Accept-Encoding")
+    response.headers["X-Accel-Buffering"] = "no"  # 让 nginx 收到一段就转发一段，不要攒成整个响应
+    return response
@@ -0,0 +1,189 @@
+import os
+import time
+import sqlite3
+import threading
+from threading import Lock
+from collections import OrderedDict
+
+from flask import request
+from werkzeug.exceptions import TooManyRequests
+
+
+def refill(tokens, updated, capacity, interval, now):
+    """
+    令牌桶：每 interval 秒补一个令牌，最多 capacity 个
+    :return: (现在的令牌数, 桶重新装满的时间)
+    """
+    tokens = min(capacity, tokens + (now - updated) / interval)
+    return tokens, now + (capacity - tokens) * interval
+
+
+class MemoryStore(object):
+    """
+    进程内的令牌桶，每个 worker 各算各的。
+    桶按最近使用的顺序排列，超过 max_keys 个时淘汰最久没有用过的桶，每次取令牌的代价都是 O(1)。
+    大量不同 IP、用户名的请求会把旧的桶挤出去，被挤出去的桶相当于重新装满，多 worker 时可以用 SQLiteStore
+    """
+
+    def __init__(self, max_keys=10000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()  # key -> (tokens, updated)，最近用过的在最后
+        self._lock = Lock()
+
+    def take(self, key, capacity, interval, now):
+        """
+        从桶里取一个令牌
+        :return: (是否取到, 取不到时还要等待的秒数)
+        """
+        with self._lock:
+            bucket = self._buckets.pop(key, None)
+            tokens = refill(*bucket, capacity, interval, now)[0] if bucket else capacity
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return allowed, 0 if allowed else (1 - tokens) * interval
+
+    def reset(self, key):
+        with self._lock:
+            self._buckets.pop(key, None)
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class SQLiteStore(object):
+    """
+    多个 worker 进程共用的令牌桶，存在一个 SQLite 文件里，取令牌在 BEGIN IMMEDIATE 事务里完成，进程之间不会重复扣减。
+    每个线程一个连接；每 prune_every 次取令牌清理一次已经装满的桶
+    """
+
+    def __init__(self, path, prune_every=1000):
+        self.path = path
+        self.prune_every = prune_every
+        self._local = threading.local()
+        self._takes = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = self._connect()
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS login_bucket "
+                         "(key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL, full_at REAL NOT NULL)")
+        finally:
+            conn.close()  # sqlite3 的连接用在 with 里只会结束事务，不会关闭连接
+
+    def _connect(self):
+        # isolation_level=None 关掉 sqlite3 模块自己的事务管理，事务由 BEGIN IMMEDIATE 显式开始
+        return sqlite3.connect(self.path, timeout=5, isolation_level=None)
+
+    @property
+    def connection(self):
+        conn = getattr(self._local, "connection", None)
+        if conn is None:
+            conn = self._local.connection = self._connect()
+        return conn
+
+    def take(self, key, capacity, interval, now):
+        conn = self.connection
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT tokens, updated FROM login_bucket WHERE key = ?", (key,)).fetchone()
+            tokens, full_at = refill(*row, capacity, interval, now) if row else (capacity, now)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+                full_at += interval
+            conn.execute("INSERT OR REPLACE INTO login_bucket (key, tokens, updated, full_at) VALUES (?, ?, ?, ?)",
+                         (key, tokens, now, full_at))
+            self._takes += 1
+            if self._takes % self.prune_every == 0:
+                conn.execute("DELETE FROM login_bucket WHERE full_at <= ?", (now,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return allowed, 0 if allowed else (1 - tokens) * interval
+
+    def reset(self, key):
+        self.connection.execute("DELETE FROM login_bucket WHERE key = ?", (key,))
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM login_bucket").fetchone()[0]
+
+
+class LoginThrottle(object):
+    """
+    登录限流：每个 IP 和每个用户名各一个令牌桶，在校验密码之前扣令牌，
+    取不到令牌直接返回 429，不会为了暴力破解去计算代价很高的密码哈希。
+
+    MYBLOG_LOGIN_IP_BURST / MYBLOG_LOGIN_IP_INTERVAL：每个 IP 最多连续尝试的次数，之后每隔多少秒恢复一次；
+    MYBLOG_LOGIN_USER_BURST / MYBLOG_LOGIN_USER_INTERVAL：同上，按用户名计算，挡住换着 IP 猜同一个账户的情况，登录成功后清零。
+    MYBLOG_LOGIN_THROTTLE_STORE 为空时每个 worker 各自计数，设置成 SQLite 文件路径时所有 worker 共用一份。
+    部署在反向代理后面时要用 ProxyFix 之类的中间件让 remote_addr 是真实的客户端地址，否则所有人共用一个 IP 桶。
+    """
+
+    def __init__(self, app=None):
+        self.store = None
+        self.enabled = False
+        self.limits = {}
+        self.counters = dict(allowed=0, ip_limited=0, user_limited=0)
+        self._lock = Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("MYBLOG_LOGIN_THROTTLE", True)
+        app.config.setdefault("MYBLOG_LOGIN_IP_BURST", 10)
+        app.config.setdefault("MYBLOG_LOGIN_IP_INTERVAL", 30)
+        app.config.setdefault("MYBLOG_LOGIN_USER_BURST", 5)
+        app.config.setdefault("MYBLOG_LOGIN_USER_INTERVAL", 60)
+        app.config.setdefault("MYBLOG_LOGIN_THROTTLE_STORE", None)
+
+        self.enabled = app.config["MYBLOG_LOGIN_THROTTLE"]
+        self.limits = dict(ip=(app.config["MYBLOG_LOGIN_IP_BURST"], app.config["MYBLOG_LOGIN_IP_INTERVAL"]),
+                           user=(app.config["MYBLOG_LOGIN_USER_BURST"], app.config["MYBLOG_LOGIN_USER_INTERVAL"]))
+        path = app.config["MYBLOG_LOGIN_THROTTLE_STORE"]
+        self.store = SQLiteStore(path) if path else MemoryStore()
+
+    @staticmethod
+    def user_key(username):
+        return "user:" + (username or "").strip().lower()[:64]
+
+    def check(self, username):
+        """
+        一次登录尝试，先扣 IP 的令牌再扣用户名的令牌，被 IP 挡住时不会消耗用户名的令牌
+        :raise TooManyRequests: 任意一个桶空了，retry_after 为还要等待的秒数
+        """
+        if not self.enabled:
+            return
+        now = time.time()
+        for kind, key in (("ip", "ip:%s" % request.remote_addr), ("user", self.user_key(username))):
+            allowed, retry_after = self.store.take(key, *self.limits[kind], now)
+            if not allowed:
+                self._count(kind + "_limited")
+                error = TooManyRequests("登录尝试太频繁了，请 %d 秒后再试" % (retry_after + 1))
+                # Werkzeug 1.0 以前的 HTTPException 不接受 retry_after 参数，由 429 的错误处理函数写进 Retry-After
+                error.retry_after = int(retry_after) + 1
+                raise error
+        self._count("allowed")
+
+    def reset(self, username):
+        """登录成功后清空这个用户名的桶"""
+        if self.enabled:
+            self.store.reset(self.user_key(username))
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def to_dict(self):
+        with self._lock:
+            counters = dict(self.counters)
+        return dict(pid=os.getpid(), enabled=self.enabled, store=type(self.store).__name__, buckets=len(self.store),
+                    limits=dict((kind, dict(burst=burst, interval=interval))
+                                for kind, (burst, interval) in self.limits.items()),
+                    **counters)
@@ -1,6 +1,12 @@
-from flask import request, redirect, url_for, current_app
+import time
+import hashlib
+from functools import wraps
+from flask import request, redirect, url_for, current_app, session
+from flask_login import current_user
 from urllib.parse import urlparse, urljoin
 
+from myblog.models import Comment
+
 
 def is_safe_url(target):
     """
@@ -33,18 +39,59 @@ def allowed_file(filename):
             current_app.config["MYBLOG_ALLOWED_IMAGE_EXTENSIONS"]
 
 
+def conditional(get_last_modified, csrf=False):
+    """
+    条件请求（ETag / Last-Modified）装饰器。
 
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+    get_last_modified 接收和视图函数一样的参数，只查询页面内容的最后修改时间。
+    请求里的 If-None-Match / If-Modified-Since 匹配时直接返回 304，不会执行视图函数，
+    也就不会加载文章正文和渲染模板。
+    :param get_last_modified: 返回 datetime，返回 None 时不做条件请求处理
+    :param csrf: 页面里有表单时为 True，CSRF 令牌有有效期，ETag 每半个有效期变化一次，避免浏览器用上过期的令牌
+    """
+    def decorator(view):
+        @wraps(view)
+        def decorated_view(*args, **kwargs):
+            # 有待显示的 flash 消息时页面内容不一样，不做处理
+            if request.method != "GET" or "_flashes" in session:
+                return view(*args, **kwargs)
+            last_modified = get_last_modified(*args, **kwargs)
+            if last_modified is None:
+                return view(*args, **kwargs)
+
+            keys = [request.full_path, request.cookies.get("theme", ""), last_modified.isoformat()]
+            last_modified = last_modified.replace(microsecond=0)  # HTTP 日期只精确到秒
+            # 页面还跟主题、登录状态、CSRF 令牌有关时，修改时间不能说明页面有没有变化，只用 ETag 校验
+            use_last_modified = not (csrf or current_user.is_authenticated
+                                     or request.cookies.get("theme", "blue") != "blue")  # 默认主题见 base.html
+            if current_user.is_authenticated:
+                # 管理员看到的页面上还有待审核评论数，新评论不会改变文章和博客资料的修改时间
+                keys.extend([current_user.get_id(), str(Comment.unread_count())])
+            if csrf:
+                time_limit = current_app.config.get("WTF_CSRF_TIME_LIMIT") or 3600
+                keys.append(str(int(time.time() // (time_limit / 2))))
+            etag = hashlib.sha1("|".join(keys).encode("utf-8")).hexdigest()
+
+            if request.if_none_match:
+                not_modified = request.if_none_match.contains_weak(etag)
+            elif request.if_modified_since and use_last_modified:
+                not_modified = request.if_modified_since.replace(tzinfo=None) >= last_modified
+            else:
+                not_modified = False
+
+            if not_modified:
+                response = current_app.response_class(status=304)
+            else:
+                response = current_app.make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag, weak=True)
+            if use_last_modified:
+                response.last_modified = last_modified
+            response.cache_control.no_cache = True  # 浏览器每次都要带着校验值来确认
+            response.vary.add("Cookie")
+            return response
+
+        return decorated_view
+
+    return decorator
@@ -0,0 +1,84 @@
+import unittest
+
+from myblog import create_app
+from myblog.extensions import db
+from myblog.models import Post, Category
+
+
+class CategoryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        app = create_app("testing")
+        app.config.update(SQLALCHEMY_DATABASE_URI="sqlite:///:memory:")
+        self.context = app.app_context()
+        self.context.push()
+        db.create_all()
+        self.runner = app.test_cli_runner()
+
+        self.default = Category(name="Default")
+        self.python = Category(name="Python")
+        self.flask = Category(name="Flask")
+        db.session.add_all([self.default, self.python, self.flask])
+        db.session.flush()
+        for category, count in ((self.default, 1), (self.python, 2), (self.flask, 1)):
+            for i in range(count):
+                db.session.add(Post(title="%s %d" % (category.name, i), body="body", category=category))
+        db.session.flush()
+        Category.update_post_counts()
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
+
+    def post_ids(self, category_id):
+        return set(post_id for post_id, in db.session.query(Post.id).filter(Post.category_id == category_id))
+
+    def test_merge_into(self):
+        python_id, flask_id = self.python.id, self.flask.id
+        expected = self.post_ids(python_id) | self.post_ids(flask_id)
+        self.assertEqual(self.python.merge_into(self.flask), 2)
+        db.session.commit()
+        self.assertIsNone(Category.query.get(python_id))
+        self.assertEqual(self.post_ids(flask_id), expected)
+        self.assertEqual(self.flask.post_count, 3)
+        self.assertEqual(self.default.post_count, 1)
+
+    def test_merge_into_itself(self):
+        with self.assertRaises(ValueError):
+            self.python.merge_into(self.python)
+        db.session.rollback()
+        self.assertEqual(len(self.post_ids(self.python.id)), 2)
+        self.assertEqual(self.python.post_count, 2)
+
+    def test_delete(self):
+        python_id = self.python.id
+        self.assertEqual(self.python.delete(), 2)
+        self.assertIsNone(Category.query.get(python_id))
+        self.assertEqual(len(self.post_ids(self.default.id)), 3)
+        self.assertEqual(self.default.post_count, 3)
+
+    def test_delete_default(self):
+        with self.assertRaises(ValueError):
+            self.default.delete()
+        self.assertEqual(Category.query.count(), 3)
+        self.assertEqual(self.default.post_count, 1)
+
+    def test_merge_category_command(self):
+        default_id, flask_id = self.default.id, self.flask.id
+        result = self.runner.invoke(args=["merge-category", "Python", str(flask_id)])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("移动了2篇文章", result.output)
+        self.assertEqual(Category.query.get(flask_id).post_count, 3)
+        self.assertEqual(Category.query.count(), 2)
+
+        for args in (["Default", "Flask"], ["Flask", "Flask"], ["Nope"]):
+            result = self.runner.invoke(args=["merge-category"] + args)
+            self.assertNotEqual(result.exit_code, 0, args)
+        self.assertEqual(Category.query.get(flask_id).post_count, 3)
+        self.assertEqual(Category.query.get(default_id).post_count, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,110 @@
+import unittest
+
+from myblog import create_app
+from myblog.extensions import db
+from myblog.models import Admin, Post, Comment
+
+
+class BulkCommentTestCase(unittest.TestCase):
+
+    def setUp(self):
+        app = create_app("testing")
+        app.config.update(SQLALCHEMY_DATABASE_URI="sqlite:///:memory:", WTF_CSRF_ENABLED=False)
+        self.context = app.app_context()
+        self.context.push()
+        db.create_all()
+        self.client = app.test_client()
+
+        # post 下面：a -> a1 -> a2，b（未审核）-> b1；other 下面：c，以及回复 a 的老数据 x -> x1
+        self.post = Post(title="post", body="body")
+        self.other = Post(title="other", body="body")
+        db.session.add_all([self.post, self.other])
+        db.session.flush()
+        self.a = self.add_comment(self.post)
+        self.a1 = self.add_comment(self.post, self.a)
+        self.a2 = self.add_comment(self.post, self.a1, reviewed=False)
+        self.b = self.add_comment(self.post, reviewed=False)
+        self.b1 = self.add_comment(self.post, self.b, reviewed=False)
+        self.c = self.add_comment(self.other)
+        self.x = self.add_comment(self.other, self.a)
+        self.x1 = self.add_comment(self.other, self.x)
+        Post.update_comment_counts()
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
+
+    def add_comment(self, post, replied=None, reviewed=True):
+        comment = Comment(author="yl", body="comment", post=post, replied=replied, reviewed=reviewed)
+        db.session.add(comment)
+        db.session.flush()
+        comment.set_path()
+        return comment
+
+    def remaining(self):
+        db.session.expire_all()
+        return set(comment_id for comment_id, in db.session.query(Comment.id))
+
+    def counts(self, post):
+        db.session.refresh(post)
+        return post.comment_count, post.reviewed_comment_count
+
+    def test_bulk_delete_thread_across_posts(self):
+        ids = [self.c.id, self.b.id, self.b1.id]
+        count, replies, post_ids = Comment.bulk_delete(ids=[self.a.id])
+        db.session.commit()
+        self.assertEqual((count, replies), (5, 4))
+        self.assertEqual(post_ids, {self.post.id, self.other.id})
+        self.assertEqual(self.remaining(), set(ids))
+        self.assertEqual(self.counts(self.post), (2, 0))
+        self.assertEqual(self.counts(self.other), (1, 1))
+
+    def test_bulk_delete_filter(self):
+        ids = [self.a.id, self.a1.id, self.c.id, self.x.id, self.x1.id]
+        count, replies, post_ids = Comment.bulk_delete(post_id=self.post.id, reviewed=False)
+        db.session.commit()
+        self.assertEqual((count, replies), (3, 0))
+        self.assertEqual(post_ids, {self.post.id})
+        self.assertEqual(self.remaining(), set(ids))
+        self.assertEqual(self.counts(self.post), (2, 2))
+        self.assertEqual(self.counts(self.other), (3, 3))
+
+    def test_bulk_delete_nothing(self):
+        self.assertEqual(Comment.bulk_delete(ids=[0]), (0, 0, set()))
+        self.assertEqual(len(self.remaining()), 8)
+
+    def test_bulk_approve(self):
+        count, post_ids = Comment.bulk_approve(ids=[self.a2.id, self.b.id, self.c.id])
+        db.session.commit()
+        self.assertEqual((count, post_ids), (2, {self.post.id}))
+        self.assertFalse(Comment.query.get(self.b1.id).reviewed)  # 回复不会跟着发表
+        self.assertEqual(self.counts(self.post), (5, 4))
+        self.assertEqual(self.counts(self.other), (3, 3))
+
+    def test_bulk_comment_view(self):
+        admin = Admin(username="yl")
+        admin.set_password("password")
+        db.session.add(admin)
+        db.session.commit()
+        referer = dict(Referer="http://localhost/admin/comment/manage")
+        self.client.post("/auth/login", data=dict(username="yl", password="password"), headers=referer)
+
+        response = self.client.post("/admin/comment/bulk", data=dict(action="delete", scope="selected"),
+                                    headers=referer)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(len(self.remaining()), 8)  # 没有勾选评论时什么都不做
+
+        self.client.post("/admin/comment/bulk", data=dict(action="approve", scope="filter", filter="unread",
+                                                          post_id=self.post.id), headers=referer)
+        self.assertEqual(self.counts(self.post), (5, 5))
+
+        self.client.post("/admin/comment/bulk", data=dict(action="delete", scope="selected", ids=[self.b.id]),
+                         headers=referer)
+        self.assertEqual(self.remaining(), {self.a.id, self.a1.id, self.a2.id, self.c.id, self.x.id, self.x1.id})
+        self.assertEqual(self.counts(self.post), (3, 3))
+
+
+if __name__ == "__main__":
+    unittest.main()
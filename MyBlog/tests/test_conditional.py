@@ -0,0 +1,62 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from myblog import create_app
+from myblog.extensions import db, context_cache
+from myblog.models import Admin
+
+
+class ConditionalRequestTestCase(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.app = create_app("testing")
+        self.app.config.update(SQLALCHEMY_DATABASE_URI="sqlite:///" + os.path.join(directory, "myblog.db"),
+                               WTF_CSRF_ENABLED=False)
+        # 登录状态放在 g 里，请求会沿用已经推送的程序上下文，所以只在准备数据时推送
+        with self.app.app_context():
+            db.create_all()
+            admin = Admin(username="yl", blog_title="MyBlog", name="yl", about="about")
+            admin.set_password("password")
+            db.session.add(admin)
+            db.session.commit()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        context_cache.invalidate()
+
+    def revalidate(self, response):
+        """带着上一次响应里的 Last-Modified 再请求一次"""
+        return self.client.get("/about", headers={"If-Modified-Since": response.headers["Last-Modified"]})
+
+    def test_anonymous_default_theme(self):
+        response = self.client.get("/about")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("Last-Modified", response.headers)
+        self.assertEqual(self.revalidate(response).status_code, 304)
+        self.client.set_cookie("localhost", "theme", "blue")
+        self.assertEqual(self.revalidate(response).status_code, 304)
+
+    def test_theme_changed(self):
+        response = self.client.get("/about")
+        self.client.set_cookie("localhost", "theme", "dark")
+        response = self.revalidate(response)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn("Last-Modified", response.headers)
+        # ETag 里包含了主题，换回来以前的校验值都不会命中
+        self.assertEqual(self.client.get("/about", headers={"If-None-Match": response.headers["ETag"]}).status_code,
+                         304)
+
+    def test_logged_in(self):
+        response = self.client.get("/about")
+        self.client.post("/auth/login", data=dict(username="yl", password="password"),
+                         headers={"Referer": "http://localhost/"})
+        self.assertEqual(self.revalidate(response).status_code, 200)
+        self.assertNotIn("Last-Modified", self.client.get("/about").headers)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,77 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from flask_mail import Message
+
+from myblog import create_app
+from myblog.extensions import mail_dispatcher
+from myblog.mailqueue import SpoolBackend
+
+
+class FlakySpoolBackend(SpoolBackend):
+    """发给 bad@example.com 的邮件总是失败，发给 flaky@example.com 的邮件第一次失败"""
+
+    def __init__(self, directory):
+        super(FlakySpoolBackend, self).__init__(directory)
+        self.flaky = True
+
+    def send_batch(self, messages):
+        while messages:
+            recipient = messages[0].recipients[0]
+            if recipient == "bad@example.com":
+                raise RuntimeError("550 no such user")
+            if recipient == "flaky@example.com" and self.flaky:
+                self.flaky = False
+                raise RuntimeError("421 try again later")
+            super(FlakySpoolBackend, self).send_batch(messages[:1])
+            messages.pop(0)
+
+
+class MailDispatcherTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        app = create_app("testing")
+        app.config.update(MYBLOG_MAIL_BACKEND="spool", MYBLOG_MAIL_SPOOL_DIR=self.directory,
+                          MYBLOG_MAIL_RETRIES=2, MYBLOG_MAIL_RETRY_DELAY=0.001)
+        mail_dispatcher.init_app(app)
+        mail_dispatcher.stats = dict.fromkeys(mail_dispatcher.stats, 0)
+        mail_dispatcher.backend = FlakySpoolBackend(self.directory)
+        self.addCleanup(mail_dispatcher.shutdown)
+
+    def message(self, recipient):
+        return Message("新的评论", sender="yl@example.com", recipients=[recipient], body=recipient)
+
+    def spooled(self):
+        recipients = []
+        for filename in os.listdir(self.directory):
+            if filename.endswith(".eml") and not filename.startswith("."):
+                with open(os.path.join(self.directory, filename), encoding="utf-8") as f:
+                    recipients.extend(line.split(":", 1)[1].strip() for line in f if line.startswith("To:"))
+        return sorted(recipients)
+
+    def test_skip_failing_mail(self):
+        recipients = ["a@example.com", "bad@example.com", "flaky@example.com", "b@example.com"]
+        batch = [self.message(recipient) for recipient in recipients]
+        mail_dispatcher._deliver(batch)
+        self.assertEqual(batch, [])
+        self.assertEqual(self.spooled(), ["a@example.com", "b@example.com", "flaky@example.com"])
+        self.assertEqual(mail_dispatcher.stats["sent"], 3)
+        self.assertEqual(mail_dispatcher.stats["failed"], 1)
+        self.assertEqual(mail_dispatcher.stats["retried"], 3)  # bad 重试两次，flaky 重试一次
+
+    def test_workers(self):
+        for recipient in ("a@example.com", "bad@example.com", "b@example.com"):
+            self.assertTrue(mail_dispatcher.send(self.message(recipient)))
+        mail_dispatcher.shutdown()  # 等队列里的邮件发完
+        self.assertEqual(self.spooled(), ["a@example.com", "b@example.com"])
+        self.assertEqual(mail_dispatcher.stats["queued"], 3)
+        self.assertEqual(mail_dispatcher.stats["sent"], 2)
+        self.assertEqual(mail_dispatcher.stats["failed"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
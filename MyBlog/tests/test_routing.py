@@ -0,0 +1,83 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+
+from sqlalchemy import event
+
+from myblog import create_app
+from myblog.extensions import db, context_cache, mail_dispatcher
+from myblog.fakes import fake_admin, fake_categories, fake_posts
+from myblog.models import Post
+from myblog.settings import config
+
+
+class ReplicaRoutingTestCase(unittest.TestCase):
+    """主库和只读副本是同一个数据库的两个 SQLite 文件，通过引擎上的事件记录每次请求读了哪个库"""
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.primary, self.replica = os.path.join(directory, "primary.db"), os.path.join(directory, "replica.db")
+        with mock.patch.multiple(config["testing"], SQLALCHEMY_DATABASE_URI="sqlite:///" + self.primary,
+                                 MYBLOG_DATABASE_REPLICAS=["sqlite:///" + self.replica], WTF_CSRF_ENABLED=False,
+                                 MAIL_SUPPRESS_SEND=True, MAIL_USERNAME="yl@example.com",
+                                 MAIL_DEFAULT_SENDER="yl@example.com", create=True):
+            self.app = create_app("testing")
+        self.addCleanup(mail_dispatcher.shutdown)
+
+        # 请求会沿用已经推送的程序上下文，g 里选好的副本会带到下一个请求，所以只在准备数据时推送
+        with self.app.app_context():
+            db.create_all(bind=None)
+            fake_admin()
+            fake_categories(1)
+            fake_posts(2)
+            self.post_id = Post.query.first().id
+            db.session.remove()
+            shutil.copy(self.primary, self.replica)
+            db.last_write = 0  # 准备数据时写过主库
+
+            self.reads = []
+            for name, bind in (("primary", None), ("replica", "replica_0")):
+                event.listen(db.get_engine(self.app, bind), "before_cursor_execute",
+                             lambda *args, name=name: self.reads.append(name))
+
+    def tearDown(self):
+        context_cache.invalidate()
+
+    def read(self, client, url):
+        """请求一个页面，返回这个请求读过的数据库"""
+        context_cache.invalidate()  # 模板上下文缓存命中时不会查询
+        del self.reads[:]
+        self.assertEqual(client.get(url).status_code, 200)
+        return set(self.reads)
+
+    def count_comments(self, path):
+        with sqlite3.connect(path) as connection:
+            return connection.execute("SELECT COUNT(*) FROM comment WHERE body = 'read after write'").fetchone()[0]
+
+    def test_blog_reads_use_replica(self):
+        client = self.app.test_client()
+        self.assertEqual(self.read(client, "/"), {"replica"})
+        self.assertEqual(self.read(client, "/post/%d" % self.post_id), {"replica"})
+        self.assertEqual(self.read(client, "/auth/login"), {"primary"})  # 不在 MYBLOG_REPLICA_BLUEPRINTS 里
+
+    def test_read_after_write_uses_primary(self):
+        url = "/post/%d" % self.post_id
+        client, other = self.app.test_client(), self.app.test_client()
+        response = client.post(url, data=dict(author="yl", email="yl@example.com", body="read after write"))
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual((self.count_comments(self.primary), self.count_comments(self.replica)), (1, 0))
+
+        # 刚写过数据库的进程里所有请求都先读主库
+        self.assertEqual(self.read(other, url), {"primary"})
+        # 进程级的窗口过去以后，写过数据库的浏览器会话仍然读主库，其他会话回到副本
+        db.last_write = 0
+        self.assertEqual(self.read(client, url), {"primary"})
+        self.assertEqual(self.read(other, url), {"replica"})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+import unittest
+
+from myblog import create_app
+from myblog.extensions import db
+from myblog.models import Post, Category
+from myblog.search import tokenize, index_terms, index_post, search
+
+
+class SearchTestCase(unittest.TestCase):
+
+    def setUp(self):
+        app = create_app("testing")
+        app.config.update(SQLALCHEMY_DATABASE_URI="sqlite:///:memory:")
+        self.context = app.app_context()
+        self.context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
+
+    def add_post(self, title, body):
+        post = Post(title=title, body=body)
+        db.session.add(post)
+        db.session.flush()
+        index_post(post)
+        db.session.commit()
+        return post
+
+    def test_tokenize(self):
+        self.assertEqual(tokenize("全文搜索 Flask"), ["全文", "文搜", "搜索", "flask"])
+        self.assertEqual(index_terms("全文搜索"), ["全文", "文搜", "搜索", "索"])
+
+    def test_search_bigrams(self):
+        post = self.add_post("全文搜索", "<p>倒排索引</p>")
+        self.add_post("别的文章", "<p>没有关键词</p>")
+        self.assertEqual(search("搜索"), [post.id])
+        self.assertEqual(search("倒排 索引"), [post.id])
+        self.assertEqual(search("索搜"), [])
+
+    def test_search_single_character(self):
+        post = self.add_post("全文搜索", "<p>正文</p>")
+        self.assertEqual(search("全"), [post.id])
+        self.assertEqual(search("搜"), [post.id])
+
+    def test_search_trailing_character(self):
+        # “索”只出现在标题最后，没有以它开头的二元词
+        post = self.add_post("全文搜索", "<p>hello world</p>")
+        self.assertEqual(search("索"), [post.id])
+        self.assertEqual(search("hello"), [post.id])
+
+    def test_search_limit(self):
+        # 单字前缀匹配时只取词频之和最高的几篇，按 TF-IDF 排序
+        posts = [self.add_post("文章 %d" % i, "<p>%s</p>" % ("文字" * i)) for i in range(1, 6)]
+        self.add_post("别的", "<p>hello</p>")
+        self.assertEqual(search("文"), [post.id for post in reversed(posts)])
+        self.assertEqual(search("文", limit=2), [posts[4].id, posts[3].id])
+        self.assertEqual(search("文字 hello"), [])
+
+    def test_search_view_clamps_page(self):
+        post = self.add_post("全文搜索", "<p>正文</p>")
+        post.category = Category(name="Default")
+        db.session.commit()
+        client = self.context.app.test_client()
+        for page in ("0", "-1", "x"):
+            response = client.get("/search?q=搜索&page=" + page)
+            self.assertEqual(response.status_code, 200)
+            self.assertIn(post.title, response.get_data(as_text=True))
+
+
+if __name__ == "__main__":
+    unittest.main()
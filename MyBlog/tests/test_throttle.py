@@ -0,0 +1,73 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from myblog import create_app
+from myblog.extensions import db, login_throttle
+from myblog.throttle import MemoryStore, SQLiteStore
+
+
+class LoginThrottleTestCase(unittest.TestCase):
+
+    def setUp(self):
+        app = create_app("testing")
+        app.config.update(SQLALCHEMY_DATABASE_URI="sqlite:///:memory:", WTF_CSRF_ENABLED=False,
+                          MYBLOG_LOGIN_IP_BURST=2, MYBLOG_LOGIN_IP_INTERVAL=30)
+        login_throttle.init_app(app)
+        self.context = app.app_context()
+        self.context.push()
+        db.create_all()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
+
+    def login(self):
+        return self.client.post("/auth/login", data=dict(username="yl", password="wrong password"))
+
+    def test_too_many_requests(self):
+        self.assertEqual(self.login().status_code, 200)
+        self.assertEqual(self.login().status_code, 200)
+        response = self.login()
+        self.assertEqual(response.status_code, 429)
+        self.assertIn(int(response.headers["Retry-After"]), range(30, 32))
+
+
+class StoreTestCase(unittest.TestCase):
+
+    def test_refill(self):
+        store = MemoryStore()
+        self.assertEqual(store.take("ip:1", 2, 10, now=0), (True, 0))
+        self.assertEqual(store.take("ip:1", 2, 10, now=0), (True, 0))
+        self.assertEqual(store.take("ip:1", 2, 10, now=0), (False, 10))
+        self.assertEqual(store.take("ip:1", 2, 10, now=5), (False, 5))
+        self.assertEqual(store.take("ip:1", 2, 10, now=10), (True, 0))
+
+    def test_evict_least_recently_used(self):
+        store = MemoryStore(max_keys=2)
+        store.take("a", 1, 60, now=0)
+        store.take("b", 1, 60, now=0)
+        self.assertFalse(store.take("a", 1, 60, now=0)[0])  # a 变成最近用过的
+        store.take("c", 1, 60, now=0)  # 挤掉 b
+        self.assertEqual(len(store), 2)
+        self.assertFalse(store.take("a", 1, 60, now=0)[0])
+        self.assertTrue(store.take("b", 1, 60, now=0)[0])
+
+    def test_sqlite_store_is_shared(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "throttle.sqlite")
+        first, second = SQLiteStore(path), SQLiteStore(path)
+        self.assertTrue(first.take("user:yl", 2, 60, now=0)[0])
+        self.assertTrue(second.take("user:yl", 2, 60, now=0)[0])
+        self.assertFalse(first.take("user:yl", 2, 60, now=0)[0])
+        second.reset("user:yl")
+        self.assertTrue(first.take("user:yl", 2, 60, now=0)[0])
+        self.assertEqual(len(first), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,902 @@
+"""
+路由级别的基准测试：用测试客户端逐个请求 MyBlog 的 blog、admin 蓝本和 MessageBoard 的所有路由，
+统计每个路由的 p50/p95/p99 延迟、每次请求的SQL查询数和峰值内存，并和基线结果对比。
+
+    python benchmarks/bench.py forge --scale 100k            # 生成数据集，已经存在的直接复用
+    python benchmarks/bench.py run --scale 1k --scale 100k   # 跑基准测试，有基线时打印对比结果
+    python benchmarks/bench.py run --save-baseline           # 把这次的结果写进基线文件
+    python benchmarks/bench.py run -c MYBLOG_RESPONSE_CACHE_TYPE='"memory"'  # 覆盖配置项
+    python benchmarks/bench.py import-dataset /path/to/other/benchmarks/data  # 导入别的版本生成的数据集
+    python benchmarks/bench.py concurrency --app myblog --path /post/1 --latency 5  # 同一个进程里 WSGI 线程池和 ASGI 的吞吐量
+
+每个应用、每个数据规模在单独的子进程里测量，请求作用在数据集的副本上，写操作不会改动数据集。
+"""
+import os
+import sys
+import json
+import math
+import time
+import asyncio
+import shutil
+import sqlite3
+import platform
+import tempfile
+import itertools
+import subprocess
+import tracemalloc
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+
+try:
+    import resource
+except ImportError:  # Windows 没有 resource 模块
+    resource = None
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_DIR = os.path.join(ROOT, "benchmarks")
+DATA_DIR = os.path.join(BENCH_DIR, "data")
+BASELINE = os.path.join(BENCH_DIR, "baseline.json")
+
+APPS = ("myblog", "sayhello")
+# 按评论数（留言板按留言数）划分的数据规模，文章和分类的数量跟着增长
+SCALES = OrderedDict([
+    ("1k", dict(comments=1000, posts=100, categories=5)),
+    ("100k", dict(comments=100000, posts=5000, categories=20)),
+    ("1m", dict(comments=1000000, posts=20000, categories=50)),
+])
+WARMUP = 1  # 每个路由先请求一次，模板编译、缓存预热不计入结果
+METRICS = ("p50", "p95", "p99", "queries", "peak_kb")
+# 变化小于这个值的不算回归，避免毫秒以下的抖动刷屏
+NOISE_FLOOR = dict(p50=1.0, p95=2.0, p99=2.0, queries=0, peak_kb=64)
+
+
+class PoolExhausted(Exception):
+    pass
+
+
+class IdPool(object):
+    """
+    删除、审核这类请求每次都要换一个目标，第一次使用时才加载，这样读到的是前面的写请求执行完以后的数据
+    """
+
+    def __init__(self, app, loader):
+        self.app = app
+        self.loader = loader
+        self.ids = None
+
+    def pop(self):
+        if self.ids is None:
+            with self.app.app_context():
+                self.ids = list(self.loader())
+        if not self.ids:
+            raise PoolExhausted()
+        return self.ids.pop()
+
+
+class Route(object):
+    """
+    一个被测路由，url 和 data 可以是无参函数，每次请求时调用
+    """
+
+    def __init__(self, endpoint, url, method="GET", data=None, login=False, variant=None):
+        self.endpoint = endpoint
+        self.url = url
+        self.method = method
+        self.data = data
+        self.login = login
+        self.name = "%s %s%s" % (method, endpoint, variant or "")
+
+    def request(self, client):
+        url = self.url() if callable(self.url) else self.url
+        data = self.data() if callable(self.data) else self.data
+        # redirect_back 需要 Referer，不然没有可以跳转的地址
+        return client.open(url, method=self.method, data=data, headers={"Referer": "http://localhost/"})
+
+
+class QueryCounter(object):
+    def __init__(self, engine):
+        from sqlalchemy import event
+
+        self.count = 0
+        event.listen(engine, "before_cursor_execute", self._count)
+
+    def _count(self, *args):
+        self.count += 1
+
+
+def dataset_path(app_name, scale):
+    return os.path.join(DATA_DIR, "%s-%s.db" % (app_name, scale))
+
+
+def parse_settings(settings):
+    """
+    -c KEY=VALUE，VALUE 按 JSON 解析，解析不了的当作字符串
+    """
+    overrides = OrderedDict()
+    for setting in settings:
+        key, _, value = setting.partition("=")
+        try:
+            overrides[key] = json.loads(value)
+        except ValueError:
+            overrides[key] = value
+    return overrides
+
+
+def percentile(values, percent):
+    """最近秩法计算百分位数"""
+    values = sorted(values)
+    return values[max(int(math.ceil(percent / 100.0 * len(values))) - 1, 0)]
+
+
+######### 加载应用 ###########
+
+
+def load_myblog(path, overrides):
+    sys.path.insert(0, os.path.join(ROOT, "MyBlog"))
+    from myblog import create_app
+    from myblog.settings import config, TestingConfig
+
+    class BenchmarkConfig(TestingConfig):
+        SQLALCHEMY_DATABASE_URI = "sqlite:///" + path
+        WTF_CSRF_ENABLED = False
+        MAIL_SUPPRESS_SEND = True
+        MAIL_USERNAME = "bench@example.com"
+        MAIL_DEFAULT_SENDER = ("MyBlog", "bench@example.com")
+
+    for key, value in overrides.items():
+        setattr(BenchmarkConfig, key, value)
+    config["benchmark"] = BenchmarkConfig
+    return create_app("benchmark")
+
+
+def load_sayhello(path, overrides):
+    os.environ["DATABASE_URI"] = "sqlite:///" + path  # sayhello 导入的时候就读取了配置
+    sys.path.insert(0, os.path.join(ROOT, "MessageBoard"))
+    from sayhello import app
+
+    app.config["WTF_CSRF_ENABLED"] = False
+    app.config.update(overrides)
+    return app
+
+
+######### 生成数据集 ###########
+
+
+def forge_myblog(path, scale, processes):
+    app = load_myblog(path, {})
+    from myblog.extensions import db
+    from myblog.fakes import fake_admin, fake_categories, fake_posts, fake_comments, fake_links
+    from myblog.search import rebuild_index
+
+    size = SCALES[scale]
+    with app.app_context():
+        db.create_all()
+        fake_admin()
+        fake_categories(size["categories"])
+        fake_posts(size["posts"], 5000, processes)
+        # fake_comments 会额外生成 30% 的待审核、管理员评论和回复
+        fake_comments(size["comments"] * 10 // 13, 5000, processes)
+        fake_links()
+        rebuild_index()
+
+
+def forge_sayhello(path, scale, processes):
+    from faker import Faker
+
+    app = load_sayhello(path, {})
+    from sayhello import db
+    from sayhello.models import Message
+
+    fake = Faker("zh_CN")
+    total = SCALES[scale]["comments"]
+    with app.app_context():
+        db.create_all()
+        for start in range(0, total, 5000):
+            rows = [dict(name=fake.name(), body=fake.sentence(), timestamp=fake.date_time_this_year())
+                    for i in range(min(5000, total - start))]
+            db.session.execute(Message.__table__.insert(), rows)
+            db.session.commit()
+            click.echo("  messages: %d/%d" % (start + len(rows), total))
+
+
+def copy_dataset(source, path):
+    """
+    把 source 里各个表和 path 共有的列复制过去，path 里的表已经按当前代码的模型建好
+    """
+    connection = sqlite3.connect(path)
+    try:
+        connection.execute("ATTACH DATABASE ? AS source", (source,))
+        tables = [name for name, in connection.execute(
+            "SELECT name FROM main.sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'")]
+        for table in tables:
+            old = [row[1] for row in connection.execute('PRAGMA source.table_info("%s")' % table)]
+            columns = ", ".join('"%s"' % column for column in old if column in
+                                set(row[1] for row in connection.execute('PRAGMA main.table_info("%s")' % table)))
+            if columns:
+                connection.execute('INSERT INTO main."%s" (%s) SELECT %s FROM source."%s"'
+                                   % (table, columns, columns, table))
+        connection.commit()
+    finally:
+        connection.close()
+
+
+def import_myblog(source, path):
+    app = load_myblog(path, {})
+    from myblog.extensions import db
+
+    with app.app_context():
+        db.create_all()
+        db.session.remove()
+        db.engine.dispose()
+    copy_dataset(source, path)
+    # 旧版本生成的数据集没有冗余的计数、讨论串路径和搜索索引，有 upgrade 命令的版本用它回填
+    if "upgrade" in app.cli.commands:
+        result = app.test_cli_runner().invoke(args=["upgrade"])
+        if result.exit_code != 0:
+            raise click.ClickException(result.output)
+
+
+def import_sayhello(source, path):
+    app = load_sayhello(path, {})
+    from sayhello import db
+
+    with app.app_context():
+        db.create_all()
+        db.session.remove()
+        db.engine.dispose()
+    copy_dataset(source, path)
+
+
+######### 路由 ###########
+
+
+def myblog_routes(app):
+    from myblog.extensions import db
+    from myblog.models import Post, Comment, Category, Link
+
+    with app.app_context():
+        per_page = app.config["MYBLOG_POST_PAGE_NUM"]
+        # 只用各个版本都有的列挑选目标，import-dataset 导入的同一份数据在不同版本上测的是同样的页面
+        post_id, = db.session.query(Comment.post_id).filter(Comment.reviewed == True).group_by(Comment.post_id) \
+            .order_by(db.func.count(Comment.id).desc(), Comment.post_id).first()  # 评论最多的文章
+        # 文章页有的版本按评论分页，有的按讨论串分页，按顶层评论算出的最后一页在各个版本里都存在
+        thread_count = Comment.query.filter(Comment.post_id == post_id, Comment.reviewed == True,
+                                            Comment.replied_id.is_(None)).count()
+        category_id, = db.session.query(Post.category_id).filter(Post.category_id != 1) \
+            .group_by(Post.category_id).order_by(db.func.count(Post.id).desc(), Post.category_id).first()
+        comment = Comment.query.filter_by(post_id=post_id, reviewed=True).order_by(Comment.id).first()
+        post_pages = max(int(math.ceil(Post.query.count() / float(per_page))), 1)
+        comment_pages = max(int(math.ceil(Comment.query.count() / float(per_page))), 1)
+        post_comment_pages = max(int(math.ceil(thread_count / float(per_page))), 1)
+        keyword = Post.query.get(post_id).title[:2]
+        comment_id = comment.id
+        link_id = Link.query.order_by(Link.id).first().id
+
+    names = itertools.count()
+
+    def unique(prefix):
+        return lambda: "%s-%d" % (prefix, next(names))
+
+    def create(model, **kwargs):
+        def loader():
+            objects = [model(**dict((key, value()) for key, value in kwargs.items())) for i in range(200)]
+            db.session.add_all(objects)
+            db.session.commit()
+            return [obj.id for obj in objects]
+
+        return loader
+
+    def chunks(pool, size):
+        """批量操作每次处理 size 个目标"""
+        return lambda: [pool.pop() for i in range(size)]
+
+    unreviewed = IdPool(app, lambda: [id for id, in db.session.query(Comment.id).filter_by(reviewed=False)
+                                      .order_by(Comment.id).limit(200)])
+    comments = IdPool(app, lambda: [id for id, in db.session.query(Comment.id).filter_by(reviewed=True)
+                                    .order_by(Comment.id.desc()).limit(200)])
+    posts = IdPool(app, lambda: [id for id, in db.session.query(Post.id).filter(Post.id != post_id)
+                                 .order_by(Post.id.desc()).limit(200)])
+    categories = IdPool(app, create(Category, name=unique("bench-category")))
+    links = IdPool(app, create(Link, name=unique("bench-link"), url=lambda: "#"))
+    merged = IdPool(app, create(Category, name=unique("bench-merged")))
+    # 批量审核、删除用新建的未审核评论，不和单条审核、删除抢目标
+    bulk_approve = IdPool(app, create(Comment, author=lambda: "bench", body=lambda: "bulk", post_id=lambda: post_id,
+                                      reviewed=lambda: False))
+    bulk_delete = IdPool(app, create(Comment, author=lambda: "bench", body=lambda: "bulk", post_id=lambda: post_id,
+                                     reviewed=lambda: False))
+    post_data = lambda: dict(title="bench %d" % next(names), body="<p>benchmark</p>", category=category_id)
+
+    return [
+        Route("blog.index", "/"),
+        Route("blog.index", "/?page=%d" % post_pages, variant="?page=last"),
+        Route("blog.about", "/about"),
+        Route("blog.show_category", "/category/%d" % category_id),
+        Route("blog.show_post", "/post/%d" % post_id),
+        Route("blog.show_post", "/post/%d?page=%d" % (post_id, post_comment_pages), variant="?page=last"),
+        Route("blog.search", "/search?q=%s" % keyword),
+        Route("blog.reply_comment", "/reply/comment/%d" % comment_id),
+        Route("blog.change_theme", "/change-theme/dark"),
+        Route("blog.show_post", "/post/%d" % post_id, method="POST",
+              data=dict(author="bench", email="bench@example.com", body="benchmark")),
+
+        Route("admin.settings", "/admin/settings", login=True),
+        Route("admin.manage_post", "/admin/post/manage", login=True),
+        Route("admin.manage_post", "/admin/post/manage?page=%d" % post_pages, login=True, variant="?page=last"),
+        Route("admin.new_post", "/admin/post/new", login=True),
+        Route("admin.edit_post", "/admin/post/%d/edit" % post_id, login=True),
+        Route("admin.manage_comment", "/admin/comment/manage", login=True),
+        Route("admin.manage_comment", "/admin/comment/manage?filter=unread", login=True, variant="?filter=unread"),
+        Route("admin.manage_comment", "/admin/comment/manage?filter=admin", login=True, variant="?filter=admin"),
+        Route("admin.manage_comment", "/admin/comment/manage?page=%d" % comment_pages, login=True,
+              variant="?page=last"),
+        Route("admin.manage_category", "/admin/category/manage", login=True),
+        Route("admin.new_category", "/admin/category/new", login=True),
+        Route("admin.edit_category", "/admin/category/%d/edit" % category_id, login=True),
+        Route("admin.manage_link", "/admin/link/manage", login=True),
+        Route("admin.new_link", "/admin/link/new", login=True),
+        Route("admin.edit_link", "/admin/link/%d/edit" % link_id, login=True),
+        Route("admin.queries", "/admin/queries", login=True),
+        Route("admin.pool", "/admin/pool", login=True),
+        Route("admin.throttle", "/admin/throttle", login=True),
+
+        Route("admin.settings", "/admin/settings", method="POST", login=True,
+              data=dict(name="bench", blog_title="MyBlog", blog_sub_title="benchmark", about="benchmark")),
+        Route("admin.new_post", "/admin/post/new", method="POST", login=True, data=post_data),
+        Route("admin.edit_post", "/admin/post/%d/edit" % post_id, method="POST", login=True, data=post_data),
+        Route("admin.set_comment", "/admin/post/%d/set-comment" % post_id, method="POST", login=True),
+        Route("admin.approve_comment", lambda: "/admin/comment/%d/approve" % unreviewed.pop(), method="POST",
+              login=True),
+        Route("admin.new_category", "/admin/category/new", method="POST", login=True,
+              data=lambda: dict(name=unique("category")())),
+        Route("admin.edit_category", "/admin/category/%d/edit" % category_id, method="POST", login=True,
+              data=lambda: dict(name=unique("renamed")())),
+        Route("admin.new_link", "/admin/link/new", method="POST", login=True,
+              data=lambda: dict(name=unique("link")(), url="#")),
+        Route("admin.edit_link", "/admin/link/%d/edit" % link_id, method="POST", login=True,
+              data=lambda: dict(name=unique("link")(), url="#")),
+        Route("admin.bulk_comment", "/admin/comment/bulk", method="POST", login=True, variant=" approve",
+              data=lambda: dict(action="approve", scope="selected", ids=chunks(bulk_approve, 5)())),
+        Route("admin.bulk_comment", "/admin/comment/bulk", method="POST", login=True, variant=" approve unread",
+              data=dict(action="approve", scope="filter", filter="unread", post_id=post_id)),
+        Route("admin.reset_queries", "/admin/queries/reset", method="POST", login=True),
+
+        Route("admin.delete_comment", lambda: "/admin/comment/%d/delete" % comments.pop(), method="POST",
+              login=True),
+        Route("admin.delete_post", lambda: "/admin/post/%d/delete" % posts.pop(), method="POST", login=True),
+        Route("admin.delete_category", lambda: "/admin/category/%d/delete" % categories.pop(), method="POST",
+              login=True),
+        Route("admin.delete_link", lambda: "/admin/link/%d/delete" % links.pop(), method="POST", login=True),
+        Route("admin.bulk_comment", "/admin/comment/bulk", method="POST", login=True, variant=" delete",
+              data=lambda: dict(action="delete", scope="selected", ids=chunks(bulk_delete, 5)())),
+        Route("admin.merge_category", lambda: "/admin/category/%d/merge" % merged.pop(), method="POST", login=True,
+              data=dict(target_id=category_id)),
+    ]
+
+
+def sayhello_routes(app):
+    from sayhello.models import Message
+
+    cursor = ""
+    if "messages" in app.view_functions:
+        with app.app_context():
+            oldest = Message.query.order_by(Message.timestamp.asc(), Message.id.asc()).first()
+            cursor = oldest.cursor if oldest is not None else ""
+
+    return [
+        Route("index", "/"),
+        Route("messages", "/messages"),
+        Route("messages", "/messages?older_than=%s" % cursor, variant="?older_than=last"),
+        Route("buffer_stats", "/buffer/stats"),
+        Route("index", "/", method="POST", data=dict(name="bench", body="benchmark")),
+    ]
+
+
+def myblog_dataset(app):
+    from myblog.models import Post, Comment, Category
+
+    with app.app_context():
+        return dict(categories=Category.query.count(), posts=Post.query.count(), comments=Comment.query.count())
+
+
+def sayhello_dataset(app):
+    from sayhello.models import Message
+
+    with app.app_context():
+        return dict(messages=Message.query.count())
+
+
+def myblog_login(app, client):
+    client.post("/auth/login", data=dict(username="yl", password="yl"), headers={"Referer": "http://localhost/"})
+
+
+def sayhello_db():
+    from sayhello import db
+    return db
+
+
+def myblog_db():
+    from myblog.extensions import db
+    return db
+
+
+def myblog_asgi(app):
+    from myblog.asgi import ASGIApp
+    return ASGIApp(app, myblog_db())
+
+
+def sayhello_asgi(app):
+    from sayhello.aio import ASGIApp
+    return ASGIApp(app, sayhello_db())
+
+
+LOADERS = dict(myblog=load_myblog, sayhello=load_sayhello)
+FORGERS = dict(myblog=forge_myblog, sayhello=forge_sayhello)
+IMPORTERS = dict(myblog=import_myblog, sayhello=import_sayhello)
+ROUTES = dict(myblog=myblog_routes, sayhello=sayhello_routes)
+DATASETS = dict(myblog=myblog_dataset, sayhello=sayhello_dataset)
+LOGINS = dict(myblog=myblog_login, sayhello=None)
+DATABASES = dict(myblog=myblog_db, sayhello=sayhello_db)
+ASGI_APPS = dict(myblog=myblog_asgi, sayhello=sayhello_asgi)
+
+
+######### 测量 ###########
+
+
+def bench_route(client, route, counter, requests, max_seconds):
+    """
+    先预热，然后在请求数和时间预算内反复请求，最后单独请求一次用 tracemalloc 测峰值内存
+    （tracemalloc 会明显拖慢请求，不和延迟一起测）
+    """
+    result = OrderedDict(samples=0)
+    timings, queries, statuses = [], [], set()
+    try:
+        for i in range(WARMUP):
+            route.request(client)
+        deadline = time.time() + max_seconds
+        while len(timings) < requests and (not timings or time.time() < deadline):
+            counter.count = 0
+            start = time.perf_counter()
+            response = route.request(client)
+            timings.append((time.perf_counter() - start) * 1000)
+            queries.append(counter.count)
+            statuses.add(response.status_code)
+
+        tracemalloc.start()
+        try:
+            route.request(client)
+            result["peak_kb"] = tracemalloc.get_traced_memory()[1] // 1024
+        finally:
+            tracemalloc.stop()
+    except PoolExhausted:
+        result["error"] = "no more targets"
+    except Exception as e:
+        result["error"] = "%s: %s" % (type(e).__name__, e)
+
+    if timings:
+        result["samples"] = len(timings)
+        for percent in (50, 95, 99):
+            result["p%d" % percent] = round(percentile(timings, percent), 3)
+        result["queries"] = max(queries)
+        result["status"] = sorted(statuses)
+    return result
+
+
+def measure(app_name, scale, requests, max_seconds, overrides):
+    source = dataset_path(app_name, scale)
+    workdir = tempfile.mkdtemp(prefix="myblog-bench-")
+    path = os.path.join(workdir, os.path.basename(source))
+    shutil.copyfile(source, path)  # 写请求改的是副本
+    try:
+        app = LOADERS[app_name](path, overrides)
+        app.logger.disabled = True  # 500 错误会记录在结果里，不用再打印堆栈
+        with app.app_context():
+            counter = QueryCounter(DATABASES[app_name]().engine)
+        dataset = DATASETS[app_name](app)
+
+        clients = dict(anonymous=app.test_client(), admin=app.test_client())
+        if LOGINS[app_name] is not None:
+            LOGINS[app_name](app, clients["admin"])
+
+        routes = OrderedDict()
+        for route in ROUTES[app_name](app):
+            if route.endpoint not in app.view_functions:  # 对比旧版本时，后来才加的路由不测
+                click.echo("  %-50s skipped, no such endpoint" % route.name, err=True)
+                continue
+            client = clients["admin" if route.login else "anonymous"]
+            routes[route.name] = bench_route(client, route, counter, requests, max_seconds)
+            click.echo("  %-50s %s" % (route.name, format_row(routes[route.name])), err=True)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    max_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource is not None else None
+    return OrderedDict(dataset=dataset, config=overrides, max_rss_kb=max_rss_kb, routes=routes)
+
+
+def simulate_latency(seconds):
+    """
+    每条SQL之前等待 seconds 秒，模拟隔着网络的数据库。
+    异步请求里用 asyncio.sleep，等待期间事件循环可以处理别的请求；同步请求里用 time.sleep，线程一直被占着
+    """
+    from sqlalchemy import event, exc
+    from sqlalchemy.engine import Engine
+    from sqlalchemy.util import await_only
+
+    @event.listens_for(Engine, "before_cursor_execute")
+    def wait(*args):
+        sleep = asyncio.sleep(seconds)
+        try:
+            await_only(sleep)
+        except exc.MissingGreenlet:  # 不在 greenlet 里，是同步请求
+            sleep.close()
+            time.sleep(seconds)
+
+
+def summarize(timings, statuses, elapsed):
+    return OrderedDict(requests=len(timings), rps=round(len(timings) / elapsed, 1),
+                       p50=round(percentile(timings, 50), 3), p99=round(percentile(timings, 99), 3),
+                       status=sorted(statuses))
+
+
+def run_wsgi_clients(app, path, requests, threads):
+    """threads 个线程同时请求，相当于一个 gunicorn gthread worker"""
+    from werkzeug.test import EnvironBuilder, run_wsgi_app
+
+    def request(i):
+        start = time.perf_counter()
+        app_iter, status, headers = run_wsgi_app(app, EnvironBuilder(path=path).get_environ(), buffered=True)
+        return (time.perf_counter() - start) * 1000, int(status.split()[0])
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        results = list(executor.map(request, range(requests)))
+    return summarize([result[0] for result in results], set(result[1] for result in results),
+                     time.perf_counter() - start)
+
+
+async def run_asgi_clients(asgi, path, requests, clients):
+    """clients 个协程同时请求同一个 ASGI 应用，每个请求完成以后马上发下一个"""
+    path, _, query_string = path.partition("?")
+    remaining = iter(range(requests))
+    timings, statuses = [], set()
+
+    async def request():
+        scope = dict(type="http", method="GET", path=path, query_string=query_string.encode(), http_version="1.1",
+                     headers=[(b"host", b"localhost")], server=("localhost", 80), client=("127.0.0.1", 0))
+        messages = [dict(type="http.request", body=b"", more_body=False)]
+        response = {}
+
+        async def receive():
+            return messages.pop() if messages else dict(type="http.disconnect")
+
+        async def send(message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+
+        start = time.perf_counter()
+        await asgi(scope, receive, send)
+        timings.append((time.perf_counter() - start) * 1000)
+        statuses.add(response.get("status"))
+
+    async def client():
+        for i in remaining:
+            await request()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client() for i in range(clients)])
+    return summarize(timings, statuses, time.perf_counter() - start)
+
+
+async def shutdown(asgi):
+    """按 ASGI lifespan 协议通知应用退出，关闭异步引擎和线程池"""
+    async def receive():
+        return dict(type="lifespan.shutdown")
+
+    async def send(message):
+        pass
+
+    await asgi(dict(type="lifespan"), receive, send)
+
+
+def measure_concurrency(app_name, scale, path, requests, threads, clients, latency, overrides):
+    source = dataset_path(app_name, scale)
+    workdir = tempfile.mkdtemp(prefix="myblog-bench-")
+    db_path = os.path.join(workdir, os.path.basename(source))
+    shutil.copyfile(source, db_path)
+    try:
+        app = LOADERS[app_name](db_path, overrides)
+        app.logger.disabled = True
+        if latency:
+            simulate_latency(latency / 1000.0)
+        asgi = ASGI_APPS[app_name](app)
+
+        async def run_asgi():
+            await run_asgi_clients(asgi, path, clients, clients)  # 预热：建立连接、编译模板
+            result = await run_asgi_clients(asgi, path, requests, clients)
+            await shutdown(asgi)
+            return result
+
+        run_wsgi_clients(app, path, threads, threads)
+        results = OrderedDict()
+        results["wsgi (%d threads)" % threads] = run_wsgi_clients(app, path, requests, threads)
+        results["asgi (%d clients)" % clients] = asyncio.run(run_asgi())
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+######### 报告 ###########
+
+
+def format_row(result):
+    if not result["samples"]:
+        return result.get("error", "")
+    return "n=%-4d p50=%9.2fms p95=%9.2fms p99=%9.2fms queries=%-4d peak=%7dKB status=%s%s" % (
+        result["samples"], result["p50"], result["p95"], result["p99"], result["queries"],
+        result.get("peak_kb", 0), ",".join(str(status) for status in result["status"]),
+        "  (%s)" % result["error"] if "error" in result else "")
+
+
+def compare(baseline, report, threshold):
+    """
+    和基线对比，延迟、内存超过阈值或者查询数增加算作回归
+    :return: 回归的条目列表
+    """
+    regressions = []
+    for key, result in report["results"].items():
+        old = baseline.get("results", {}).get(key)
+        if old is None:
+            click.echo("%s: 基线里没有这个数据集，跳过对比" % key)
+            continue
+        click.echo("\n%s 对比基线：" % key)
+        changed = False
+        for name, route in result["routes"].items():
+            old_route = old["routes"].get(name)
+            if old_route is None:
+                continue
+            for metric in METRICS:
+                before, after = old_route.get(metric), route.get(metric)
+                if before is None or after is None or abs(after - before) <= NOISE_FLOOR[metric]:
+                    continue
+                if metric == "queries":
+                    worse, better = after > before, after < before
+                else:
+                    worse, better = after > before * (1 + threshold), after < before * (1 - threshold)
+                if not (worse or better):
+                    continue
+                changed = True
+                change = "%+.0f%%" % ((after - before) * 100.0 / before) if before else "new"
+                click.echo("  %-50s %-8s %10s -> %-10s %6s %s" % (name, metric, before, after, change,
+                                                                  "REGRESSION" if worse else "improved"))
+                if worse:
+                    regressions.append((key, name, metric, before, after))
+        if not changed:
+            click.echo("  没有明显变化")
+    return regressions
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def spawn(*args):
+    """在子进程里执行 worker 命令，每个数据集的内存统计、模块级缓存互不影响"""
+    subprocess.check_call([sys.executable, os.path.abspath(__file__), "worker"] + [str(arg) for arg in args])
+
+
+def ensure_dataset(app_name, scale, processes, force=False):
+    path = dataset_path(app_name, scale)
+    if os.path.exists(path) and not force:
+        return
+    os.makedirs(DATA_DIR, exist_ok=True)
+    click.echo("Forging %s dataset %s..." % (app_name, scale))
+    tmp = path + ".tmp"
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    spawn("forge", app_name, scale, "--processes", processes, "--output", tmp)
+    os.replace(tmp, path)  # 生成完才改名，中途中断不会留下不完整的数据集
+
+
+######### 命令 ###########
+
+
+@click.group()
+def cli():
+    """MyBlog / MessageBoard 路由基准测试"""
+
+
+@cli.command()
+@click.option("--app", "apps", multiple=True, type=click.Choice(APPS), help="Apps to forge, default is all.")
+@click.option("--scale", "scales", multiple=True, type=click.Choice(list(SCALES)), default=["1k"],
+              show_default=True, help="Dataset scales, repeatable.")
+@click.option("--processes", default=1, help="Processes used to generate fake text.")
+@click.option("--force", is_flag=True, help="Rebuild datasets that already exist.")
+def forge(apps, scales, processes, force):
+    """Generate the SQLite datasets."""
+    for app_name in apps or APPS:
+        for scale in scales:
+            ensure_dataset(app_name, scale, processes, force)
+    click.echo("Done.")
+
+
+@cli.command("import-dataset")
+@click.argument("source_dir", type=click.Path(exists=True, file_okay=False))
+@click.option("--app", "apps", multiple=True, type=click.Choice(APPS), help="Apps to import, default is all.")
+@click.option("--scale", "scales", multiple=True, type=click.Choice(list(SCALES)), default=["1k"],
+              show_default=True, help="Dataset scales, repeatable.")
+def import_dataset(source_dir, apps, scales):
+    """Copy datasets forged by another checkout into this checkout's schema."""
+    os.makedirs(DATA_DIR, exist_ok=True)
+    for app_name in apps or APPS:
+        for scale in scales:
+            source = os.path.join(source_dir, os.path.basename(dataset_path(app_name, scale)))
+            if not os.path.exists(source):
+                click.echo("Skipping %s, not found." % source)
+                continue
+            click.echo("Importing %s..." % source)
+            path = dataset_path(app_name, scale)
+            tmp = path + ".tmp"
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            spawn("import", app_name, os.path.abspath(source), "--output", tmp)
+            os.replace(tmp, path)
+    click.echo("Done.")
+
+
+@cli.command()
+@click.option("--app", "apps", multiple=True, type=click.Choice(APPS), help="Apps to benchmark, default is all.")
+@click.option("--scale", "scales", multiple=True, type=click.Choice(list(SCALES)), default=["1k"],
+              show_default=True, help="Dataset scales, repeatable.")
+@click.option("--requests", default=30, show_default=True, help="Measured requests per route.")
+@click.option("--max-seconds", default=20.0, show_default=True, help="Time budget per route.")
+@click.option("--config", "-c", "settings", multiple=True, help="Config override KEY=JSON_VALUE, repeatable.")
+@click.option("--baseline", default=BASELINE, show_default=True, help="Baseline JSON file.")
+@click.option("--save-baseline", is_flag=True, help="Write the results into the baseline file.")
+@click.option("--threshold", default=0.2, show_default=True, help="Relative change counted as a regression.")
+@click.option("--output", help="Also write the results to this JSON file.")
+@click.option("--processes", default=1, help="Processes used when a dataset has to be forged.")
+@click.option("--strict", is_flag=True, help="Exit with status 1 when there are regressions.")
+def run(apps, scales, requests, max_seconds, settings, baseline, save_baseline, threshold, output, processes,
+        strict):
+    """Benchmark every route and diff against the baseline."""
+    report = OrderedDict(meta=OrderedDict(
+        revision=git_revision(), date=time.strftime("%Y-%m-%d %H:%M:%S"), python=platform.python_version(),
+        platform=platform.platform(), requests=requests,
+    ), results=OrderedDict())
+
+    for app_name in apps or APPS:
+        for scale in scales:
+            ensure_dataset(app_name, scale, processes)
+            key = "%s/%s" % (app_name, scale)
+            click.echo("Benchmarking %s..." % key)
+            fd, tmp = tempfile.mkstemp(suffix=".json")
+            os.close(fd)
+            try:
+                spawn("measure", app_name, scale, "--requests", requests, "--max-seconds", max_seconds,
+                      "--output", tmp, *itertools.chain.from_iterable(("-c", setting) for setting in settings))
+                with open(tmp) as f:
+                    report["results"][key] = json.load(f, object_pairs_hook=OrderedDict)
+            finally:
+                os.remove(tmp)
+
+    for key, result in report["results"].items():
+        click.echo("\n%s %s (max rss %s KB)" % (key, json.dumps(result["dataset"]), result["max_rss_kb"]))
+        for name, route in result["routes"].items():
+            click.echo("  %-50s %s" % (name, format_row(route)))
+
+    regressions = []
+    old = None
+    if os.path.exists(baseline):
+        with open(baseline) as f:
+            old = json.load(f, object_pairs_hook=OrderedDict)
+        regressions = compare(old, report, threshold)
+    else:
+        click.echo("\n没有找到基线文件 %s，用 --save-baseline 生成" % baseline)
+
+    if output:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+    if save_baseline:
+        if old is not None:  # 只更新这次跑过的数据集
+            old["results"].update(report["results"])
+            report["results"] = old["results"]
+        with open(baseline, "w") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        click.echo("Saved baseline to %s" % baseline)
+
+    if regressions:
+        click.echo("\n%d regressions." % len(regressions))
+        if strict:
+            sys.exit(1)
+
+
+@cli.command()
+@click.option("--app", "app_name", type=click.Choice(APPS), default="myblog", show_default=True)
+@click.option("--scale", type=click.Choice(list(SCALES)), default="1k", show_default=True)
+@click.option("--path", default="/", show_default=True, help="GET path requested by every client.")
+@click.option("--requests", default=500, show_default=True, help="Measured requests per mode.")
+@click.option("--threads", default=8, show_default=True, help="Threads serving the WSGI app.")
+@click.option("--clients", default=100, show_default=True, help="Concurrent clients against the ASGI app.")
+@click.option("--latency", default=0.0, show_default=True, help="Simulated DB round-trip per query, in ms.")
+@click.option("--config", "-c", "settings", multiple=True, help="Config override KEY=JSON_VALUE, repeatable.")
+@click.option("--processes", default=1, help="Processes used when a dataset has to be forged.")
+def concurrency(app_name, scale, path, requests, threads, clients, latency, settings, processes):
+    """Compare WSGI threads with the ASGI async path in one process."""
+    ensure_dataset(app_name, scale, processes)
+    fd, tmp = tempfile.mkstemp(suffix=".json")
+    os.close(fd)
+    try:
+        spawn("concurrency", app_name, scale, "--path", path, "--requests", requests, "--threads", threads,
+              "--clients", clients, "--latency", latency, "--output", tmp,
+              *itertools.chain.from_iterable(("-c", setting) for setting in settings))
+        with open(tmp) as f:
+            results = json.load(f, object_pairs_hook=OrderedDict)
+    finally:
+        os.remove(tmp)
+
+    click.echo("%s/%s GET %s, simulated latency %sms per query" % (app_name, scale, path, latency))
+    for mode, result in results.items():
+        click.echo("  %-20s n=%-5d %8.1f req/s p50=%9.2fms p99=%9.2fms status=%s" % (
+            mode, result["requests"], result["rps"], result["p50"], result["p99"],
+            ",".join(str(status) for status in result["status"])))
+
+
+@cli.group(hidden=True)
+def worker():
+    """子进程里执行的任务"""
+
+
+@worker.command("forge")
+@click.argument("app_name")
+@click.argument("scale")
+@click.option("--processes", default=1)
+@click.option("--output")
+def worker_forge(app_name, scale, processes, output):
+    FORGERS[app_name](output, scale, processes)
+
+
+@worker.command("import")
+@click.argument("app_name")
+@click.argument("source")
+@click.option("--output")
+def worker_import(app_name, source, output):
+    IMPORTERS[app_name](source, output)
+
+
+@worker.command("measure")
+@click.argument("app_name")
+@click.argument("scale")
+@click.option("--requests", default=30)
+@click.option("--max-seconds", default=20.0)
+@click.option("--output")
+@click.option("--config", "-c", "settings", multiple=True)
+def worker_measure(app_name, scale, requests, max_seconds, output, settings):
+    result = measure(app_name, scale, requests, max_seconds, parse_settings(settings))
+    with open(output, "w") as f:
+        json.dump(result, f, ensure_ascii=False)
+
+
+@worker.command("concurrency")
+@click.argument("app_name")
+@click.argument("scale")
+@click.option("--path", default="/")
+@click.option("--requests", default=500)
+@click.option("--threads", default=8)
+@click.option("--clients", default=100)
+@click.option("--latency", default=0.0)
+@click.option("--output")
+@click.option("--config", "-c", "settings", multiple=True)
+def worker_concurrency(app_name, scale, path, requests, threads, clients, latency, output, settings):
+    result = measure_concurrency(app_name, scale, path, requests, threads, clients, latency,
+                                 parse_settings(settings))
+    with open(output, "w") as f:
+        json.dump(result, f, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    cli()